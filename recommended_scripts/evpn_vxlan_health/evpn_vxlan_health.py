@@ -126,6 +126,27 @@
 #
 # - If the system goes down to bad state and comes back to good state within
 #   the polling interval, the event will be missed and alert will not happen
+#
+# - A REST query is made at most once per poll and only within the first
+#   fetch_budget seconds of the poll. A failing query is retried in a later
+#   poll, after a backoff doubled on every failure, and its object keeps its
+#   last known state meanwhile.
+#
+# - The VNI, EVPN instance and tunnel endpoint queries of a poll are made
+#   first, up to fetch_workers in parallel, then analyzed one sub-agent after
+#   another in the same order as before.
+#
+# - When VRFs or tunnel endpoints are listed, all the tunnel endpoints are
+#   fetched with one query of the attributes monitored and the listed ones
+#   selected by the script (tunnel_bulk_query).
+#
+# - The EVPN instances, VNIs and tunnel endpoints are shared by the
+#   sub-agents in memory, their variables are written once at the end of the
+#   poll and only when they changed.
+#
+# - The remote MAC / Route counts per EVPN instance and peer VTEP are
+#   compared to those of the previous poll in bulk, and the largest
+#   decreases are reported first when the alert limit is reached.
 
 LONG_DESCRIPTION = '''\
 ## Script Description
@@ -213,15 +234,29 @@ Agents derived from this script will monitor three areas:
 Note:
 - The Maximum of alert conditions processed in one poll cycle is a configurable parameter. With a minimum of 1, maximum of 6 and default of 3 alerts in one poll cycle.
 - If the system goes down to bad state and comes back to good state within the polling interval, the event will be missed and alert will not happen
+- A REST query is made at most once per poll and only within the first fetch_budget seconds of the poll. A failing query is retried in a later poll, after a backoff doubled on every failure, and its object keeps its last known state meanwhile.
+- The VNI, EVPN instance and tunnel endpoint queries of a poll are made first, up to fetch_workers in parallel, then analyzed one sub-agent after another in the same order as before.
+- When VRFs or tunnel endpoints are listed, all the tunnel endpoints are fetched with one query of the attributes monitored and the listed ones selected by the script (tunnel_bulk_query).
+- The EVPN instances, VNIs and tunnel endpoints are shared by the sub-agents in memory, their variables are written once at the end of the poll and only when they changed.
+- The remote MAC / Route counts per EVPN instance and peer VTEP are compared to those of the previous poll in bulk, and the largest decreases are reported first when the alert limit is reached.
 '''
 
 import json
-from time import (sleep, clock_gettime, CLOCK_PROCESS_CPUTIME_ID)
+from array import array
+from bisect import bisect_right
+from copy import deepcopy
+from fnmatch import fnmatchcase
+from itertools import (accumulate, chain, compress)
+from operator import lt
+from random import uniform
+from concurrent.futures import (ThreadPoolExecutor, wait)
+from threading import Lock
+from time import (clock_gettime, CLOCK_MONOTONIC, CLOCK_PROCESS_CPUTIME_ID)
 
 Manifest = {
     'Name': 'evpn_vxlan_health',
     'Description': 'Agent for monitoring EVPN and VxLAN health',
-    'Version': '3.1',
+    'Version': '3.2',
     'Author': 'HPE Aruba Networking',
     'AOSCXVersionMin': '10.13.1000',
     'AOSCXPlatformList': ['6200', '6300', '64xx', '8325', '8360', '8400', '10000', '8100']
@@ -310,6 +345,36 @@ ParameterDefinitions = {
                        'Minimum is 1, Maximum is 6 and Default is 3',
         'Type': 'Integer',
         'Default': 3
+    },
+    'fetch_budget': {
+        'Name': 'REST query time budget',
+        'Description': 'Time in seconds of a poll during which REST queries '
+                       'are made. The objects not queried in time, or whose '
+                       'query failed, keep their last known state until a '
+                       'later poll. Minimum is 1, Maximum is the poll '
+                       'interval and Default is 20',
+        'Type': 'Integer',
+        'Default': 20
+    },
+    'fetch_workers': {
+        'Name': 'REST query workers',
+        'Description': 'Number of VNI, EVPN instance and tunnel endpoint '
+                       'REST queries issued in parallel every poll. 1 '
+                       'queries them one after another. Minimum is 1, '
+                       'Maximum is 16 and Default is 4',
+        'Type': 'Integer',
+        'Default': 4
+    },
+    'tunnel_bulk_query': {
+        'Name': 'Tunnel endpoint bulk query',
+        'Description': 'Default is ''true''. When ''true'' and VRFs or '
+                       'tunnel endpoints are listed, the state, destination, '
+                       'origin, vrf and network_id of all tunnel endpoints '
+                       'are fetched with a single query and the listed ones '
+                       'are selected by the script. When set to ''false'', '
+                       'one query is issued per VRF and tunnel endpoint.',
+        'Type': 'String',
+        'Default': 'true'
     }
 }
 
@@ -349,6 +414,11 @@ EVPN = "EVPN"
 TUNNEL = "Tunnel"
 VNI = "VNI"
 NORMAL = "Normal"
+# Backoff in seconds of a failing REST query, doubled on every failure, and
+# the failures in a row after which its circuit is open
+FETCH_BACKOFF_BASE = 15
+FETCH_BACKOFF_MAX = 900
+FETCH_BREAKER_FAILURES = 3
 
 
 def dprint(*args):
@@ -357,6 +427,259 @@ def dprint(*args):
         print(args)
 
 
+def carry_stale_entries(dict_old, dict_new, stale):
+    '''this function copies to dict_new the entries of dict_old whose key
+    matches one of the stale patterns and which are missing from dict_new,
+    so the objects which could not be queried keep their last known state'''
+    for key, value in dict_old.items():
+        if key not in dict_new and \
+                any(fnmatchcase(key, pattern) for pattern in stale):
+            dict_new[key] = deepcopy(value)
+
+
+class TopologySnapshot:
+    '''This class holds the EVPN instances, VNIs and tunnel endpoints
+    monitored by the sub-agents, in the structures described in
+    Agent.__init__. A sub-agent reads the entries of the previous poll, or
+    of this poll for a table already analyzed, and replaces them once it
+    has analyzed its own table. The tables are written to their variables
+    once at the end of the poll, and only when they changed, instead of
+    being decoded and encoded by every sub-agent.
+
+    The entries handed out are not modified after they are replaced, the
+    sub-agents build new entries every poll.'''
+
+    # Table to the variable it is persisted to
+    TABLES = (('evis', 'evpn_instance_list'),
+              ('vnis', 'vni_instance_list'),
+              ('tunnels', 'tunnel_instance_list'))
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.tables = {table: {} for table, _ in self.TABLES}
+        self.persisted = dict(self.tables)
+        self.vtep_index = None
+
+    def get(self, table):
+        '''this function returns the latest entries of table'''
+        return self.tables[table]
+
+    def update(self, table, entries):
+        '''this function replaces the entries of table'''
+        self.tables[table] = entries
+        if table == 'tunnels':
+            self.vtep_index = None
+
+    def tunnel_keys_of_vtep(self, destination):
+        '''this function returns the vrf,origin,destination keys of the
+        tunnel endpoints to destination'''
+        if self.vtep_index is None:
+            self.vtep_index = {}
+            for key in self.tables['tunnels']:
+                self.vtep_index.setdefault(
+                    key.split(',', 2)[-1], []).append(key)
+        return self.vtep_index.get(destination, [])
+
+    def persist(self):
+        '''this function writes the tables changed since their last write'''
+        for table, name in self.TABLES:
+            entries = self.tables[table]
+            if entries is not self.persisted[table] and \
+                    entries != self.persisted[table]:
+                self.agent.variables[name] = json.dumps(entries)
+            self.persisted[table] = entries
+
+
+class RemoteMacCounters:
+    '''This class holds the remote MAC / Route counts per EVPN instance and
+    peer VTEP of the last two polls as columns of a matrix. Each EVPN
+    instance is a row, a run of cells in the order of its peer VTEPs, and
+    the counts of a poll are an array indexed by cell. The previous counts
+    are aligned to the rows of the latest poll, -1 for the pairs not
+    reported then, so the decreases are found by comparing the two arrays
+    in bulk instead of looking up the peer VTEPs of every EVPN instance.
+
+    While the EVPN instances and their peer VTEPs do not change, the rows
+    keep their cells and the previous array is used as it is.'''
+
+    def __init__(self):
+        self.rows = []
+        self.offsets = [0]
+        self.vteps = ()
+        self.counts = array('q')
+        self.previous = array('q')
+        self.source = None
+
+    @staticmethod
+    def column(evi_dict):
+        '''this function returns the EVPN instances of evi_dict, the first
+        cell of each of them, the peer VTEP and the count of each cell'''
+        peers = [instance['remote_mac_count_per_vtep_peer']
+                 for instance in evi_dict.values()]
+        offsets = [0]
+        offsets.extend(accumulate(map(len, peers)))
+        return (list(evi_dict), offsets, tuple(chain.from_iterable(peers)),
+                array('q', list(chain.from_iterable(
+                    vteps.values() for vteps in peers))))
+
+    def align(self, rows, offsets, vteps):
+        '''this function returns the latest counts in the cells of rows'''
+        if rows == self.rows and offsets == self.offsets and \
+                vteps == self.vteps:
+            return self.counts
+        counts = array('q', [-1]) * len(vteps)
+        old_rows = dict(zip(self.rows, range(len(self.rows))))
+        for row, evi in enumerate(rows):
+            if evi not in old_rows:
+                continue
+            start, end = offsets[row], offsets[row + 1]
+            old_start = self.offsets[old_rows[evi]]
+            old_end = self.offsets[old_rows[evi] + 1]
+            if vteps[start:end] == self.vteps[old_start:old_end]:
+                counts[start:end] = self.counts[old_start:old_end]
+                continue
+            old_cells = dict(zip(self.vteps[old_start:old_end],
+                                 range(old_start, old_end)))
+            for cell in range(start, end):
+                if vteps[cell] in old_cells:
+                    counts[cell] = self.counts[old_cells[vteps[cell]]]
+        return counts
+
+    def update(self, evi_dict_old, evi_dict_new):
+        '''this function makes the counts of evi_dict_new the latest ones
+        and those of evi_dict_old the previous ones. evi_dict_old is only
+        read when it is not the evi_dict_new of the last update'''
+        if evi_dict_old is not self.source:
+            self.rows, self.offsets, self.vteps, self.counts = \
+                self.column(evi_dict_old)
+        rows, offsets, vteps, counts = self.column(evi_dict_new)
+        self.previous = self.align(rows, offsets, vteps)
+        self.rows, self.offsets, self.vteps, self.counts = \
+            rows, offsets, vteps, counts
+        self.source = evi_dict_new
+
+    def decreases(self, percent):
+        '''this function returns as (evi, vtep, old count, new count) the
+        pairs reported in both polls whose count decreased by percent or
+        more, the largest decreases first'''
+        previous, counts = self.previous, self.counts
+        if counts == previous:
+            return []
+        drops = []
+        for cell in compress(range(len(counts)), map(lt, counts, previous)):
+            old = previous[cell]
+            percentage = int(((old - counts[cell]) / old) * 100)
+            if percentage >= percent:
+                drops.append((percentage, old - counts[cell], cell))
+        drops.sort(key=lambda drop: drop[:2], reverse=True)
+        return [(self.rows[bisect_right(self.offsets, cell) - 1],
+                 self.vteps[cell], previous[cell], counts[cell])
+                for _, _, cell in drops]
+
+
+class FetchPolicy:
+    '''This class bounds the REST queries of a poll, replacing the former
+    8 attempts 15 seconds apart which could hold a poll for two minutes:
+    - a query is made at most once per poll, and none once fetch_budget
+      seconds of the poll have passed
+    - a query failing for another reason than an HTTP error status is
+      retried in a later poll once its backoff has passed. The backoff
+      starts at FETCH_BACKOFF_BASE and doubles on every failure up to
+      FETCH_BACKOFF_MAX, jittered down to half so failing queries do not
+      all retry in the same poll
+    - after FETCH_BREAKER_FAILURES failures in a row the circuit of the
+      query is open, this and its closing are logged once
+
+    The queries not made or failing in a poll are unavailable, the
+    sub-agents keep the last known state of the objects they cover.
+    Queries may be made from several threads.'''
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.lock = Lock()
+        self.polls = 0
+        self.deadline = None
+        # url to [failures in a row, monotonic time of the next attempt]
+        self.failures = {}
+        self.unavailable = set()
+
+    def begin_poll(self):
+        '''this function starts the time budget of a poll'''
+        with self.lock:
+            self.polls += 1
+            self.deadline = clock_gettime(CLOCK_MONOTONIC) + \
+                int(self.agent.params['fetch_budget'].value)
+            self.unavailable = set()
+
+    def remaining(self):
+        '''this function returns the seconds left of the poll budget'''
+        return max(0, self.deadline - clock_gettime(CLOCK_MONOTONIC))
+
+    def expired(self, url, poll=None):
+        '''this function marks url unavailable in the current poll, unless
+        poll is an earlier one'''
+        with self.lock:
+            if poll is None or poll == self.polls:
+                self.unavailable.add(url)
+
+    def available(self, url):
+        '''this function returns False if url was not queried or failed in
+        this poll'''
+        return url not in self.unavailable
+
+    def fetch(self, url):
+        '''this function queries url if its backoff has passed and the poll
+        budget is not spent. Returns None on error, or if url is
+        unavailable'''
+        now = clock_gettime(CLOCK_MONOTONIC)
+        with self.lock:
+            poll = self.polls
+            failure = self.failures.get(url)
+        if (self.deadline is not None and now >= self.deadline) or \
+                (failure is not None and now < failure[1]):
+            self.expired(url)
+            return None
+        try:
+            response = self.agent.get_rest_request_json(url, retry=1)
+        except NAEException as e:
+            # valid to get not found response. say if tunnel is deleted
+            if 'status code' not in str(e):
+                self.failed(url, e, poll)
+                return None
+            response = None
+        except Exception as e:
+            self.failed(url, e, poll)
+            return None
+        if failure is not None:
+            with self.lock:
+                self.failures.pop(url, None)
+            if failure[0] >= FETCH_BREAKER_FAILURES:
+                self.agent.logger.info(
+                    "REST query succeeded again after {0} failures, url: "
+                    "{1}".format(failure[0], url))
+        return response
+
+    def failed(self, url, error, poll):
+        '''this function backs url off after a failed query of poll'''
+        with self.lock:
+            failures = self.failures.get(url, [0, 0])[0] + 1
+            backoff = min(FETCH_BACKOFF_MAX,
+                          FETCH_BACKOFF_BASE * 2 ** (failures - 1))
+            self.failures[url] = [
+                failures, clock_gettime(CLOCK_MONOTONIC) +
+                uniform(backoff / 2, backoff)]
+        self.expired(url, poll)
+        if failures == FETCH_BREAKER_FAILURES:
+            self.agent.logger.error(
+                "system error while collecting stat error: {0}| url: {1}, "
+                "circuit open, retrying with a backoff of up to {2} "
+                "seconds".format(
+                    error, url, FETCH_BACKOFF_MAX))
+        else:
+            dprint("REST query failure {0}: {1}| url: {2}".format(
+                failures, error, url))
+
+
 class Agent(NAE):
     '''
 
@@ -373,6 +696,9 @@ class Agent(NAE):
     def __init__(self):
 
         # dprint("WIP------- Agent:__init__")
+        self.fetch_policy = FetchPolicy(self)
+        self.topology = TopologySnapshot(self)
+        self.remote_macs = RemoteMacCounters()
         self.evpn_agent = EVPNAgent(self)
         self.vxlan_tunnel_monitor = VxlanTunnelMonitorAgent(self)
         self.vni_health_monitor = VNIHealthMonitorAgent(self)
@@ -405,6 +731,17 @@ class Agent(NAE):
         if poll_interval < 30:
             raise ValueError('Please update the value of poll interval to 30 '
                              'seconds or greater')
+        fetch_budget = int(self.params['fetch_budget'].value)
+        if fetch_budget < 1 or fetch_budget > poll_interval:
+            raise ValueError('REST query time budget should be in the range '
+                             'of 1 to the poll interval')
+        fetch_workers = int(self.params['fetch_workers'].value)
+        if fetch_workers < 1 or fetch_workers > 16:
+            raise ValueError('REST query workers should be in the range of '
+                             '1 to 16')
+        if self.params['tunnel_bulk_query'].value not in ('true', 'false'):
+            raise ValueError(
+                "Tunnel endpoint bulk query should be 'true' or 'false'")
 
         self.syslogs_per_poll = 0
         self.addnl_log_cli_excd = False
@@ -489,14 +826,27 @@ class Agent(NAE):
             {EVPN: NORMAL, TUNNEL: NORMAL, VNI: NORMAL})
 
     def evpn_vxlan_health_poller(self, event):
-        '''this function is called every poll cycle to collect EVPN data'''
+        '''this function is called every poll cycle to collect EVPN data.
+        The VNI, EVPN instance and tunnel endpoint queries are made first,
+        in parallel, then the sub-agents analyze their responses one after
+        another'''
+        wall0 = clock_gettime(CLOCK_MONOTONIC)
+        self.fetch_policy.begin_poll()
+        monitor_evpn = self.params['monitor_evpn'].value == 'true'
+        url_list = self.vni_health_monitor.vni_url_list + \
+            (self.evpn_agent.evpn_url_list if monitor_evpn else []) + \
+            self.vxlan_tunnel_monitor.tunnel_url_list
+        responses = self.collect_urls(url_list)
+        dprint("Time Report, COLLECT : {} seconds".format(
+            clock_gettime(CLOCK_MONOTONIC) - wall0))
         time0 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
-        self.vni_health_monitor.vni_handler()
+        self.vni_health_monitor.vni_handler(responses)
         time1 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
-        if self.params['monitor_evpn'].value == 'true':
-            self.evpn_agent.evpn_handler()
+        if monitor_evpn:
+            self.evpn_agent.evpn_handler(responses)
         time2 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
-        self.vxlan_tunnel_monitor.tunnel_handler()
+        self.vxlan_tunnel_monitor.tunnel_handler(responses)
+        self.topology.persist()
         time3 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
         self.evpn_vxlan_health_set_alert()
         time4 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
@@ -635,26 +985,35 @@ class Agent(NAE):
         ActionShell(script)
 
     def fetch_url(self, url):
-        '''this function is used to fetch data for given REST url. Retries GET
-           request if OVSDB hasn't been populated'''
-        for count in range(8):
-            response = None
-            try:
-                response = self.get_rest_request_json(url, retry=1)
-            except NAEException as e:
-                # valid to get not found response. say if tunnel is deleted
-                if 'status code' in str(e):
-                    break
-                elif count < 7:
-                    sleep(15)
-                else:
-                    self.logger.error("system error while collecting stat"
-                                      "error: {0}| url: {1}"
-                                      .format(e, url))
-            except:
-                self.logger.error("system error {} While collecting stat"
-                                  .format(url))
-        return response
+        '''this function is used to fetch data for given REST url. A failing
+           GET request is retried in a later poll, see FetchPolicy'''
+        return self.fetch_policy.fetch(url)
+
+    def collect_urls(self, url_list):
+        '''this function fetches the urls with up to fetch_workers queries in
+           parallel and returns the url to response dict. The queries still
+           running when the poll budget is spent are abandoned and their
+           urls unavailable'''
+        url_list = list(dict.fromkeys(url_list))
+        workers = min(int(self.params['fetch_workers'].value), len(url_list))
+        if workers <= 1:
+            return {url: self.fetch_url(url) for url in url_list}
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(self.fetch_url, url) for url in url_list]
+        done, _ = wait(futures, timeout=self.fetch_policy.remaining())
+        # Do not wait for the queries still running, they are abandoned
+        executor.shutdown(wait=False)
+
+        responses = {}
+        for url, future in zip(url_list, futures):
+            if future in done:
+                responses[url] = future.result()
+            else:
+                future.cancel()
+                self.fetch_policy.expired(url)
+                responses[url] = None
+        return responses
 
 
 class EVPNAgent(Agent):
@@ -672,6 +1031,8 @@ class EVPNAgent(Agent):
         self.action_other = set()
         self.evpn_url_list = self.get_url_list(
             self.agent.params['vni_id'].value)
+        # Key of the EVPN instances covered by each url, '*' for all
+        self.evpn_key_list = self.agent.params['vni_id'].value.split(",")
 
     def get_url_list(self, evpn_instances):
         '''Takes evpn instances as input and generate
@@ -686,14 +1047,14 @@ class EVPNAgent(Agent):
 
         return evpn_url_list
 
-    def evpn_handler(self):
+    def evpn_handler(self, responses):
         '''Wrapper for collect_evpn_data. Invoked from main agent'''
         dprint("WIP------- evpn_handler")
-        self.collect_evpn_data()
+        self.collect_evpn_data(responses)
 
     # Funtion to collect EVPN Data
-    def collect_evpn_data(self):
-        '''Fetch EVI from REST query and Analyze'''
+    def collect_evpn_data(self, responses):
+        '''Collect EVI from the REST responses of the poll and Analyze'''
         evpn_url_list = self.evpn_url_list
         evpn_response_list = []
 
@@ -701,7 +1062,7 @@ class EVPNAgent(Agent):
             dprint(url)
 
         for url in evpn_url_list:
-            response = self.agent.fetch_url(url)
+            response = responses.get(url)
             if response is None:
                 continue
             else:
@@ -710,7 +1071,9 @@ class EVPNAgent(Agent):
         dprint('EVPN Response list length:', len(evpn_response_list))
         dprint('EVPN response_list = {0}'.format(evpn_response_list))
 
-        self.analyze_evpn_data(evpn_response_list)
+        stale = [key for url, key in zip(evpn_url_list, self.evpn_key_list)
+                 if not self.agent.fetch_policy.available(url)]
+        self.analyze_evpn_data(evpn_response_list, stale)
 
         # bring the alert back to normal
         if self.evpn_alert_on_this_cycle is True:
@@ -725,10 +1088,11 @@ class EVPNAgent(Agent):
 
         return None
 
-    def analyze_evpn_data(self, evpn_res_list):
+    def analyze_evpn_data(self, evpn_res_list, stale=()):
         '''this function stores the required EVPN Data from JSON response in
          local storage and Analyzes the changes by comparing with previous
-         response'''
+         response. The EVPN instances matching stale keep their previous
+         data'''
 
         evpn_res_list = [] if evpn_res_list is None else evpn_res_list
         evi_dict_new = {}
@@ -742,12 +1106,11 @@ class EVPNAgent(Agent):
                 for res in evpn_res_list:
                     evi_dict_new[str(res['evi'])] = res
 
-        evpn_dict_old = json.loads(
-            self.agent.variables["evpn_instance_list"])
-        vni_dict_new = json.loads(
-            self.agent.variables["vni_instance_list"])
-        tunnel_dict_old = json.loads(
-            self.agent.variables["tunnel_instance_list"])
+        # The VNIs are analyzed before, the tunnels after the EVIs
+        evpn_dict_old = self.agent.topology.get('evis')
+        carry_stale_entries(evpn_dict_old, evi_dict_new, stale)
+        vni_dict_new = self.agent.topology.get('vnis')
+        tunnel_dict_old = self.agent.topology.get('tunnels')
         # initialize down_time
         if evpn_dict_old == {}:
             for instance in evi_dict_new.values():
@@ -765,6 +1128,7 @@ class EVPNAgent(Agent):
                         evpn_dict_old[evi]["down_time"]
                 else:
                     evi_dict_new[evi]["down_time"] = 0
+        self.agent.remote_macs.update(evpn_dict_old, evi_dict_new)
 
         # Structure of evi_dict_new
         # {
@@ -814,14 +1178,10 @@ class EVPNAgent(Agent):
         #     }
         # }
 
-        dprint("evpn_instance_list = {0}".format(
-            self.agent.variables["evpn_instance_list"]))
+        dprint("evpn_instance_list = {0}".format(evpn_dict_old))
         dprint("evi_dict_new = {0}".format(evi_dict_new))
-        dprint("vni_instance_list = {0}".format(
-            self.agent.variables["vni_instance_list"]))
         dprint("vni_dict_new={0}".format(vni_dict_new))
-        dprint("tunnel_instance_list = {0}".format(
-            self.agent.variables["tunnel_instance_list"]))
+        dprint("tunnel_instance_list = {0}".format(tunnel_dict_old))
 
         dprint('Old evpn dict:')
         dprint('******************')
@@ -1015,8 +1375,7 @@ class EVPNAgent(Agent):
             if alert_level != AlertLevel.NONE:
                 self.evpn_alert_on_this_cycle = True
                 self.evpn_set_alert_level(alert_level)
-        self.agent.variables["evpn_instance_list"] = json.dumps(
-            evi_dict_new)
+        self.agent.topology.update('evis', evi_dict_new)
         return alert_level
 
     def monitor_tunnel_deletion(self, evi_dict_old, evi_dict_new,
@@ -1055,10 +1414,9 @@ class EVPNAgent(Agent):
                 # VRF. If tunnel endpoint is deleted and we cannot get the
                 # underlay VRF, we will use default VRF for underlay
                 vrf = "default"
-                for key in tunnel_dict_old.keys():
-                    if tunnel in key:
-                        vrf = key.split(',')[0]
-                        break
+                for key in self.agent.topology.tunnel_keys_of_vtep(tunnel):
+                    vrf = key.split(',')[0]
+                    break
                 if tunnel not in deleted_tunnels_and_evis.keys():
                     deleted_tunnels_and_evis[tunnel] = list()
                 deleted_tunnels_and_evis[tunnel].append(int(evi))
@@ -1112,49 +1470,28 @@ class EVPNAgent(Agent):
             int(self.agent.params['percent_mac_route_lost'].value)
         if evi_dict_old == {}:
             return alert_level
-        for evi in evi_dict_new.keys():
-            if evi not in evi_dict_old.keys():
-                continue
-            for vtep in evi_dict_new[evi]['remote_mac_count_per_vtep_peer'] \
-                    .keys():
-                if vtep not in evi_dict_old[evi]['remote_mac_count_per_vtep_peer'].keys():
-                    continue
-                old_mac_route_count = \
-                    evi_dict_old[evi]['remote_mac_count_per_vtep_peer'][vtep]
-                new_mac_route_count = \
-                    evi_dict_new[evi]['remote_mac_count_per_vtep_peer'][vtep]
-                dprint("old={0} new={1}".format(
-                    old_mac_route_count, new_mac_route_count))
-                if new_mac_route_count < old_mac_route_count:
-                    decrease = old_mac_route_count - new_mac_route_count
-                    percentage_decrease = int(
-                        (decrease / old_mac_route_count) * 100)
-                    if percentage_decrease >= percent_mac_route_lost:
-                        # check if routing enable for VNI => L3VNI
-                        if vni_dict_new[evi]["routing"] is True:
-                            syslog = "{0}/{1} Remote Routes were " \
-                                "deleted in EVPN Instance {2} for VTEP Peer " \
-                                "{3}".format(decrease,
-                                             old_mac_route_count, evi, vtep)
-                        else:
-                            syslog = "{0}/{1} Remote MACs " \
-                                "were deleted in EVPN " \
-                                "Instance {2} for VTEP Peer " \
-                                "{3}".format(decrease,
-                                             old_mac_route_count, evi, vtep)
-                            self.action_other.add(
-                                "show mac-address-table | inc evpn"
-                                " | count")
-                            self.action_evpn.add("show evpn mac-ip "
-                                                 "evi {0}".format(evi))
-                        alert_level = AlertLevel.MINOR
-                        self.agent.action_syslog(
-                            Log.WARNING, syslog)
-                        self.agent.set_alert_description_for_key(EVPN, syslog)
-                        self.action_evpn.add("show evpn evi {0} "
-                                             "detail".format(evi))
-                        self.action_evpn.add("show bgp l2vpn evpn vni "
-                                             "{0}".format(evi))
+        for evi, vtep, old_mac_route_count, new_mac_route_count in \
+                self.agent.remote_macs.decreases(percent_mac_route_lost):
+            dprint("old={0} new={1}".format(
+                old_mac_route_count, new_mac_route_count))
+            decrease = old_mac_route_count - new_mac_route_count
+            # check if routing enable for VNI => L3VNI
+            if vni_dict_new[evi]["routing"] is True:
+                syslog = "{0}/{1} Remote Routes were " \
+                    "deleted in EVPN Instance {2} for VTEP Peer " \
+                    "{3}".format(decrease, old_mac_route_count, evi, vtep)
+            else:
+                syslog = "{0}/{1} Remote MACs were deleted in EVPN " \
+                    "Instance {2} for VTEP Peer " \
+                    "{3}".format(decrease, old_mac_route_count, evi, vtep)
+                self.action_other.add(
+                    "show mac-address-table | inc evpn | count")
+                self.action_evpn.add("show evpn mac-ip evi {0}".format(evi))
+            alert_level = AlertLevel.MINOR
+            self.agent.action_syslog(Log.WARNING, syslog)
+            self.agent.set_alert_description_for_key(EVPN, syslog)
+            self.action_evpn.add("show evpn evi {0} detail".format(evi))
+            self.action_evpn.add("show bgp l2vpn evpn vni {0}".format(evi))
         if alert_level != AlertLevel.NONE:
             dprint("Enter alert_level != NONE")
             self.evpn_alert_on_this_cycle = True
@@ -1275,6 +1612,18 @@ class VxlanTunnelMonitorAgent(Agent):
                 self.agent.params['vrf'].value,
                 self.agent.params['origin'].value,
                 self.agent.params['Tunnel_endpoint'].value)
+        # Each url ends with the vrf,origin,destination key of the tunnels
+        # it covers, '*' for all
+        self.tunnel_key_list = [url.rsplit('/', 1)[1]
+                                for url in self.tunnel_url_list]
+        self.tunnel_bulk_url = None
+        if self.agent.params['tunnel_bulk_query'].value == 'true' and \
+                self.tunnel_key_list != ['*,{0},*'.format(
+                    self.agent.params['origin'].value)]:
+            self.vxlan_set_tunnel_bulk_query(
+                self.agent.params['vrf'].value,
+                self.agent.params['origin'].value,
+                self.agent.params['Tunnel_endpoint'].value)
 
     def vxlan_get_tunnel_uri(self, vrf, origin, destination):
         '''Returns a list of REST URI strings after adding user params'''
@@ -1289,18 +1638,51 @@ class VxlanTunnelMonitorAgent(Agent):
 
         return tunnel_url_list
 
-    def tunnel_handler(self):
+    def vxlan_set_tunnel_bulk_query(self, vrf, origin, destination):
+        '''Replaces the tunnel REST URIs with a single query of all the
+         tunnel endpoints, and sets the VRFs and destinations selected from
+         its response, None for all'''
+        self.tunnel_bulk_url = HTTP_ADDRESS + \
+            '/rest/v10.10/system/interfaces/vxlan1/tunnel_endpoints' \
+            '?depth=2&attributes=destination,network_id,origin,state,vrf'
+        self.tunnel_url_list = [self.tunnel_bulk_url]
+        vrfs = [tunnel_vrf.strip() for tunnel_vrf in vrf.split(",")]
+        destinations = [tunnel.strip() for tunnel in destination.split(",")]
+        self.tunnel_key_list = [
+            '{0},{1},{2}'.format(tunnel_vrf, origin, tunnel)
+            for tunnel_vrf in vrfs for tunnel in destinations]
+        self.tunnel_vrfs = None if '*' in vrfs else frozenset(vrfs)
+        self.tunnel_destinations = None if '*' in destinations else \
+            frozenset(destinations)
+        self.tunnel_origin = origin
+
+    def vxlan_select_tunnels(self, tunnels):
+        '''Returns the tunnels of the bulk query response matching the vrf,
+         origin and Tunnel_endpoint parameters'''
+        selected = {}
+        for key, tunnel in tunnels.items():
+            tunnel_vrf = next(iter(tunnel.get('vrf') or {}), None)
+            if (self.tunnel_vrfs is None or
+                    tunnel_vrf in self.tunnel_vrfs) and \
+                    (self.tunnel_destinations is None or
+                     tunnel.get('destination') in self.tunnel_destinations) \
+                    and self.tunnel_origin in ('*', tunnel.get('origin')):
+                selected[key] = tunnel
+        return selected
+
+    def tunnel_handler(self, responses):
         '''Wrapper for vxlan_tunnel_collect_data'''
         # dprint("WIP------- tunnel_handler")
-        self.vxlan_tunnel_collect_data()
+        self.vxlan_tunnel_collect_data(responses)
 
-    def vxlan_tunnel_collect_data(self):
-        '''Collects Tunnel_Endpoint data and analyzes'''
+    def vxlan_tunnel_collect_data(self, responses):
+        '''Collects Tunnel_Endpoint data from the REST responses of the poll
+         and analyzes'''
         tunnel_url_list = self.tunnel_url_list
         tunnel_response_list = []
         for url in tunnel_url_list:
             dprint("tunnel_url={0}".format(url))
-            response = self.agent.fetch_url(url)
+            response = responses.get(url)
             dprint("response={0}".format(response))
             if response is None:
                 continue
@@ -1403,7 +1785,11 @@ class VxlanTunnelMonitorAgent(Agent):
         # ]
         # '''
         tunnel_res_dict = {}
-        if tunnel_response_list != []:
+        if self.tunnel_bulk_url is not None:
+            if tunnel_response_list != []:
+                tunnel_res_dict = self.vxlan_select_tunnels(
+                    tunnel_response_list[0])
+        elif tunnel_response_list != []:
             if (self.agent.params['Tunnel_endpoint'].value == '*' and
                     self.agent.params['vrf'].value == '*'):
                 tunnel_res_dict = tunnel_response_list[0]['vxlan1']
@@ -1416,7 +1802,14 @@ class VxlanTunnelMonitorAgent(Agent):
                     tunnel_res_dict[key] = value
         dprint('tunnel_res_dict = {0}'.format(tunnel_res_dict))
 
-        self.vxlan_tunnel_analyze_data(tunnel_res_dict)
+        if self.tunnel_bulk_url is not None:
+            stale = [] if self.agent.fetch_policy.available(
+                self.tunnel_bulk_url) else self.tunnel_key_list
+        else:
+            stale = [key for url, key in
+                     zip(tunnel_url_list, self.tunnel_key_list)
+                     if not self.agent.fetch_policy.available(url)]
+        self.vxlan_tunnel_analyze_data(tunnel_res_dict, stale)
 
         # bring the alert back to normal
         if self.vxlan_tunnel_alert_on_this_cycle is True:
@@ -1430,10 +1823,11 @@ class VxlanTunnelMonitorAgent(Agent):
                 self.vxlan_tunnel_set_alert_level(AlertLevel.NONE)
         return None
 
-    def vxlan_tunnel_analyze_data(self, tunnel_res_dict):
+    def vxlan_tunnel_analyze_data(self, tunnel_res_dict, stale=()):
         '''this function stores the required Tunnel_Endpoint Data from
          JSON response in local storage and Analyzes the changes by comparing
-         with previous response'''
+         with previous response. The tunnels matching stale keep their
+         previous data'''
         tunnel_list_dict_new = {}
         for key in tunnel_res_dict.keys():
             dprint('key={0}'.format(key))
@@ -1444,9 +1838,9 @@ class VxlanTunnelMonitorAgent(Agent):
                 "down_time": down_time
             }
         dprint("tunnel_list_dict_new={0}".format(tunnel_list_dict_new))
-        tunnel_list_dict_old = json.loads(
-            self.agent.variables["tunnel_instance_list"])
+        tunnel_list_dict_old = self.agent.topology.get('tunnels')
         dprint("tunnel_list_dict_old={0}".format(tunnel_list_dict_old))
+        carry_stale_entries(tunnel_list_dict_old, tunnel_list_dict_new, stale)
 
         # dprint("---------------------------")
         # dprint('vxlan tunnel dict old:')
@@ -1476,8 +1870,7 @@ class VxlanTunnelMonitorAgent(Agent):
         self.agent.actioncli['tunnel'].update(self.action_tunnel)
         self.agent.actioncli['config'].update(self.action_config)
         self.agent.actioncli['other'].update(self.action_other)
-        self.agent.variables['tunnel_instance_list'] = json.dumps(
-            tunnel_list_dict_new)
+        self.agent.topology.update('tunnels', tunnel_list_dict_new)
 
     # '''
     # Structure of tunnel dict:
@@ -1514,7 +1907,7 @@ class VxlanTunnelMonitorAgent(Agent):
                          "nexthops?depth=2".format(
                              HTTP_ADDRESS, vrf, destination, subnet_mask)
                 dprint(nh_url)
-                response = self.fetch_url(nh_url)
+                response = self.agent.fetch_url(nh_url)
                 dprint(response)
                 if response:
                     # get next-hop address
@@ -1636,7 +2029,7 @@ class VxlanTunnelMonitorAgent(Agent):
                         'filter=address%3A' + destination + \
                         '%2Corigin%3A' + origin_to_rr
                     dprint("rr_url={}".format(rr_url))
-                    response = self.fetch_url(rr_url)
+                    response = self.agent.fetch_url(rr_url)
                     dprint(response)
                     if response is None:
                         continue
@@ -1658,7 +2051,7 @@ class VxlanTunnelMonitorAgent(Agent):
                                      HTTP_ADDRESS, vrf, ip_address[0],
                                      ip_address[1])
                         dprint(nh_url)
-                        response = self.fetch_url(nh_url)
+                        response = self.agent.fetch_url(nh_url)
                         dprint("nh_response={0}".format(response))
                         if response is not None:
                             # get next-hop address
@@ -1710,8 +2103,6 @@ class VxlanTunnelMonitorAgent(Agent):
             dprint("Enter alert_level != NONE")
             self.vxlan_tunnel_alert_on_this_cycle = True
             self.vxlan_tunnel_set_alert_level(alert_level)
-        self.agent.variables["tunnel_instance_list"] = json.dumps(
-            tunnel_dict_new)
         return alert_level
 
     def vxlan_tunnel_set_alert_level(self, level):
@@ -1736,6 +2127,8 @@ class VNIHealthMonitorAgent(Agent):
         self.vni_url_list = \
             self.get_vni_url_list(
                 self.agent.params['vni_id'].value)
+        # Key of the VNIs covered by each url, '*' for all
+        self.vni_key_list = self.agent.params['vni_id'].value.split(",")
 
     def get_vni_url_list(self, vni_ids):
         '''This function returns list of VNI URI strings after adding user
@@ -1757,13 +2150,14 @@ class VNIHealthMonitorAgent(Agent):
 
         return vni_url_list
 
-    def vni_handler(self):
+    def vni_handler(self, responses):
         '''Wrapper for vni_collect_data'''
         dprint("WIP------- vni_handler")
-        self.vni_collect_data()
+        self.vni_collect_data(responses)
 
-    def vni_collect_data(self):
-        '''Fetch VNI data using REST query and analyze'''
+    def vni_collect_data(self, responses):
+        '''Collect VNI data from the REST responses of the poll and
+         analyze'''
         vni_url_list = self.vni_url_list
         vni_response_list = []
 
@@ -1771,7 +2165,7 @@ class VNIHealthMonitorAgent(Agent):
             dprint(url)
 
         for url in vni_url_list:
-            response = self.agent.fetch_url(url)
+            response = responses.get(url)
             if response is None:
                 continue
             else:
@@ -1780,7 +2174,9 @@ class VNIHealthMonitorAgent(Agent):
         dprint('VNI Response list length:{0}'.format(len(vni_response_list)))
         dprint('VNI response_list = {0}'.format(vni_response_list))
 
-        self.vni_analyze_data(vni_response_list)
+        stale = [key for url, key in zip(vni_url_list, self.vni_key_list)
+                 if not self.agent.fetch_policy.available(url)]
+        self.vni_analyze_data(vni_response_list, stale)
 
         # bring the alert back to normal
         if self.vni_alert_on_this_cycle is True:
@@ -1795,10 +2191,11 @@ class VNIHealthMonitorAgent(Agent):
 
         return None
 
-    def vni_analyze_data(self, vni_res_list):
+    def vni_analyze_data(self, vni_res_list, stale=()):
         '''this function stores the required VNI data from
          JSON response in local storage and Analyzes the changes by comparing
-         with previous response'''
+         with previous response. The VNIs matching stale keep their previous
+         data'''
         vni_res_list = [] if vni_res_list is None else vni_res_list
         vni_dict_new = {}
         dprint('vni_res_list={0}'.format(vni_res_list))
@@ -1872,8 +2269,8 @@ class VNIHealthMonitorAgent(Agent):
                             vni_dict_new[vni_id_str]["vrf"] = list(
                                 vni_dict[key]["vrf"].keys())[0]
 
-        vni_dict_old = json.loads(
-            self.agent.variables["vni_instance_list"])
+        vni_dict_old = self.agent.topology.get('vnis')
+        carry_stale_entries(vni_dict_old, vni_dict_new, stale)
         dprint('vni dict old: {0}'.format(vni_dict_old))
         dprint('vni dict new: {0}'.format(vni_dict_new))
 
@@ -1899,7 +2296,7 @@ class VNIHealthMonitorAgent(Agent):
         self.agent.actioncli['tunnel'].update(self.action_tunnel)
         self.agent.actioncli['config'].update(self.action_config)
         self.agent.actioncli['other'].update(self.action_other)
-        self.agent.variables['vni_instance_list'] = json.dumps(vni_dict_new)
+        self.agent.topology.update('vnis', vni_dict_new)
 
     def monitor_vni_state(self, vni_dict_old, vni_dict_new):
         '''this function monitor VNI state changes from operational
@@ -1990,8 +2387,6 @@ class VNIHealthMonitorAgent(Agent):
         elif alert_level_minor is True:
             self.vni_alert_on_this_cycle = True
             self.vxlan_vni_set_alert_level(AlertLevel.MINOR)
-        self.agent.variables["vni_instance_list"] = json.dumps(
-            vni_dict_new)
 
     def monitor_vni_config_errors(self, vni_dict_old, vni_dict_new):
         '''this function monitors VNI routing, vlan and vrf and Alerts if
@@ -2126,8 +2521,6 @@ class VNIHealthMonitorAgent(Agent):
         if alert_level != AlertLevel.NONE:
             self.vni_alert_on_this_cycle = True
             self.vxlan_vni_set_alert_level(alert_level)
-        self.agent.variables["vni_instance_list"] = json.dumps(
-            vni_dict_new)
 
     def vxlan_vni_set_alert_level(self, level):
         self.agent.alert_levels_generated_within_poll_per_subagent[
@@ -22,9 +22,17 @@
 #
 # Agents derived from this script will monitor three areas:
 # 1. COPP
-#    - monitor COPP stat: "unresolved_ip_unicast_packets_dropped"
-#    - alert if 1, 5, or 10 minute moving average increases above 10 percent
+#    - monitor COPP stats matching copp_statistics, by default every
+#      "*_packets_dropped" stat such as "unresolved_ip_unicast_packets_dropped"
+#      or the ARP, DHCP and ip exceptions drops, all read from one query
+#    - alert if 1, 5, or 10 minute moving average of a packets dropped stat
+#      matching copp_alert_statistics, by default only
+#      "unresolved_ip_unicast_packets_dropped", increases above 10 percent
 #      of the system capacity
+#      (and the copp_extra_windows moving averages, e.g. 30 and 60 minutes)
+#    - the increments of all stats are kept as rows of a ring buffer with a
+#      running sum per stat and window, a poll costs the same whatever the
+#      window sizes; the averages are stored in copp_stats_averages
 #    - publish output from:
 #       - show copp statistics non-zero
 #       - show ip route summary all-vrfs
@@ -53,6 +61,11 @@
 #   - filters
 #     - based on vrf, area or interface ( interface-list can be given
 #       separated by comma ))
+#   - neighbors of all interfaces are fetched with one query per OSPF version
+#     and filtered on interface by the script (ospf_wildcard_query)
+#   - neighbors of the interfaces are queried in parallel, bounded by
+#     ospf_fetch_deadline; interfaces not answering in time keep their last
+#     known neighbors and are not reported as expired
 #   - alerts
 #       - CRITICAL
 #           - neighbor stuck in states ex_start/exchange/init
@@ -87,6 +100,8 @@
 #     - All neighbors present are in good state
 #   - filters
 #     - based on vrf, neighbor address
+#   - only the neighbor attributes used by the script are fetched
+#     (bgp_projected_query)
 #   - alerts
 #       - CRITICAL
 #           - neighbor state changed from estabished to idle/connect/active/
@@ -110,9 +125,12 @@
 #     - alert if
 #       - CPU stays high for cpu_threshold for cpu_time_interval
 #     - actions
-#       - for the cpu_cooldown_interval do not query ospf/bgp neighbors
-#       - do not case additional cpu spike
-#       - give time for cool down
+#       - the routing daemon cpu is read every poll, above cpu_threshold - 20
+#         the ospf, bgp and prefix checks are run less often, the costliest
+#         ones first, down to once per cpu_cooldown_interval
+#       - do not case additional cpu spike while keeping partial visibility
+#       - a check whose last run took longer than the poll interval is also
+#         run less often
 #
 #
 #
@@ -121,10 +139,18 @@
 # - Monitors critical prefixes entered by user
 # - User enters comma separated list of IPv4 and/or IPv6 prefixes and corresponding VRF in format prefix|vrf_name.
 # - An exact match is done on the prefix and data is fetched and analysed from Route Table
+# - Routes of a VRF holding several prefixes are fetched with a single query
+#   when the VRF has at most prefix_batch_max_routes routes
+# - prefix_list is compiled once into a watch table (parsed networks, VRF,
+#   REST URLs), rebuilt only when the parameter is changed
+# - with prefix_lpm, the route covering each prefix (longest prefix match in
+#   the VRF route table) is tracked with an index updated incrementally
+#   every poll
 # - alert if:
 #     - Route is not present from the start
 #     - Route is deleted
 #     - Route is modified - source, metric and admin distance changes
+#     - Covering route of a prefix changes (prefix_lpm)
 # - publish output from:
 #     - show ip route summary all-vrfs ( v6 equivalent if v6 route )
 #     - show ip rib summary all-vrfs ( v6 equivalent if v6 route )
@@ -185,13 +211,17 @@
 #      threshold value 'rate_of_increase_threshold' or 'rate_of_decrease_threshold'
 #      passed as NAE parameter to the NAE Agent.
 #
-#    - The callback action retrieves the previous value of the resource
+#    - The callback action retrieves the previous values of the resource
 #      from a variable stored in the local storage of the NAE Agent,
-#      compares it with the current value of the resource obtained by
-#      making a REST call to the resource to URI to calculate the
-#      difference in the two values. The rate is calculated by dividing the
-#      difference by the time interval to obtain the rate of change. It
-#      updates the NAE Agent level based on the rate of change.
+#      compares them with the current value of the resource obtained by
+#      making a REST call to the resource URI to calculate the difference in
+#      the two values. The rate is calculated by dividing the difference by
+#      the time interval to obtain the rate of change. It updates the NAE
+#      Agent level based on the rate of change.
+#    - The rates over the route_count_rate_horizons, 5, 15 and 60 minutes by
+#      default, are calculated from the same stored values and kept in the
+#      route_count_rates variable as {minutes: [routes per minute, percent
+#      per minute]}
 #
 #    - Since the NAE monitor for Rate monitoring does not support
 #      monitoring of rate of change of a resource, the rate
@@ -209,6 +239,44 @@
 #    - alerts:
 #        - CRITICAL
 #            Alert lasts for 1 cycle for duration of route_count_time_interval
+#
+# (6.C.) Route Count Breakdown (route_count_breakdown)
+#    - The routes are also counted per vrf/family/protocol bucket, e.g.
+#      red/ipv4/bgp, kept in the route_count_buckets variable
+#    - Nothing is queried while the route count does not change, else the
+#      count of each VRF is queried and only the VRFs whose count changed
+#      are listed, with only the family and protocol of their routes
+#    - alert if:
+#        - The route count of a bucket exceeds its threshold in
+#          route_count_bucket_thresholds
+#        - The rate of increase / decrease percentage of a bucket exceeds
+#          rate_of_increase_threshold / rate_of_decrease_threshold
+#    - alerts:
+#        - CRITICAL
+#            The rate alert lasts for 1 cycle, the threshold alert as long as
+#            the bucket is above its threshold
+#
+#
+#
+#
+# The "publish output from" commands of all areas are requested from one
+# action planner per poll: duplicates are run once, the commands are ordered
+# by alert level and the first 20 of them run, up to 8 per CLI session.
+#
+# The cost of every area of a poll (wall and cpu time, REST calls, response
+# bytes and decode time, bytes of the variables changed) is kept for the
+# last 60 polls, the percentiles are in the poll_stats variable.
+#
+# The Route table is read through one RouteSnapshot shared by the prefix
+# and route count checks: each route query is made once per poll or rate
+# calculation, and a VRF listing is only made again when the route count
+# of the VRF changed, or every poll for the prefix checks which also see
+# routes modified in place.
+#
+# The OSPF, OSPFv3 and BGP routers of the VRF are read by one query, kept
+# for capability_ttl seconds in the capabilities variable. The neighbors of
+# a protocol are only queried while it has a router, a protocol configured
+# later is monitored from the next query on.
 
 LONG_DESCRIPTION = '''\
 ## Script Description
@@ -217,8 +285,9 @@ The overall, terse goal of this script is to monitor routing health, decide if t
 
 Agents derived from this script will monitor three areas:
 1. COPP
-    - monitor COPP stat: "unresolved_ip_unicast_packets_dropped"
-    - alert if 1, 5, or 10 minute moving average increases above 10 percent of the system capacity
+    - monitor COPP stats matching copp_statistics, by default every "*_packets_dropped" stat such as "unresolved_ip_unicast_packets_dropped", read from one query
+    - alert if 1, 5, or 10 minute moving average of a packets dropped stat matching copp_alert_statistics, by default only "unresolved_ip_unicast_packets_dropped", increases above 10 percent of the system capacity, the moving averages of the other stats are kept in the copp_stats_averages variable
+    - additional moving average windows, e.g. 30 and 60 minutes, can be set with copp_extra_windows
     - publish output from:
         - show copp statistics non-zero
         - show ip route summary all-vrfs
@@ -245,6 +314,8 @@ Agents derived from this script will monitor three areas:
     - All neighbors present are in good state
     - filters
     - based on vrf, area or interface ( interface-list can be given separated by comma )
+    - neighbors of all interfaces are fetched with one query per OSPF version and filtered on interface by the script (ospf_wildcard_query)
+    - neighbors of the interfaces are queried in parallel, bounded by ospf_fetch_deadline; interfaces not answering in time keep their last known neighbors and are not reported as expired
     - alerts
         - CRITICAL
             - neighbor stuck in states ex_start/exchange/init
@@ -273,6 +344,7 @@ Agents derived from this script will monitor three areas:
         - All neighbors present are in good state
     - filters
     - based on vrf, neighbor address
+    - only the neighbor attributes used by the script are fetched (bgp_projected_query)
     - alerts
         - CRITICAL
             - neighbor state changed from estabished to idle/connect/active/OpenConfirm
@@ -288,20 +360,28 @@ Agents derived from this script will monitor three areas:
     - alert if
         - CPU stays high for cpu_threshold for cpu_time_interval
     - actions
-        - for the cpu_cooldown_interval do not query ospf/bgp neighbors
-        - do not case additional cpu spike
-        - give time for cool down
+        - the routing daemon cpu is read every poll, above cpu_threshold - 20 the OSPF, BGP and prefix checks are run less often, the costliest ones first, down to once per cpu_cooldown_interval
+        - do not case additional cpu spike while keeping partial visibility
+        - a check whose last run took longer than the poll interval is also run less often
+    - the wall and cpu time, REST calls, response bytes and decode time and the bytes of the variables changed by COPP, OSPF, BGP, PREFIX and the actions over the last 60 polls are shown as 50th/95th percentile and maximum in the poll_stats variable
+    - the OSPF, OSPFv3 and BGP routers of the VRF are read by one query every capability_ttl seconds, the neighbors of a protocol are only queried while it has a router and a protocol configured later is monitored from the next query on
 '''
 
 import json
-from time import (clock_gettime, CLOCK_PROCESS_CPUTIME_ID)
+import re
+from fnmatch import fnmatchcase
+from collections import namedtuple
+from concurrent.futures import (ThreadPoolExecutor, wait)
+from threading import Lock
+from time import (clock_gettime, CLOCK_MONOTONIC, CLOCK_PROCESS_CPUTIME_ID)
 from datetime import datetime
-from ipaddress import (ip_address, IPv4Address, IPv6Address)
+from ipaddress import (ip_address, ip_network, IPv4Address, IPv6Address)
+from types import MappingProxyType
 
 Manifest = {
     'Name': 'routing_health_monitor',
     'Description': 'Agent for monitoring routing health',
-    'Version': '3.1',
+    'Version': '3.2',
     'Author': 'HPE Aruba Networking',
     'AOSCXVersionMin': '10.13.1000',
     'AOSCXPlatformList': ['5420', '6200', '6300', '64xx', '8100', '8320', '8325', '8360', '8400', '9300', '10000']
@@ -324,10 +404,12 @@ ParameterDefinitions = {
         'Default': 60
     },
     'cpu_cooldown_interval': {
-        'Name': 'Time interval in seconds to pause monitoring routing health',
-        'Description': 'Time interval in seconds to defer OSPF/BGP health'
-                       ' monitoring during high cpu utilization by'
-                       ' hpe_routing_daemon. ',
+        'Name': 'Longest poll period in seconds during high cpu utilization',
+        'Description': 'Longest time in seconds the OSPF, BGP and prefix'
+                       ' checks are deferred to while hpe_routing_daemon is'
+                       ' busy. Above cpu_threshold - 20 percent the period'
+                       ' of each check is stretched in proportion to the cpu'
+                       ' utilization and to the time its last run took.',
         'Type': 'integer',
         'Default': 300
     },
@@ -344,12 +426,55 @@ ParameterDefinitions = {
         'Type': 'integer',
         'Default': 60
     },
+    'copp_statistics': {
+        'Name': 'COPP statistics',
+        'Description': 'Comma separated list of the COPP statistics to '
+                       'track, shell-style wildcards allowed. All of them '
+                       'are read from a single query every poll and their '
+                       'moving averages are computed. Eg: unresolved_ip_'
+                       'unicast_packets_dropped,arp_*_packets_dropped. By '
+                       'default all packets dropped statistics are tracked.',
+        'Type': 'String',
+        'Default': '*_packets_dropped'
+    },
+    'copp_alert_statistics': {
+        'Name': 'COPP alert statistics',
+        'Description': 'Comma separated list of the tracked COPP packets '
+                       'dropped statistics (ending in _packets_dropped) '
+                       'raising an alert when their moving average goes '
+                       'above 10 percent of the system capacity, '
+                       'shell-style wildcards allowed. Eg: unresolved_ip_'
+                       'unicast_packets_dropped,arp_*_packets_dropped. '
+                       'Default is unresolved_ip_unicast_packets_dropped.',
+        'Type': 'String',
+        'Default': 'unresolved_ip_unicast_packets_dropped'
+    },
+    'copp_extra_windows': {
+        'Name': 'COPP extra moving average windows',
+        'Description': 'Comma separated list of moving average windows in '
+                       'minutes, above 10 and up to 1440, evaluated in '
+                       'addition to the 1, 5 and 10 minute windows of the '
+                       'COPP drop rate. A drop rate above 10 percent of the '
+                       'system capacity over these windows is critical. '
+                       'Eg: 30,60. By default no extra window is used.',
+        'Type': 'String',
+        'Default': ''
+    },
     'vrf': {
         'Name': 'VRF',
         'Description': 'VRF to monitor. By default all VRFs are monitored.',
         'Type': 'String',
         'Default': "*"
     },
+    'capability_ttl': {
+        'Name': 'Protocol discovery interval',
+        'Description': 'Time in seconds after which the OSPF, OSPFv3 and BGP '
+                       'routers of the VRF are queried again. A protocol '
+                       'configured in the meantime starts to be monitored '
+                       'at the next query. 0 queries them every poll.',
+        'Type': 'integer',
+        'Default': 300
+    },
     'ospf_area': {
         'Name': 'OSPF area',
         'Description': 'OSPF area to monitor. By default all areas are '
@@ -373,6 +498,33 @@ ParameterDefinitions = {
         'Type': 'integer',
         'Default': 300
     },
+    'ospf_wildcard_query': {
+        'Name': 'OSPF wildcard query',
+        'Description': 'Default is ''true''. When ''true'', the neighbors of '
+                       'all OSPF interfaces are fetched with a single query '
+                       'per OSPF version and filtered on OSPF interface by '
+                       'the script. When set to ''false'', one query is '
+                       'issued per OSPF interface.',
+        'Type': 'String',
+        'Default': 'true'
+    },
+    'ospf_fetch_workers': {
+        'Name': 'OSPF fetch workers',
+        'Description': 'Number of OSPF neighbor REST queries issued in '
+                       'parallel every poll. 1 queries the interfaces one '
+                       'after another. Minimum is 1, Maximum is 16',
+        'Type': 'integer',
+        'Default': 4
+    },
+    'ospf_fetch_deadline': {
+        'Name': 'OSPF fetch deadline',
+        'Description': 'Time in seconds allowed for the parallel OSPF '
+                       'neighbor queries of one poll. Interfaces whose query '
+                       'does not complete in time keep their last known '
+                       'neighbors until the next poll.',
+        'Type': 'integer',
+        'Default': 30
+    },
     'bgp_neighbor': {
         'Name': 'BGP Neighbor',
         'Description': 'BGP Neighbor to monitor. By default all neighbors are'
@@ -380,6 +532,15 @@ ParameterDefinitions = {
         'Type': 'String',
         'Default': '*'
     },
+    'bgp_projected_query': {
+        'Name': 'BGP projected query',
+        'Description': 'Default is ''true''. When ''true'', only the BGP '
+                       'neighbor attributes used by the script are fetched. '
+                       'When set to ''false'', the complete BGP router '
+                       'configuration and status is fetched.',
+        'Type': 'String',
+        'Default': 'true'
+    },
     'alert_limit': {
         'Name': 'Alert Limit',
         'Description': 'Maximum of alert conditions processed in one poll cycle.'
@@ -395,6 +556,26 @@ ParameterDefinitions = {
                        'Eg: 1.1.1.0/24|vrf_1,2.2.0.0/16|vrf_2,1::1/128|vrf_3',
         'Type': 'String'
     },
+    'prefix_batch_max_routes': {
+        'Name': 'Prefix batch maximum routes',
+        'Description': 'When several prefixes of the Prefix list belong to '
+                       'a VRF with at most this number of routes, the routes '
+                       'of the VRF are fetched with a single query instead '
+                       'of two queries per prefix. 0 always queries the '
+                       'prefixes one by one.',
+        'Type': 'integer',
+        'Default': 1000
+    },
+    'prefix_lpm': {
+        'Name': 'Prefix longest match',
+        'Description': 'Default is ''false''. When ''true'', the route '
+                       'covering each prefix of the Prefix list (the longest '
+                       'matching route, e.g. a less specific or default '
+                       'route once the prefix is withdrawn) is tracked and a '
+                       'change of covering route is reported.',
+        'Type': 'String',
+        'Default': 'false'
+    },
     'upper_count_threshold': {
         'Name': 'Route Count Upper Threshold Value',
         'Description': 'When the number of routes exceeds '
@@ -442,6 +623,41 @@ ParameterDefinitions = {
                        'to be calculated.',
         'Type': 'integer',
         'Default': 1
+    },
+    'route_count_rate_horizons': {
+        'Name': 'Route count rate horizons',
+        'Description': 'Comma separated list of time intervals in minutes, '
+                       'up to 1440, over which the rate of change of routes '
+                       'count is also calculated and stored in the '
+                       'route_count_rates variable. They are computed from '
+                       'the counts read every route_count_time_interval and '
+                       'rounded to a multiple of it. Eg: 5,15,60.',
+        'Type': 'String',
+        'Default': '5,15,60'
+    },
+    'route_count_breakdown': {
+        'Name': 'Route count breakdown',
+        'Description': 'Default is ''false''. When ''true'', the routes are '
+                       'also counted per VRF, address family and protocol '
+                       '(vrf/family/protocol, e.g. red/ipv4/bgp) every '
+                       'route_count_time_interval. Only the VRFs whose count '
+                       'changed are listed again, and nothing is queried '
+                       'while the route count does not change. A bucket '
+                       'whose rate of change exceeds the rate thresholds '
+                       'raises an alert.',
+        'Type': 'String',
+        'Default': 'false'
+    },
+    'route_count_bucket_thresholds': {
+        'Name': 'Route count bucket thresholds',
+        'Description': 'Comma separated list of bucket=threshold, the '
+                       'bucket being vrf/family/protocol with shell-style '
+                       'wildcards allowed. When route_count_breakdown is '
+                       'true, a bucket whose route count exceeds its '
+                       'threshold raises an alert. '
+                       'Eg: red/ipv4/bgp=5000,*/ipv6/*=2000.',
+        'Type': 'String',
+        'Default': ''
     }
 }
 
@@ -460,8 +676,39 @@ URI_PREFIX_MONITOR = "/rest/v1/"
 IPV6_MASK_MAX_VALUE = 128
 IPV4_MASK_MAX_VALUE = 32
 PREFIX_LIST_MAX_LIMIT = 21
+# Route attributes compared by PrefixAgent
+PREFIX_ROUTE_ATTRIBUTES = "prefix,from,metric,distance,nexthops"
 DURATION_SECONDS = 60
 NUM_CYCLES = 5
+BGP_NBR_ADDED = "added"
+BGP_NBR_DELETED = "deleted"
+BGP_NBR_STATE_CHANGE = "state_change"
+BGP_NBR_FLAP = "flap"
+BGP_NBR_NEW_ERROR = "new_error"
+BGP_NBR_STUCK = "stuck"
+BGP_NBR_EVENTS = (BGP_NBR_ADDED, BGP_NBR_DELETED, BGP_NBR_STATE_CHANGE,
+                  BGP_NBR_FLAP, BGP_NBR_NEW_ERROR, BGP_NBR_STUCK)
+BGP_NBR_DOWN_STATES = ("Idle", "Connect", "Active", "OpenConfirm")
+STATE_SNAPSHOT_INTERVAL = 30
+# Moving average windows of the COPP drop rate, in minutes
+COPP_WINDOWS = (1, 5, 10)
+COPP_WINDOW_MAX = 1440
+# Rows listed per table by the incomplete routes and neighbors action
+OVSDB_INCOMPLETE_ROWS_MAX = 1000
+# Commands run in one CLI session by ActionPlanner
+CLI_SESSION_MAX_COMMANDS = 8
+# Polls kept by PollStats, and how often the REST responses are measured
+POLL_STATS_SAMPLES = 60
+POLL_STATS_PAYLOAD_INTERVAL = 10
+# Routing daemon cpu utilization, below cpu_threshold, from which
+# PollScheduler starts to stretch the poll period of the checks
+SCHEDULE_CPU_MARGIN = 20
+ROUTE_COUNT_HORIZON_MAX = 1440
+# Error of a REST query rejected by the switch (HTTP 4xx), e.g. "status
+# code 400", "Status code: 404" or "HTTP/1.1 400"
+REST_CLIENT_ERROR = re.compile(
+    r'\b(?:status(?:[ _]?code)?|http(?:/[\d.]+)?)\W{0,3}4\d\d\b',
+    re.IGNORECASE)
 
 
 def dprint(*args):
@@ -605,6 +852,989 @@ class AlertManager:
         # else do nothing
 
 
+class ActionPlanner:
+    '''This class plans the CLI commands and shell scripts run as actions by
+    the sub-agents. They are requested with the alert level they are raised
+    for, a command requested several times, even with a different spacing,
+    is planned once at its highest level. When executed, at the end of the
+    poll or of the callback, the commands are ordered by level, then by
+    sub-agent and command. The first global_alert_limit_cli of them are run,
+    CLI_SESSION_MAX_COMMANDS at a time in one ActionCLI (one CLI session),
+    the others are dropped. A level of None requests a command restoring
+    the switch state, e.g. disabling a debug, which is always run first.'''
+
+    SOURCES = (CPU, COPP, ROUTE_COUNT, OSPF, BGP, PREFIX)
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.commands = {}
+        self.scripts = {}
+
+    def order(self, source, level):
+        '''Function to return the sort key of a request'''
+        if level is None:
+            rank = 0
+        else:
+            rank = {AlertLevel.CRITICAL: 1, AlertLevel.MAJOR: 2,
+                    AlertLevel.MINOR: 3}.get(level, 4)
+        return (rank, self.SOURCES.index(source))
+
+    def request_cli(self, source, level, commands):
+        '''Function to request CLI commands'''
+        order = self.order(source, level)
+        for command in commands:
+            command = ' '.join(command.split())
+            if command not in self.commands or order < self.commands[command]:
+                self.commands[command] = order
+
+    def request_shell(self, source, level, script):
+        '''Function to request a shell script'''
+        order = self.order(source, level)
+        if script not in self.scripts or order < self.scripts[script]:
+            self.scripts[script] = order
+
+    def execute(self):
+        '''Function to run the planned actions'''
+        planned = sorted(self.commands,
+                         key=lambda command: (self.commands[command], command))
+        budget = self.agent.global_alert_limit_cli
+        self.agent.actioncli_per_poll += len(planned)
+        if len(planned) > budget:
+            self.agent.addnl_log_cli_excd = True
+            planned = planned[:budget]
+        dprint("cmds_list= {0}".format(planned))
+        for i in range(0, len(planned), CLI_SESSION_MAX_COMMANDS):
+            self.agent.action_cli(
+                '\n'.join(planned[i:i + CLI_SESSION_MAX_COMMANDS]))
+        for script in sorted(self.scripts, key=self.scripts.get):
+            self.agent.action_shell(script)
+        self.commands = {}
+        self.scripts = {}
+
+
+class NeighborStateStore:
+    '''This class persists a neighbor dict of the previous poll in
+    self.variables. Only the fields compared by the detectors are stored,
+    as a list per neighbor. Every poll only the neighbors which differ from
+    the last full snapshot are written, the snapshot itself is rewritten
+    every STATE_SNAPSHOT_INTERVAL polls or once the delta grows past half
+    of it. The stored state is only decoded when the dict of the previous
+    poll is not held in memory, e.g. after the agent restarted.
+
+    Variables used:
+    <name> : full snapshot {key: [field values]}
+    <name>_delta : changes since the snapshot {key: [field values] or null}
+    '''
+
+    def __init__(self, agent, name, fields):
+        self.agent = agent
+        self.name = name
+        self.delta_name = name + '_delta'
+        self.fields = fields
+        self.snapshot = None
+        self.delta_str = None
+        self.current = None
+        self.polls_since_snapshot = 0
+
+    def encode(self, neighbor):
+        '''Function to encode a neighbor as the list of its stored fields'''
+        return [neighbor.get(field) for field in self.fields]
+
+    def decode(self, values):
+        '''Function to decode stored field values into a neighbor dict'''
+        if isinstance(values, dict):
+            # Stored as a plain dict by an earlier version of the script
+            return values
+        return dict(zip(self.fields, values))
+
+    def load(self):
+        '''Function to return the neighbor dict of the previous poll'''
+        if self.current is None:
+            stored = json.loads(self.agent.variables[self.name])
+            self.snapshot = {key: self.encode(self.decode(values))
+                             for key, values in stored.items()}
+            self.delta_str = json.dumps({})
+            if self.delta_name in self.agent.variables.keys():
+                self.delta_str = self.agent.variables[self.delta_name]
+            for key, values in json.loads(self.delta_str).items():
+                if values is None:
+                    stored.pop(key, None)
+                else:
+                    stored[key] = values
+            self.current = {key: self.decode(values)
+                            for key, values in stored.items()}
+        return self.current
+
+    def save(self, neighbor_dict):
+        '''Function to store the neighbor dict of the current poll'''
+        if self.snapshot is None:
+            self.load()
+        self.current = neighbor_dict
+        encoded = {key: self.encode(neighbor)
+                   for key, neighbor in neighbor_dict.items()}
+        delta = {key: values for key, values in encoded.items()
+                 if self.snapshot.get(key) != values}
+        for key in self.snapshot:
+            if key not in encoded:
+                delta[key] = None
+
+        self.polls_since_snapshot += 1
+        if (self.polls_since_snapshot >= STATE_SNAPSHOT_INTERVAL or
+                len(delta) * 2 > len(self.snapshot)):
+            if delta or self.delta_str != json.dumps({}):
+                self.agent.variables[self.name] = json.dumps(
+                    encoded, separators=(',', ':'))
+                self.snapshot = encoded
+                delta = {}
+            self.polls_since_snapshot = 0
+
+        delta_str = json.dumps(delta, separators=(',', ':'))
+        if delta_str != self.delta_str:
+            self.agent.variables[self.delta_name] = delta_str
+            self.delta_str = delta_str
+
+
+class SampleRing:
+    '''This class keeps the latest increments of a set of counters (the
+    columns) in a fixed size ring buffer of rows, one row more than the
+    largest window, along with the running sum of every column for each
+    moving average window. Adding a row updates the sums of all columns in
+    a single pass with the row entering and the one leaving each window, so
+    a poll costs the same whatever the window sizes. Rows not yet written
+    and the rows of a cleared column hold zeros, which keeps the sums exact
+    without checking how many samples each column has.
+
+    The rows are persisted in self.variables, oldest first, as space
+    separated rows of comma separated integers. The snapshot is rewritten
+    every STATE_SNAPSHOT_INTERVAL rows or when the columns change, in
+    between only the rows added since are written. The stored rows are only
+    decoded when the ring is not held in memory, e.g. after the agent
+    restarted.
+
+    Variables used:
+    <name> : rows of the last snapshot "1,0,42 2,0,567"
+    <name>_delta : rows added since the snapshot "3,0,4"
+    <name>_columns : {"columns": [column names],
+                      "counts": [samples of each column in the snapshot]}
+    '''
+
+    def __init__(self, agent, name):
+        self.agent = agent
+        self.name = name
+        self.delta_name = name + '_delta'
+        self.columns_name = name + '_columns'
+        self.windows = ()
+        self.columns = []
+        self.samples = None
+        self.head = 0
+        self.pushed = 0
+        self.first = []
+        self.sums = []
+        self.delta_str = ''
+        self.added_since_snapshot = 0
+
+    def encode(self, rows):
+        '''Function to encode rows of samples'''
+        return ' '.join(','.join(str(sample) for sample in row)
+                        for row in rows)
+
+    def decode(self, value):
+        '''Function to decode stored rows of samples'''
+        return [[int(sample) for sample in row.split(',')]
+                for row in value.split()]
+
+    def load(self):
+        '''Function to return the stored columns, the number of samples of
+        each column and the stored rows, oldest first'''
+        if self.columns_name not in self.agent.variables.keys():
+            return [], [], []
+        header = json.loads(self.agent.variables[self.columns_name])
+        rows = self.decode(self.agent.variables[self.name])
+        self.delta_str = self.agent.variables[self.delta_name]
+        delta = self.decode(self.delta_str)
+        self.added_since_snapshot = len(delta)
+        counts = [count + len(delta) for count in header['counts']]
+        return header['columns'], counts, rows + delta
+
+    def ordered(self):
+        '''Function to return the rows held in the ring, oldest first'''
+        capacity = len(self.samples)
+        held = min(self.pushed, capacity)
+        return [self.samples[(self.head - held + i) % capacity]
+                for i in range(held)]
+
+    def count(self, column):
+        '''Function to return the number of samples held for a column'''
+        return min(self.pushed - self.first[column], len(self.samples))
+
+    def set_windows(self, windows):
+        '''Function to set the size, in samples, of each moving average
+        window. The ring is only rebuilt when the sizes change'''
+        windows = tuple(windows)
+        if self.samples is not None and windows == self.windows:
+            return
+        if self.samples is None:
+            columns, counts, rows = self.load()
+        else:
+            columns = self.columns
+            counts = [self.count(i) for i in range(len(columns))]
+            rows = self.ordered()
+        capacity = max(windows) + 1
+        self.windows = windows
+        self.columns = list(columns)
+        self.samples = [[0] * len(columns) for _ in range(capacity)]
+        self.head = 0
+        self.pushed = 0
+        self.sums = [[0] * len(columns) for _ in windows]
+        for row in rows[-capacity:]:
+            self.push(row)
+        self.first = [self.pushed - min(count, capacity) for count in counts]
+
+    def set_columns(self, columns):
+        '''Function to set the columns of the ring. Columns kept hold their
+        samples, new columns start without any'''
+        index = {column: i for i, column in enumerate(self.columns)}
+
+        def select(values, default):
+            return [values[index[column]] if column in index else default
+                    for column in columns]
+        self.samples = [select(row, 0) for row in self.samples]
+        self.sums = [select(sums, 0) for sums in self.sums]
+        self.first = select(self.first, self.pushed)
+        self.columns = list(columns)
+        self.snapshot()
+
+    def push(self, row):
+        '''Function to add a row to the ring and the window sums'''
+        capacity = len(self.samples)
+        for i, window in enumerate(self.windows):
+            leaving = self.samples[(self.head - window) % capacity]
+            self.sums[i] = [window_sum + sample - old for window_sum, sample,
+                            old in zip(self.sums[i], row, leaving)]
+        self.samples[self.head] = row
+        self.head = (self.head + 1) % capacity
+        self.pushed += 1
+
+    def append(self, row):
+        '''Function to add a row and persist it'''
+        self.push(row)
+        self.added_since_snapshot += 1
+        if self.added_since_snapshot >= min(STATE_SNAPSHOT_INTERVAL,
+                                            len(self.samples)):
+            self.snapshot()
+            return
+        if self.delta_str:
+            self.delta_str += ' ' + self.encode([row])
+        else:
+            self.delta_str = self.encode([row])
+        self.agent.variables[self.delta_name] = self.delta_str
+
+    def snapshot(self):
+        '''Function to persist all rows held in the ring'''
+        self.agent.variables[self.name] = self.encode(self.ordered())
+        self.agent.variables[self.columns_name] = json.dumps({
+            'columns': self.columns,
+            'counts': [self.count(i) for i in range(len(self.columns))]})
+        self.delta_str = ''
+        self.added_since_snapshot = 0
+        self.agent.variables[self.delta_name] = self.delta_str
+
+    def clear_column(self, column):
+        '''Function to drop all samples of a column'''
+        i = self.columns.index(column)
+        for row in self.samples:
+            row[i] = 0
+        for sums in self.sums:
+            sums[i] = 0
+        self.first[i] = self.pushed
+        self.snapshot()
+
+    def averages(self):
+        '''Function to return, for each window, the moving average of every
+        column. The average of a column is 0 until the ring holds more
+        samples of it than the window, as its first sample has no previous
+        value to be diffed with and may be seemingly over-large'''
+        return [[window_sum / window if self.pushed - first > window else 0
+                 for window_sum, first in zip(sums, self.first)]
+                for sums, window in zip(self.sums, self.windows)]
+
+
+class PollStats:
+    '''This class records what each sub-agent of a poll costs: wall and cpu
+    time in milliseconds, the REST calls made, the bytes and the decode time
+    of their responses and the bytes of the self.variables it changed. The
+    samples of the last POLL_STATS_SAMPLES polls of every sub-agent are
+    kept, their 50th/95th percentiles and maximum are written to <name> each
+    poll.
+
+    The REST API hands the responses decoded, their size and decode time
+    are measured by encoding and decoding them again. This is as costly as
+    the query itself, so it is only done every POLL_STATS_PAYLOAD_INTERVAL
+    polls, the bytes and decode time of the other polls are null. The
+    responses are kept until the sub-agent ends and measured after its wall
+    and cpu time are taken, so the measurement is not part of them.
+
+    Variables used:
+    <name> : {sub-agent: {metric: [p50, p95, max]}}
+    <name>_samples : {sub-agent: [samples]}, rewritten every
+                     STATE_SNAPSHOT_INTERVAL polls to survive a restart
+    '''
+
+    METRICS = ('wall_ms', 'cpu_ms', 'rest_calls', 'rest_bytes', 'decode_ms',
+               'variables_bytes')
+
+    def __init__(self, agent, name):
+        self.agent = agent
+        self.name = name
+        self.samples_name = name + '_samples'
+        self.lock = Lock()
+        self.samples = {}
+        self.polls = 0
+        self.running = None
+        self.total = None
+        self.load()
+
+    def load(self):
+        '''Function to restore the samples stored by an earlier run'''
+        if self.samples_name not in self.agent.variables.keys():
+            return
+        stored = json.loads(self.agent.variables[self.samples_name])
+        self.samples = {sub: [row for row in rows
+                              if len(row) == len(self.METRICS)]
+                        for sub, rows in stored.items()}
+
+    def payload_poll(self):
+        '''Function to return whether the responses of this poll are
+        measured'''
+        return self.polls % POLL_STATS_PAYLOAD_INTERVAL == 0
+
+    def variables_refs(self):
+        '''Function to return the current value of every variable, to find
+        the ones a sub-agent changed'''
+        variables = self.agent.variables
+        return {key: variables[key] for key in variables.keys()}
+
+    def start(self, sub):
+        '''Function to start recording the sub-agent sub'''
+        responses = [] if self.payload_poll() else None
+        running = [sub, clock_gettime(CLOCK_MONOTONIC),
+                   clock_gettime(CLOCK_PROCESS_CPUTIME_ID),
+                   self.variables_refs(), 0, responses]
+        with self.lock:
+            self.running = running
+
+    def current(self):
+        '''Function to return the record of the running sub-agent, to be
+        passed to rest() from the threads it starts'''
+        with self.lock:
+            return self.running
+
+    def rest(self, response, running=None):
+        '''Function to count a REST response in running, the record of the
+        sub-agent which made the query, by default the running one. The
+        OSPF neighbors are fetched from several threads, the responses of
+        the queries abandoned by a sub-agent which stopped are ignored'''
+        with self.lock:
+            if running is None:
+                running = self.running
+            if running is None or running is not self.running:
+                return
+            running[4] += 1
+            if running[5] is not None and response is not None:
+                running[5].append(response)
+
+    def measure(self, responses):
+        '''Function to return the bytes and the decode time in milliseconds
+        of responses'''
+        size = 0
+        decode = 0.0
+        for response in responses:
+            text = json.dumps(response, separators=(',', ':'))
+            time0 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
+            json.loads(text)
+            decode += clock_gettime(CLOCK_PROCESS_CPUTIME_ID) - time0
+            size += len(text)
+        return size, round(decode * 1000, 2)
+
+    def stop(self):
+        '''Function to stop recording the running sub-agent and keep its
+        sample'''
+        with self.lock:
+            sub, wall0, cpu0, refs, calls, responses = self.running
+            self.running = None
+        cpu = clock_gettime(CLOCK_PROCESS_CPUTIME_ID) - cpu0
+        wall = clock_gettime(CLOCK_MONOTONIC) - wall0
+        variables = self.agent.variables
+        written = sum(len(variables[key]) for key in variables.keys()
+                      if refs.get(key) != variables[key])
+        size = decode = None
+        if responses is not None:
+            size, decode = self.measure(responses)
+        row = [round(wall * 1000, 1), round(cpu * 1000, 1), calls, size,
+               decode, written]
+        self.add(sub, row)
+        if self.total is None:
+            self.total = row
+        else:
+            self.total = [None if a is None else round(a + b, 2)
+                          for a, b in zip(self.total, row)]
+        dprint("Poll stats, {0}: {1}".format(
+            sub, dict(zip(self.METRICS, row))))
+
+    def add(self, sub, row):
+        '''Function to add a sample of sub, dropping its oldest one'''
+        rows = self.samples.setdefault(sub, [])
+        rows.append(row)
+        if len(rows) > POLL_STATS_SAMPLES:
+            del rows[0]
+
+    def percentiles(self, rows, i):
+        '''Function to return the 50th, 95th percentile and the maximum of
+        metric i of rows, None if no row has it measured'''
+        values = sorted(row[i] for row in rows if row[i] is not None)
+        if not values:
+            return None
+        last = len(values) - 1
+        return [values[last // 2], values[(last * 95 + 99) // 100],
+                values[last]]
+
+    def finish(self):
+        '''Function to end the poll: the total of its sub-agents is kept as
+        the sample of "TOTAL" and the percentiles are written'''
+        if self.total is not None:
+            self.add('TOTAL', self.total)
+            self.total = None
+        self.polls += 1
+        summary = {sub: {metric: self.percentiles(rows, i)
+                         for i, metric in enumerate(self.METRICS)}
+                   for sub, rows in self.samples.items()}
+        self.agent.variables[self.name] = json.dumps(
+            summary, separators=(',', ':'))
+        if self.polls % STATE_SNAPSHOT_INTERVAL == 0:
+            self.agent.variables[self.samples_name] = json.dumps(
+                self.samples, separators=(',', ':'))
+
+
+class PollScheduler:
+    '''This class decides which of the OSPF, BGP and prefix checks run in a
+    poll. Each of them runs every <period> polls, recomputed every poll from
+    the cpu utilization of hpe_routing_daemon and the wall time of its last
+    run recorded by the agent's PollStats:
+    - below cpu_threshold - SCHEDULE_CPU_MARGIN percent every check runs
+      every poll
+    - above it the period of a check is stretched in proportion to the cpu
+      utilization and to its cost relative to the costliest check, up to
+      cpu_cooldown_interval. The cheap checks keep running while the
+      costly ones back off
+    - a check whose last run took longer than the poll interval runs at
+      most once per that many polls whatever the cpu utilization
+    - a check activated, by CapabilityProbe when its protocol is newly
+      configured, runs in the next plan whatever its period
+
+    Variables used:
+    <name> : {"cpu": last cpu utilization, check: [period in polls,
+              polls since its last run]}
+    '''
+
+    CHECKS = (OSPF, BGP, PREFIX)
+
+    def __init__(self, agent, name):
+        self.agent = agent
+        self.name = name
+        self.cpu_url = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + \
+            'system/subsystems/*/*/daemons/' + \
+            agent.params['hpe_routing_daemon'].value + \
+            '?attributes=name,resource_utilization'
+        self.high_cpu = False
+        self.cpu = None
+        self.schedule = {check: [1, 0] for check in self.CHECKS}
+        self.activated = set()
+        if name in agent.variables.keys():
+            stored = json.loads(agent.variables[name])
+            self.cpu = stored.pop('cpu', None)
+            self.schedule.update((check, value) for check, value in
+                                 stored.items() if check in self.schedule)
+
+    def read_cpu(self):
+        '''Function to return the cpu utilization of hpe_routing_daemon, None
+        if it could not be read'''
+        daemons = [self.agent.fetch_url(self.cpu_url)]
+        while daemons:
+            daemon = daemons.pop()
+            if isinstance(daemon, list):
+                daemons.extend(daemon)
+            elif isinstance(daemon, dict):
+                utilization = daemon.get('resource_utilization')
+                if isinstance(utilization, dict) and 'cpu' in utilization:
+                    return float(utilization['cpu'])
+                daemons.extend(daemon.values())
+        return None
+
+    def period(self, check, pressure, costs):
+        '''Function to return the number of polls between two runs of check'''
+        poll_interval = self.agent.params['poll_interval'].value
+        max_periods = max(1, self.agent.params['cpu_cooldown_interval'].value //
+                          poll_interval)
+        stretch = 1.0
+        if pressure > 0:
+            costliest = max(costs.values())
+            weight = costs[check] / costliest if costliest else 1.0
+            stretch += pressure * (max_periods - 1) * weight
+        stretch = max(stretch, costs[check] / (poll_interval * 1000))
+        return min(max_periods, max(1, int(round(stretch))))
+
+    def plan(self):
+        '''Function to return the checks to run in this poll'''
+        cpu = self.read_cpu()
+        if cpu is None:
+            # Fall back on the high cpu rule of RoutingAgent
+            cpu = self.agent.params['cpu_threshold'].value \
+                if self.high_cpu else 0.0
+        self.cpu = cpu
+        low = self.agent.params['cpu_threshold'].value - SCHEDULE_CPU_MARGIN
+        pressure = min(1.0, max(0.0, (cpu - low) / max(1, 100 - low)))
+        samples = self.agent.poll_stats.samples
+        costs = {check: samples[check][-1][0] if samples.get(check) else 0
+                 for check in self.CHECKS}
+        checks = []
+        for check in self.CHECKS:
+            period = self.period(check, pressure, costs)
+            polls = self.schedule[check][1] + 1
+            if polls >= period or check in self.activated:
+                checks.append(check)
+                polls = 0
+            self.schedule[check] = [period, polls]
+        self.activated.clear()
+        stored = dict(self.schedule, cpu=cpu)
+        self.agent.variables[self.name] = json.dumps(
+            stored, separators=(',', ':'))
+        if len(checks) < len(self.CHECKS):
+            dprint("Routing daemon cpu {0}%, deferred {1}".format(
+                cpu, {check: self.schedule[check][0] for check in self.CHECKS
+                      if check not in checks}))
+        return checks
+
+    def activate(self, check):
+        '''Function to run check in the next plan whatever its period'''
+        self.activated.add(check)
+
+
+class CapabilityProbe:
+    '''This class tells which routing protocols are configured on the
+    monitored VRF. One query fetches the ospf_routers, ospfv3_routers and
+    bgp_routers columns of the VRF, the answer is kept in <name> and only
+    queried again once capability_ttl seconds have passed. A protocol is:
+    - configured : the column has at least one router, its sub-agent
+      queries the neighbors
+    - supported : the column is there but empty, nothing is queried
+    - unsupported : the platform has no such column
+
+    When a protocol becomes configured its check is activated and runs in
+    the same poll whatever its PollScheduler period. When the probe fails
+    the previous answer is kept and the probe is made again next poll. The
+    whole VRF is only fetched instead once the switch rejected the query of
+    the columns (HTTP 4xx), not on a transient error.
+
+    Variables used:
+    <name> : {"checked": time of the last answer, protocol: state}
+    '''
+
+    # Protocol to the VRF column of its routers and the check using it
+    PROTOCOLS = (('ospfv2', 'ospf_routers', OSPF),
+                 ('ospfv3', 'ospfv3_routers', OSPF),
+                 ('bgp', 'bgp_routers', BGP))
+    CONFIGURED = 'configured'
+    SUPPORTED = 'supported'
+    UNSUPPORTED = 'unsupported'
+
+    def __init__(self, agent, name):
+        self.agent = agent
+        self.name = name
+        self.url = HTTP_ADDRESS + URI_PREFIX_GET + 'system/vrfs/' + \
+            agent.params['vrf'].value
+        # Older platforms reject unknown attributes, the whole VRF is
+        # then fetched instead
+        self.projected = True
+        self.checked = None
+        self.states = {}
+        if name in agent.variables.keys():
+            stored = json.loads(agent.variables[name])
+            self.checked = stored.pop('checked', None)
+            self.states = stored
+
+    def query(self):
+        '''Function to return the routers columns of the VRF, or of each
+        VRF for a wildcard, None on error'''
+        if self.projected:
+            url = self.url + '?attributes=' + ','.join(
+                column for _, column, _ in self.PROTOCOLS)
+            try:
+                return self.agent.get_rest_request_json(
+                    url, retry=2, wait_between_retries=1)
+            except NAEException as e:
+                if not REST_CLIENT_ERROR.search(str(e)):
+                    self.agent.logger.error(
+                        "system error while collecting stat"
+                        "error: {0}| url: {1}".format(e, url))
+                    return None
+                self.agent.logger.info(
+                    "Routers columns query rejected, fetching the whole "
+                    "VRF instead: {0}".format(e))
+            self.projected = False
+        return self.agent.fetch_url(self.url)
+
+    def probe(self):
+        '''Function to query the protocols again when the answer is older
+        than capability_ttl'''
+        now = datetime.now().timestamp()
+        if self.checked is not None and \
+                now - self.checked < self.agent.params['capability_ttl'].value:
+            return
+        response = self.query()
+        if not isinstance(response, dict):
+            return
+        # A wildcard VRF answers one dict per VRF
+        vrfs = [response] + [value for value in response.values()
+                             if isinstance(value, dict)]
+        states = {}
+        for protocol, column, check in self.PROTOCOLS:
+            found = [vrf[column] for vrf in vrfs if column in vrf]
+            if any(found):
+                states[protocol] = self.CONFIGURED
+            elif found:
+                states[protocol] = self.SUPPORTED
+            else:
+                states[protocol] = self.UNSUPPORTED
+            if states[protocol] == self.CONFIGURED and \
+                    self.states.get(protocol) != self.CONFIGURED:
+                if self.states:
+                    self.agent.logger.info(
+                        "{0} is configured, starting to monitor it".format(
+                            protocol))
+                self.agent.scheduler.activate(check)
+            elif states[protocol] == self.UNSUPPORTED and \
+                    self.states.get(protocol) != self.UNSUPPORTED:
+                self.agent.logger.debug(
+                    "{0} is not supported on this platform, script will not "
+                    "attempt to fetch its data".format(protocol))
+        self.states = states
+        self.checked = now
+        self.agent.variables[self.name] = json.dumps(
+            dict(states, checked=int(now)), separators=(',', ':'))
+
+    def configured(self, protocol):
+        '''Function to return whether protocol has a router on the VRF'''
+        return self.states.get(protocol) == self.CONFIGURED
+
+
+def parse_copp_extra_windows(value):
+    '''Function to parse the copp_extra_windows parameter into a sorted
+    tuple of minutes. Raises ValueError when invalid'''
+    windows = set()
+    for window in value.strip(' ').strip(',').split(','):
+        if not window.strip():
+            continue
+        try:
+            minutes = int(window)
+        except ValueError:
+            raise ValueError(
+                'COPP extra windows should be a comma separated list of '
+                'minutes')
+        if minutes <= COPP_WINDOWS[-1] or minutes > COPP_WINDOW_MAX:
+            raise ValueError(
+                'COPP extra windows should be in the range of {} to {} '
+                'minutes'.format(COPP_WINDOWS[-1] + 1, COPP_WINDOW_MAX))
+        windows.add(minutes)
+    return tuple(sorted(windows))
+
+
+def parse_route_count_rate_horizons(value):
+    '''Function to parse the route_count_rate_horizons parameter into a
+    sorted tuple of minutes. Raises ValueError when invalid'''
+    horizons = set()
+    for horizon in value.strip(' ').strip(',').split(','):
+        if not horizon.strip():
+            continue
+        try:
+            minutes = int(horizon)
+        except ValueError:
+            raise ValueError(
+                'Route count rate horizons should be a comma separated list '
+                'of minutes')
+        if minutes < 1 or minutes > ROUTE_COUNT_HORIZON_MAX:
+            raise ValueError(
+                'Route count rate horizons should be in the range of 1 to {} '
+                'minutes'.format(ROUTE_COUNT_HORIZON_MAX))
+        horizons.add(minutes)
+    return tuple(sorted(horizons))
+
+
+def parse_copp_statistics(value, name='COPP statistics'):
+    '''Function to parse the copp_statistics or copp_alert_statistics
+    parameter into a tuple of patterns. Raises ValueError when empty'''
+    patterns = tuple(dict.fromkeys(
+        pattern.strip() for pattern in value.split(',') if pattern.strip()))
+    if not patterns:
+        raise ValueError('{0} should list at least one statistic'.format(
+            name))
+    return patterns
+
+
+def parse_route_count_bucket_thresholds(value):
+    '''Function to parse the route_count_bucket_thresholds parameter into a
+    tuple of (bucket pattern, threshold). Raises ValueError when invalid'''
+    thresholds = []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        pattern, _, threshold = item.partition('=')
+        if pattern.strip().count('/') != 2:
+            raise ValueError(
+                'Route count bucket thresholds should be a comma separated '
+                'list of vrf/family/protocol=threshold')
+        try:
+            threshold = int(threshold)
+        except ValueError:
+            raise ValueError(
+                'Route count bucket threshold of {} should be an '
+                'integer'.format(pattern.strip()))
+        thresholds.append((pattern.strip(), threshold))
+    return tuple(thresholds)
+
+
+# Entry of the prefix watch table
+# key : prefix|vrf as entered in prefix_list
+# network : ipaddress network of the prefix, family : 4 or 6
+# count_url, route_url : per prefix REST queries
+PrefixWatch = namedtuple('PrefixWatch', (
+    'key', 'prefix', 'vrf', 'network', 'family', 'count_url', 'route_url'))
+# entries : PrefixWatch in prefix_list order
+# by_key : read-only prefix|vrf to PrefixWatch mapping
+# by_vrf : (vrf, routes url of the vrf, PrefixWatch of the vrf) per vrf
+PrefixWatchTable = namedtuple('PrefixWatchTable', (
+    'entries', 'by_key', 'by_vrf'))
+
+
+def compile_prefix_watch_table(user_prefix_list):
+    '''this function compiles the validated prefix|vrf list into the
+    immutable table PrefixAgent works from'''
+    entries = []
+    vrf_entries = {}
+    for ele in user_prefix_list:
+        prefix, vrf = ele.split('|')
+        network = ip_network(prefix, strict=False)
+        prefix_url_fmt = prefix.replace('/', '%2F').replace(':', '%3A')
+        url = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + 'system/vrfs/' + vrf + \
+            '/routes/' + prefix_url_fmt
+        entry = PrefixWatch(ele, prefix, vrf, network, network.version,
+                            url + '?count=true', url + '?depth=2')
+        entries.append(entry)
+        vrf_entries.setdefault(vrf, []).append(entry)
+    return PrefixWatchTable(
+        tuple(entries),
+        MappingProxyType({entry.key: entry for entry in entries}),
+        tuple((vrf, HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + 'system/vrfs/' +
+               vrf + '/routes', tuple(vrf_entry_list))
+              for vrf, vrf_entry_list in vrf_entries.items()))
+
+
+class RouteIndex:
+    '''This class indexes the route prefixes of a VRF for longest prefix
+    match lookups. The routes are kept in one dict per address family and
+    prefix length, keyed by the network bits, so a lookup probes at most
+    one dict per prefix length. update() only indexes the routes added or
+    removed since its previous call.'''
+
+    def __init__(self):
+        self.prefixes = set()
+        self.index = {4: {}, 6: {}}
+
+    def update(self, prefixes):
+        '''Function to apply the current route prefixes of the VRF'''
+        prefixes = set(prefixes)
+        for prefix in self.prefixes - prefixes:
+            self.remove(prefix)
+        for prefix in prefixes - self.prefixes:
+            self.add(prefix)
+        self.prefixes = prefixes
+
+    def add(self, prefix):
+        '''Function to index a route prefix'''
+        try:
+            network = ip_network(prefix, strict=False)
+        except ValueError:
+            return
+        bits = int(network.network_address) >> \
+            (network.max_prefixlen - network.prefixlen)
+        self.index[network.version].setdefault(
+            network.prefixlen, {})[bits] = prefix
+
+    def remove(self, prefix):
+        '''Function to remove a route prefix from the index'''
+        try:
+            network = ip_network(prefix, strict=False)
+        except ValueError:
+            return
+        bits = int(network.network_address) >> \
+            (network.max_prefixlen - network.prefixlen)
+        routes = self.index[network.version].get(network.prefixlen, {})
+        routes.pop(bits, None)
+
+    def lookup(self, network):
+        '''Function to return the longest route prefix covering network,
+        None if no route covers it'''
+        lengths = self.index[network.version]
+        address = int(network.network_address)
+        for prefixlen in range(network.prefixlen, -1, -1):
+            routes = lengths.get(prefixlen)
+            if routes:
+                prefix = routes.get(
+                    address >> (network.max_prefixlen - prefixlen))
+                if prefix is not None:
+                    return prefix
+        return None
+
+
+# Route listing of a VRF kept by RouteSnapshot
+# cycle : cycle of the listing, routes : prefix to route dict, dropped at
+#         the end of the cycle
+# count : number of routes listed, view : attributes listed
+# fingerprint : hashes of the listing in the KEYS and SUMMARY views, up to
+#               its own view
+# version : changes whenever the listing differs from the previous one in
+#           the attributes of the SUMMARY view
+RouteTable = namedtuple('RouteTable', (
+    'cycle', 'routes', 'count', 'view', 'fingerprint', 'version'))
+
+
+class RouteSnapshot:
+    '''This class is the view of the Route table shared by the sub-agents.
+    Within a cycle, a poll or a route count rate calculation, every query
+    is made once: the route count, the VRFs, their route count and the
+    route listing of a VRF. A listing is made with the attributes of one of
+    the views below, a listing of a larger view answers the smaller ones.
+
+    A VRF is listed again in a later cycle only if its route count changed
+    since, or if the caller asks for a fresh listing to see routes modified
+    in place. A caller keeping data derived from a listing passes the
+    version it was derived from and gets None back while it is current.
+    The version only changes with the attributes of the SUMMARY view, and a
+    listing of a smaller view matching the kept one does not replace it.
+    The listings are dropped at the end of the cycle, only their count and
+    version are kept.'''
+
+    KEYS = 0
+    SUMMARY = 1
+    FULL = 2
+    VIEW_QUERIES = (
+        '',
+        '?depth=2&attributes=prefix,address_family,from,selected',
+        '?depth=3&attributes=' + PREFIX_ROUTE_ATTRIBUTES +
+        ',address_family,selected')
+    SUMMARY_ATTRIBUTES = ('address_family', 'from', 'selected')
+
+    # REST Encodings:
+    # %2A is *
+    # %3A is :
+    TOTAL_COUNT_URI = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + \
+        'system/vrfs/%2A/routes?filter=selected%3Atrue&count=true'
+    VRFS_URI = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + 'system/vrfs'
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.cycle = 0
+        self.version = 0
+        self.cached = {}
+        self.tables = {}
+
+    def begin_cycle(self):
+        '''Function to start a cycle, the queries of the previous one are
+        made again'''
+        self.cycle += 1
+        self.cached = {}
+
+    def end_cycle(self):
+        '''Function to drop the route listings of the cycle'''
+        for vrf, table in self.tables.items():
+            if table.routes is not None:
+                self.tables[vrf] = table._replace(routes=None)
+
+    def url(self, vrf):
+        '''Function to return the routes url of vrf'''
+        return HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + 'system/vrfs/' + vrf + \
+            '/routes'
+
+    def fetch(self, url):
+        '''Function to query url once per cycle'''
+        if url not in self.cached:
+            self.cached[url] = self.agent.fetch_url(url)
+        return self.cached[url]
+
+    def total_count(self):
+        '''Function to return the number of selected routes of all VRFs,
+        None on error'''
+        response = self.fetch(self.TOTAL_COUNT_URI)
+        return None if not response else int(response['count'])
+
+    def vrfs(self):
+        '''Function to return the names of the VRFs, None on error'''
+        response = self.fetch(self.VRFS_URI)
+        return None if response is None else sorted(response)
+
+    def vrf_count(self, vrf):
+        '''Function to return the number of routes of vrf, None on error'''
+        response = self.fetch(self.url(vrf) + '?count=true')
+        return None if not response else int(response['count'])
+
+    def fingerprint(self, routes, view):
+        '''Function to return the hashes of routes in the views up to view,
+        a FULL listing is hashed in the SUMMARY view'''
+        hashes = (hash(frozenset(routes)),)
+        if view >= self.SUMMARY:
+            hashes += (hash(json.dumps(
+                {prefix: [route.get(key) for key in self.SUMMARY_ATTRIBUTES]
+                 for prefix, route in routes.items()}, sort_keys=True)),)
+        return hashes
+
+    def vrf_routes(self, vrf, view, fresh=False, known_version=None):
+        '''Function to return the version and the prefix to route dict of
+        the listing of vrf with at least the attributes of view, a route is
+        {} in the KEYS view. The routes are None if they could not be
+        fetched, or if known_version is still current'''
+        table = self.tables.get(vrf)
+        if table is not None and table.view >= view:
+            if table.cycle == self.cycle and table.routes is not None:
+                return table.version, table.routes
+            if not fresh and table.version == known_version and \
+                    self.vrf_count(vrf) == table.count:
+                return table.version, None
+        response = self.agent.fetch_url(self.url(vrf) +
+                                        self.VIEW_QUERIES[view])
+        if response is None:
+            return None if table is None else table.version, None
+        routes = {key.replace('%2F', '/').replace('%3A', ':'):
+                  {} if view == self.KEYS else route
+                  for key, route in response.items()}
+        fingerprint = self.fingerprint(routes, view)
+        version = None if table is None else table.version
+        if table is None:
+            self.version += 1
+            version = self.version
+        else:
+            # Compared in the smaller of both views
+            common = min(table.view, view, self.SUMMARY)
+            if table.fingerprint[common] != fingerprint[common]:
+                self.version += 1
+                version = self.version
+            elif table.view > view:
+                # The listing of the larger view is still current
+                self.tables[vrf] = table._replace(count=len(routes))
+                return version, routes
+        self.tables[vrf] = RouteTable(self.cycle, routes, len(routes), view,
+                                      fingerprint, version)
+        return version, routes
+
+
 class Agent(NAE):
     """
 
@@ -623,20 +1853,15 @@ class Agent(NAE):
         # dprint("WIP------- Agent:__init__")
         dprint("self.params['prefix_list'].value: {0}".format(
             self.params['prefix_list'].value))
-        self.user_prefix_list = None
+        self.prefix_watch_table = compile_prefix_watch_table([])
         if self.params['prefix_list'].value:
-            user_prefix_list = self.params['prefix_list'].value.strip(' ').strip(',') \
-                .split(',')
-            user_prefix_list = [user_prefix.strip()
-                                for user_prefix in user_prefix_list]
-            # remove duplicate entries from prefix_list
-            self.user_prefix_list = list(dict.fromkeys(user_prefix_list))
-            dprint("user_prefix_list remove dup:{0}:{1};".format(
-                len(self.user_prefix_list), self.user_prefix_list))
-            error_msg = self.validate_user_param_prefix_list(
-                self.user_prefix_list)
+            user_prefix_list = self.parse_user_param_prefix_list(
+                self.params['prefix_list'].value)
+            error_msg = self.validate_user_param_prefix_list(user_prefix_list)
             if error_msg:
                 raise ValueError(error_msg)
+            self.prefix_watch_table = compile_prefix_watch_table(
+                user_prefix_list)
 
         alert_limit = self.params['alert_limit'].value
         if alert_limit >= 1 and alert_limit <= 6:
@@ -646,17 +1871,48 @@ class Agent(NAE):
             raise ValueError('Alert limit should be in the range of 1 to 6')
         self.global_alert_limit_cli = 20
 
+        ospf_fetch_workers = self.params['ospf_fetch_workers'].value
+        if ospf_fetch_workers < 1 or ospf_fetch_workers > 16:
+            raise ValueError(
+                'OSPF fetch workers should be in the range of 1 to 16')
+        if self.params['ospf_fetch_deadline'].value < 1:
+            raise ValueError('OSPF fetch deadline should be at least 1 second')
+        if self.params['capability_ttl'].value < 0:
+            raise ValueError(
+                'Protocol discovery interval should be at least 0 seconds')
+        if self.params['ospf_wildcard_query'].value not in ('true', 'false'):
+            raise ValueError("OSPF wildcard query should be 'true' or 'false'")
+        if self.params['bgp_projected_query'].value not in ('true', 'false'):
+            raise ValueError("BGP projected query should be 'true' or 'false'")
+        if self.params['prefix_lpm'].value not in ('true', 'false'):
+            raise ValueError("Prefix longest match should be 'true' or 'false'")
+        if self.params['route_count_breakdown'].value not in ('true', 'false'):
+            raise ValueError(
+                "Route count breakdown should be 'true' or 'false'")
+        self.route_count_bucket_thresholds = \
+            parse_route_count_bucket_thresholds(
+                self.params['route_count_bucket_thresholds'].value or '')
+        self.copp_statistics = parse_copp_statistics(
+            self.params['copp_statistics'].value or '')
+        self.copp_alert_statistics = parse_copp_statistics(
+            self.params['copp_alert_statistics'].value or '',
+            'COPP alert statistics')
+        self.copp_windows = COPP_WINDOWS + parse_copp_extra_windows(
+            self.params['copp_extra_windows'].value or '')
+        self.route_count_horizons = parse_route_count_rate_horizons(
+            self.params['route_count_rate_horizons'].value or '')
+
         # Persistant variables across every run of this script
         # are stored in self.variables. They must be of type
         # string.
-        if 'copp_ucast_dropped_q' not in self.variables.keys():
-            self.variables['copp_ucast_dropped_q'] = ""
-        if 'copp_ucast_total_dropped' not in self.variables.keys():
-            self.variables['copp_ucast_total_dropped'] = "0"
+        if 'copp_stats_totals' not in self.variables.keys():
+            self.variables['copp_stats_totals'] = json.dumps({})
         if 'copp_alert' not in self.variables.keys():
             self.variables['copp_alert'] = json.dumps(AlertLevel.NONE)
-        if 'copp_mva_violation' not in self.variables.keys():
-            self.variables['copp_mva_violation'] = "None"
+        if 'copp_mva_violations' not in self.variables.keys():
+            self.variables['copp_mva_violations'] = json.dumps({})
+        if 'copp_stats_averages' not in self.variables.keys():
+            self.variables['copp_stats_averages'] = json.dumps({})
         if 'ospf_alert' not in self.variables.keys():
             self.variables['ospf_alert'] = json.dumps(AlertLevel.NONE)
         if 'bgp_alert' not in self.variables.keys():
@@ -671,6 +1927,8 @@ class Agent(NAE):
             self.variables['ospfv2_debug_packet_cycles_left'] = str(0)
         if 'ospfv3_debug_packet_cycles_left' not in self.variables.keys():
             self.variables['ospfv3_debug_packet_cycles_left'] = str(0)
+        if 'ospf_timed_out_interfaces' not in self.variables.keys():
+            self.variables['ospf_timed_out_interfaces'] = json.dumps([])
         if 'neighbor_count' not in self.variables.keys():
             self.variables['neighbor_count'] = ""
         if 'bgp_nbr_list' not in self.variables.keys():
@@ -683,18 +1941,28 @@ class Agent(NAE):
             self.variables['prefix_alert'] = json.dumps(AlertLevel.NONE)
         if 'prefix_instance_list' not in self.variables.keys():
             self.variables['prefix_instance_list'] = json.dumps({})
-        if 'monitoring_resume_time' not in self.variables.keys():
-            self.variables['monitoring_resume_time'] = str(0)
+        if 'prefix_covering_routes' not in self.variables.keys():
+            self.variables['prefix_covering_routes'] = json.dumps({})
         if 'route_count_alert' not in self.variables.keys():
             self.variables['route_count_alert'] = json.dumps(AlertLevel.NONE)
         if 'route_count_already_alerted' not in self.variables.keys():
             self.variables['route_count_already_alerted'] = ""
+        if 'route_count_buckets' not in self.variables.keys():
+            self.variables['route_count_buckets'] = json.dumps({})
+        if 'route_count_bucket_rates' not in self.variables.keys():
+            self.variables['route_count_bucket_rates'] = json.dumps({})
+        if 'route_count_buckets_over' not in self.variables.keys():
+            self.variables['route_count_buckets_over'] = json.dumps([])
 
         self.syslogs_per_poll = 0
         self.actioncli_per_poll = 0
         self.addnl_log_cli_excd = False
         self.addnl_log_syslog_excd = False
 
+        self.poll_stats = PollStats(self, 'poll_stats')
+        self.routes = RouteSnapshot(self)
+        self.scheduler = PollScheduler(self, 'poll_schedule')
+        self.capabilities = CapabilityProbe(self, 'capabilities')
         self.alm = AlertManager(self)
         self.coppAgent = CoppAgent(self, self.alm)
         self.ospf_agent = OSPFAgent(self, self.alm)
@@ -702,7 +1970,7 @@ class Agent(NAE):
         self.prefix_agent = PrefixAgent(self, self.alm)
         self.routing_agent = RoutingAgent(self)
         self.route_count_monitor_agent = RouteCountMonitor(self, self.alm)
-        self.actions_ospf_bgp = set()
+        self.planner = ActionPlanner(self)
 
         rule = Rule("Routing Health Rule")
         rule.condition("every {} seconds", [self.params['poll_interval']])
@@ -715,42 +1983,45 @@ class Agent(NAE):
         '''this function is called every poll cycle to collect OSPF and BGP
            data'''
         # dprint("WIP-------routing_heath_poller", event)
-        time0 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
+        self.syslogs_per_poll = 0
+        self.actioncli_per_poll = 0
+        self.addnl_log_cli_excd = False
+        self.addnl_log_syslog_excd = False
+        self.routes.begin_cycle()
+        self.poll_stats.start(COPP)
         self.coppAgent.copp_handler()
-        time1 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
-        time2 = 0
-        time3 = 0
-        time4 = 0
-        date_time = datetime.now()
-        current_time = int(date_time.timestamp())
-        if current_time < int(self.variables['monitoring_resume_time']):
-            dprint("Monitoring paused due to high cpu Utilization")
-            dprint("Will resume in {} seconds".format(
-                int(self.variables['monitoring_resume_time'])-current_time))
-        else:
-            time2 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
+        self.poll_stats.stop()
+        self.poll_stats.start('SCHEDULE')
+        self.capabilities.probe()
+        checks = self.scheduler.plan()
+        self.poll_stats.stop()
+        if OSPF in checks:
+            self.poll_stats.start(OSPF)
             self.ospf_agent.collect_ospf_data()
-            time3 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
+            self.poll_stats.stop()
+        if BGP in checks:
+            self.poll_stats.start(BGP)
             self.bgp_agent.bgp_handler()
-            self.prefix_agent.prefix_handler(self.user_prefix_list)
-            self.execute_ospf_bgp_action_cli()
-            self.alm.routing_health_set_alert()
-            if self.addnl_log_cli_excd or self.addnl_log_syslog_excd:
-                ActionSyslog('All the Alerts were not processed due to the '
-                             'Alert Limit', severity=SYSLOG_WARNING)
-                if self.addnl_log_syslog_excd:
-                    dprint("Number of syslogs dropped: {0}".format(
-                        self.syslogs_per_poll - self.global_alert_limit))
-                if self.addnl_log_cli_excd:
-                    dprint("Number of cli dropped: {0}".format(
-                        self.actioncli_per_poll - self.global_alert_limit_cli))
-            time4 = clock_gettime(CLOCK_PROCESS_CPUTIME_ID)
-
-        dprint("Time Report, COPP : {} seconds".format(time1-time0))
-        dprint("Time Report, OSPF : {} seconds".format(time3-time2))
-        dprint("Time Report, BGP  : {} seconds".format(time4-time3))
-        dprint("Time Report, Total: {} seconds".format(
-            time1-time0+time4-time2))
+            self.poll_stats.stop()
+        if PREFIX in checks:
+            self.poll_stats.start(PREFIX)
+            self.prefix_agent.prefix_handler(self.prefix_watch_table)
+            self.poll_stats.stop()
+        self.poll_stats.start('ACTIONS')
+        self.planner.execute()
+        self.alm.routing_health_set_alert()
+        if self.addnl_log_cli_excd or self.addnl_log_syslog_excd:
+            ActionSyslog('All the Alerts were not processed due to the '
+                         'Alert Limit', severity=SYSLOG_WARNING)
+            if self.addnl_log_syslog_excd:
+                dprint("Number of syslogs dropped: {0}".format(
+                    self.syslogs_per_poll - self.global_alert_limit))
+            if self.addnl_log_cli_excd:
+                dprint("Number of cli dropped: {0}".format(
+                    self.actioncli_per_poll - self.global_alert_limit_cli))
+        self.poll_stats.stop()
+        self.routes.end_cycle()
+        self.poll_stats.finish()
 
     def action_syslog(self, level, metric_args):
         '''this function is used for displaying syslog in alert window'''
@@ -777,27 +2048,30 @@ class Agent(NAE):
             self.syslogs_per_poll += 1
 
     def action_cli(self, cmds):
-        '''this function is a wrapper for ActionCLI API'''
-        if self.actioncli_per_poll < self.global_alert_limit_cli:
-            ActionCLI(cmds)
-            self.actioncli_per_poll += 1
-        elif self.actioncli_per_poll == self.global_alert_limit_cli:
-            self.actioncli_per_poll += 1
-            self.addnl_log_cli_excd = True
-        elif self.actioncli_per_poll > self.global_alert_limit_cli:
-            self.actioncli_per_poll += 1
+        '''this function is a wrapper for ActionCLI API. Sub-agents request
+        their commands from self.planner which calls it'''
+        ActionCLI(cmds)
 
     def action_shell(self, script):
         '''this function is a wrapper for ActionShell API'''
         ActionShell(script)
 
-    def fetch_url(self, url):
+    def get_rest_request_json(self, url, *args, running=None, **kwargs):
+        '''this function wraps the REST API to count every response in
+           self.poll_stats, in the running record if given'''
+        response = super().get_rest_request_json(url, *args, **kwargs)
+        self.poll_stats.rest(response, running)
+        return response
+
+    def fetch_url(self, url, running=None):
         '''this function is used to fetch data for given REST url. Retries GET
-           request if OVSDB hasn't been populated'''
+           request if OVSDB hasn't been populated. running is the
+           self.poll_stats record of the sub-agent, for a query made from
+           one of its threads'''
         response = None
         try:
             response = self.get_rest_request_json(
-                url, retry=2, wait_between_retries=1)
+                url, retry=2, wait_between_retries=1, running=running)
         except NAEException as e:
             self.logger.error("system error while collecting stat"
                               "error: {0}| url: {1}".format(e, url))
@@ -830,12 +2104,10 @@ class Agent(NAE):
             self.params['hpe_routing_daemon'].value)
         self.action_syslog(Log.WARNING, message)
         self.set_alert_description_for_key(CPU, message)
-        self.action_cli(
-            'show system resource-utilization daemon {}'.format(self.params['hpe_routing_daemon'].value))
-        date_time = datetime.now()
-        current_time = int(date_time.timestamp())
-        self.variables['monitoring_resume_time'] = str(
-            current_time + self.params['cpu_cooldown_interval'].value)
+        self.planner.request_cli(CPU, AlertLevel.CRITICAL, [
+            'show system resource-utilization daemon {}'.format(self.params['hpe_routing_daemon'].value)])
+        self.planner.execute()
+        self.scheduler.high_cpu = True
 
     def action_normal_cpu(self, event):
         '''This function brings down alert to normal when daemon cpu is
@@ -845,6 +2117,7 @@ class Agent(NAE):
             AlertLevel.NONE)
         self.alm.routing_health_set_alert()
         self.clear_alert_description_for_key(CPU)
+        self.scheduler.high_cpu = False
 
     def route_action_critical(self, event):
         dprint("route_count_action_critical")
@@ -856,8 +2129,10 @@ class Agent(NAE):
             event['value'], self.params['upper_count_threshold']))
         self.set_alert_description_for_key(ROUTE_COUNT, "{0} exceeds the upper threshold of {1}".format(
             event['value'], self.params['upper_count_threshold']))
-        self.action_cli('show ip route summary all-vrfs')
-        self.action_cli('show ipv6 route summary all-vrfs')
+        self.planner.request_cli(ROUTE_COUNT, AlertLevel.CRITICAL, [
+            'show ip route summary all-vrfs',
+            'show ipv6 route summary all-vrfs'])
+        self.planner.execute()
 
     def route_action_normal(self, event):
         dprint("route_count_action_normal")
@@ -869,13 +2144,78 @@ class Agent(NAE):
             event['value'], self.params['lower_count_threshold']))
         self.clear_alert_description_for_key(ROUTE_COUNT)
 
-    def execute_ospf_bgp_action_cli(self):
-        '''this function is used to execute action CLIs for OSPF and BGP'''
-        actions = self.actions_ospf_bgp
-        cmds_list = sorted(actions)
-        dprint("cmds_list= {0}".format(cmds_list))
-        for cmd in cmds_list:
-            self.action_cli(cmd)
+    def on_parameter_change(self, params):
+        '''this function recompiles the prefix watch table when prefix_list
+        is changed and the COPP statistics, moving average windows or route
+        count rate horizons or bucket thresholds when copp_statistics,
+        copp_alert_statistics, copp_extra_windows, route_count_rate_horizons
+        or route_count_bucket_thresholds is changed. An invalid value is
+        reported and the previous one stays in use'''
+        if 'copp_statistics' in params:
+            try:
+                self.copp_statistics = parse_copp_statistics(
+                    params['copp_statistics']['new'] or '')
+            except ValueError as e:
+                ActionSyslog(str(e) + '. Tracking the previous COPP '
+                             'statistics.', severity=SYSLOG_WARNING)
+        if 'copp_alert_statistics' in params:
+            try:
+                self.copp_alert_statistics = parse_copp_statistics(
+                    params['copp_alert_statistics']['new'] or '',
+                    'COPP alert statistics')
+            except ValueError as e:
+                ActionSyslog(str(e) + '. Alerting on the previous COPP '
+                             'statistics.', severity=SYSLOG_WARNING)
+        if 'copp_extra_windows' in params:
+            try:
+                self.copp_windows = COPP_WINDOWS + parse_copp_extra_windows(
+                    params['copp_extra_windows']['new'] or '')
+            except ValueError as e:
+                ActionSyslog(str(e) + '. Using the previous COPP windows.',
+                             severity=SYSLOG_WARNING)
+        if 'route_count_bucket_thresholds' in params:
+            try:
+                self.route_count_bucket_thresholds = \
+                    parse_route_count_bucket_thresholds(
+                        params['route_count_bucket_thresholds']['new'] or '')
+            except ValueError as e:
+                ActionSyslog(str(e) + '. Using the previous route count '
+                             'bucket thresholds.', severity=SYSLOG_WARNING)
+        if 'route_count_rate_horizons' in params:
+            try:
+                self.route_count_horizons = parse_route_count_rate_horizons(
+                    params['route_count_rate_horizons']['new'] or '')
+            except ValueError as e:
+                ActionSyslog(str(e) + '. Using the previous route count rate '
+                             'horizons.', severity=SYSLOG_WARNING)
+        if 'prefix_list' not in params:
+            return
+        user_prefix_list = []
+        if params['prefix_list']['new']:
+            user_prefix_list = self.parse_user_param_prefix_list(
+                params['prefix_list']['new'])
+        try:
+            error_msg = self.validate_user_param_prefix_list(user_prefix_list)
+        except ValueError:
+            error_msg = 'Parameter prefix_list is invalid.'
+        if error_msg:
+            ActionSyslog(error_msg + ' Monitoring the previous prefix_list.',
+                         severity=SYSLOG_WARNING)
+            return
+        self.prefix_watch_table = compile_prefix_watch_table(
+            user_prefix_list)
+
+    def parse_user_param_prefix_list(self, prefix_list):
+        '''this function splits the prefix_list parameter into prefix|vrf
+        strings, duplicates removed'''
+        user_prefix_list = prefix_list.strip(' ').strip(',').split(',')
+        user_prefix_list = [user_prefix.strip()
+                            for user_prefix in user_prefix_list]
+        # remove duplicate entries from prefix_list
+        user_prefix_list = list(dict.fromkeys(user_prefix_list))
+        dprint("user_prefix_list remove dup:{0}:{1};".format(
+            len(user_prefix_list), user_prefix_list))
+        return user_prefix_list
 
     def validate_user_param_prefix_list(self, user_prefix_list):
         for ele in user_prefix_list:
@@ -942,7 +2282,10 @@ class Agent(NAE):
 
     def calculate_rate_of_change_of_routes_count_agent(self, event):
         dprint("Enter calculate_rate_of_change_of_routes_count_agent")
+        self.routes.begin_cycle()
         self.route_count_monitor_agent.calculate_rate_of_change_of_routes_count()
+        self.routes.end_cycle()
+        self.planner.execute()
 
 
 class RoutingAgent:
@@ -986,12 +2329,6 @@ class RouteCountMonitor:
         route_count_uri_var = 'route_count_monitor'
         uri = URI_PREFIX_MONITOR + 'system/vrfs/*/routes?count&filter=selected:true'
 
-        # REST Encodings:
-        # %2A is *
-        # %3A is :
-        self.RATE_URI = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + \
-            'system/vrfs/%2A/routes?filter=selected%3Atrue&count=true'
-
         route_count_monitor = Monitor(Sum(uri), 'Route Count')
         setattr(self.agent, route_count_uri_var, route_count_monitor)
 
@@ -1009,10 +2346,21 @@ class RouteCountMonitor:
         route_count_rule.clear_action(self.agent.route_action_normal)
         setattr(self.agent, route_count_rule_var, route_count_rule)
 
-        # Store the initial routes count so that it can be used in
-        # calculating the rate of change of routes count.
-        self.agent.variables['resource_count_value'] = str(
-            self.get_resource_count())
+        # The counts read every route_count_time_interval, oldest first. The
+        # rates of all horizons are computed from them. They are dropped if
+        # the last one is older than an interval, e.g. when the agent was
+        # disabled, the first count is then read by the first rate
+        # calculation.
+        self.counts = []
+        variables = self.agent.variables
+        if 'route_count_samples' in variables.keys():
+            stamp, _, counts = variables['route_count_samples'].partition(':')
+            age = datetime.now().timestamp() - float(stamp)
+            if age < self.agent.params['route_count_time_interval'].value * \
+                    DURATION_SECONDS * 1.5:
+                self.counts = [int(count) for count in counts.split()]
+        # vrf to (version of its RouteSnapshot listing, its bucket counts)
+        self.vrf_buckets = {}
 
         # Setup the NAE Script Rules.
         self.setup_agent_rule()
@@ -1055,28 +2403,173 @@ class RouteCountMonitor:
         Callback action that is executed periodically by the NAE script
         periodic condition.
 
-        The callback action retrieves the previous value of the resource
-        from a variable stored in the local storage of the NAE Agent,
-        compares it with the current value of the resource obtained by
-        making a REST call to the resource to URI to calculate the
-        difference in the two values. The rate is calculated by dividing the
-        difference by the time interval to obtain the rate of change. It
-        updates the NAE Agent level based on the rate of change.
+        The callback action appends the current value of the resource,
+        obtained by making a REST call to the resource URI, to the counts of
+        the previous intervals kept in the local storage of the NAE Agent.
+        The rate of every horizon of route_count_rate_horizons is calculated
+        from these counts and stored in route_count_rates. The difference
+        with the previous value divided by the time interval is the rate of
+        change the NAE Agent level is updated on. An interval whose count
+        could not be read is skipped.
         """
         dprint("calculate_change_rate")
-        previous_count_value = int(
-            self.agent.variables['resource_count_value'])
         current_count_value = self.get_resource_count()
-
+        if current_count_value is None:
+            return
+        interval = self.agent.params['route_count_time_interval'].value
+        # Horizons in number of counts back, the first one is the
+        # time_interval the alert is based on
+        steps = [1] + [max(1, int(round(minutes / interval)))
+                       for minutes in self.agent.route_count_horizons]
+
+        counts = self.counts + [current_count_value]
+        del counts[:-(max(steps) + 1)]
+        self.counts = counts
+        self.agent.variables['route_count_samples'] = '{0}:{1}'.format(
+            int(datetime.now().timestamp()),
+            ' '.join(str(count) for count in counts))
+
+        rates = {}
+        for step in steps:
+            if step < len(counts):
+                previous = counts[-1 - step]
+                change_rate = (current_count_value - previous) / \
+                    (step * interval)
+                rates[step * interval] = [
+                    round(change_rate, 2),
+                    round(change_rate / max(previous, 1) * 100, 2)]
+        self.agent.variables['route_count_rates'] = json.dumps(rates)
+
+        if self.agent.params['route_count_breakdown'].value == 'true':
+            self.update_breakdown(
+                len(counts) < 2 or counts[-2] != current_count_value)
+
+        if len(counts) < 2:
+            return
+        previous_count_value = counts[-2]
         count_change = previous_count_value - current_count_value
 
-        change_rate = (count_change / self.agent.params[
-            'route_count_time_interval'].value)
-
-        self.agent.variables['resource_count_value'] = str(current_count_value)
+        change_rate = (count_change / interval)
 
         self.update_alert_level(change_rate, previous_count_value)
 
+    def update_breakdown(self, changed):
+        """
+        Updates the route count of each vrf/family/protocol bucket, kept in
+        route_count_buckets, and raises an alert for the buckets above their
+        route_count_bucket_thresholds or changing faster than the rate
+        thresholds.
+
+        Nothing is queried when the route count did not change. Otherwise
+        the routes of the VRFs whose count changed are listed again by the
+        agent's RouteSnapshot, the buckets of the other VRFs are kept.
+        :param changed: Whether the route count changed in this interval.
+        """
+        variables = self.agent.variables
+        buckets_old = json.loads(variables['route_count_buckets'])
+        buckets = buckets_old
+        if changed or not self.vrf_buckets:
+            buckets = self.collect_breakdown()
+            if buckets is None:
+                return
+            if buckets != buckets_old:
+                variables['route_count_buckets'] = json.dumps(buckets)
+
+        interval = self.agent.params['route_count_time_interval'].value
+        rates = {}
+        # The first breakdown has no previous counts to compare with
+        bucket_names = set(buckets) | set(buckets_old) if buckets_old \
+            else set()
+        for bucket in bucket_names:
+            previous = buckets_old.get(bucket, 0)
+            change_rate = (buckets.get(bucket, 0) - previous) / interval
+            if change_rate:
+                rates[bucket] = [round(change_rate, 2), round(
+                    change_rate / max(previous, 1) * 100, 2)]
+        if rates or variables['route_count_bucket_rates'] != '{}':
+            variables['route_count_bucket_rates'] = json.dumps(rates)
+
+        over = json.loads(variables['route_count_buckets_over'])
+        over_new = []
+        for bucket, count in sorted(buckets.items()):
+            for pattern, threshold in self.agent.route_count_bucket_thresholds:
+                if fnmatchcase(bucket, pattern) and count > threshold:
+                    over_new.append(bucket)
+                    if bucket not in over:
+                        self.bucket_alert(
+                            'Route count of {0} is {1} which exceeds the '
+                            'threshold value of {2}'.format(
+                                bucket, count, threshold),
+                            '{0} exceeds its threshold'.format(bucket))
+                    else:
+                        self.route_count_rate_set_alert_level(
+                            AlertLevel.CRITICAL)
+                    break
+        if over_new != over:
+            variables['route_count_buckets_over'] = json.dumps(over_new)
+
+        decrease_threshold = self.agent.params[
+            'rate_of_decrease_threshold'].value
+        increase_threshold = self.agent.params[
+            'rate_of_increase_threshold'].value
+        for bucket, (_, change_percentage) in sorted(rates.items()):
+            if change_percentage < 0 and \
+                    -change_percentage > decrease_threshold:
+                alert_type = "decrease"
+                threshold = decrease_threshold
+            elif change_percentage > increase_threshold:
+                alert_type = "increase"
+                threshold = increase_threshold
+            else:
+                continue
+            self.bucket_alert(
+                'The rate of {0} of the {1} routes which is {2}% is greater '
+                'than the threshold value of {3}%'.format(
+                    alert_type, bucket, abs(change_percentage), threshold),
+                'High rate of {0} of {1} routes'.format(alert_type, bucket))
+
+    def collect_breakdown(self):
+        """
+        Counts the selected routes of every VRF per bucket, from the VRF
+        listings of the agent's RouteSnapshot. The buckets of a VRF are
+        kept in self.vrf_buckets with the version of the listing.
+        :return: The vrf/family/protocol bucket counts, None on error.
+        """
+        vrfs = self.agent.routes.vrfs()
+        if vrfs is None:
+            return None
+        for vrf in set(self.vrf_buckets) - set(vrfs):
+            del self.vrf_buckets[vrf]
+        buckets = {}
+        for vrf in vrfs:
+            version, vrf_buckets = self.vrf_buckets.get(vrf, (None, None))
+            version, routes = self.agent.routes.vrf_routes(
+                vrf, RouteSnapshot.SUMMARY, known_version=version)
+            if routes is not None:
+                vrf_buckets = {}
+                for route in routes.values():
+                    if route.get('selected') in (False, 'False', 'false'):
+                        continue
+                    bucket = '{0}/{1}/{2}'.format(
+                        vrf, route.get('address_family'), route.get('from'))
+                    vrf_buckets[bucket] = vrf_buckets.get(bucket, 0) + 1
+                self.vrf_buckets[vrf] = (version, vrf_buckets)
+            elif vrf_buckets is None:
+                return None
+            buckets.update(vrf_buckets)
+        return buckets
+
+    def bucket_alert(self, message, description):
+        '''function used to report an alert of a route count bucket'''
+        self.agent.logger.info(message)
+        self.route_count_rate_set_alert_level(AlertLevel.CRITICAL)
+        self.agent.set_alert_description_for_key(ROUTE_COUNT, description)
+        self.alm.routing_health_set_alert()
+        self.agent.action_syslog(Log.WARNING, message)
+        self.agent.planner.request_cli(ROUTE_COUNT, AlertLevel.CRITICAL, [
+            'show ip route summary all-vrfs',
+            'show ipv6 route summary all-vrfs'])
+
     def update_alert_level(self, change_rate, previous_count_value):
         """
         Updates the Agent Alert Level based on the rate of change of the
@@ -1133,53 +2626,72 @@ class RouteCountMonitor:
         self.agent.set_alert_description_for_key(ROUTE_COUNT, description)
         self.alm.routing_health_set_alert()
         self.agent.action_syslog(Log.WARNING, message)
-        self.agent.action_cli('show ip route summary all-vrfs')
-        self.agent.action_cli('show ipv6 route summary all-vrfs')
+        self.agent.planner.request_cli(ROUTE_COUNT, AlertLevel.CRITICAL, [
+            'show ip route summary all-vrfs',
+            'show ipv6 route summary all-vrfs'])
 
     def get_resource_count(self):
         """
         Get the count of the resource by making a HTTP GET operation to the
         REST URI for the resource.
-        :return: count: Number of entries in the resource
+        :return: count: Number of entries in the resource, None on error
         """
-        count = 0
-        r = self.agent.fetch_url(self.RATE_URI)
-        if not r:
-            self.logger.error(
-                "Error while making REST call to URI {}".format(self.RATE_URI))
-        else:
-            count = r["count"]
+        count = self.agent.routes.total_count()
+        if count is None:
+            self.agent.logger.error(
+                "Error while making REST call to URI {}".format(
+                    RouteSnapshot.TOTAL_COUNT_URI))
         dprint("resource_count: {}".format(count))
         return count
 
 
 class CoppAgent:
 
-    COPP_QDEPTH_MAX = 100
     COPP_STATS_URL = HTTP_ADDRESS + \
         URI_PREFIX_GET + 'system?attributes=copp_statistics'
+    # Incomplete rows are selected by ovsdb-server, one select per
+    # dp_state value as the conditions of a select are and-ed.
+    INCOMPLETE_ROUTES_TXN = json.dumps([
+        {'op': 'select', 'table': 'Route', 'where': [['dp_state', '==', state]],
+         'columns': ['prefix', 'from', 'dp_state']}
+        for state in ['disable', 'unresolved', ['set', []]]],
+        separators=(',', ':'))
+    INCOMPLETE_NEIGHBORS_TXN = json.dumps([
+        {'op': 'select', 'table': 'Neighbor',
+         'where': [['dp_state', '==', state]],
+         'columns': ['address_family', 'dp_state', 'from', 'ip_address']}
+        for state in ['disable', ['set', []]]], separators=(',', ':'))
     INCOMPLETE_ROUTES_HOSTS_SCRIPT = """
 #!/usr/bin/env bash
 
-# find incomplete routes and print prefix, type, from, dp_state
+# Each table is read with a single transaction returning only the incomplete
+# rows and the printed columns. jq parses the reply as a stream and stops
+# after {rows_max} rows, so no table is held in memory.
+DB=$(ovsdb-client list-dbs | head -n 1)
+
+# find incomplete routes and print prefix, from, dp_state
 echo "Incomplete Routes in Route Table"
 echo "a route in disable state is a problem"
 echo "a route in unresolved state is a transitory problem which will likely get fixed by ARP/IPV6_ND in a moment"
 echo "a route with empty or incomplete state is a problem"
 echo "    except for rotues with from=local, these can be incomplete"
+echo "at most {rows_max} routes are listed"
 echo "    prefix     from   dp_state"
 echo "  ----------   ----- ------------"
-ovsdb-client dump Route -f json | \
-jq '.[0] .data[] | select(.[4] == "disable" or .[4] == "unresolved" or .[4] == ["set", []]) | "\(.[10]) \(.[6]) \(.[4])"'
+ovsdb-client transact '["'"$DB"'",{routes_txn}]' | \
+jq -rn --stream 'limit({rows_max}; fromstream(3|truncate_stream(inputs))) | "\(.prefix) \(.from) \(.dp_state)"'
 
-# find incomplete neighbors and print address_family, dp_state, from, ip_address, l3_destination
+# find incomplete neighbors and print address_family, dp_state, from, ip_address
 echo "Incomplete Neighbors in Neighbor Table"
 echo "a neighbor in disable state is a problem"
+echo "at most {rows_max} neighbors are listed"
 echo "AF     State      from    IP Address"
 echo "----  --------- -------- -----------"
-ovsdb-client dump Route -f json | \
-jq '.[0] .data[] | select(.[3] == "disable" or .[3] == ["set", []]) | "\(.[1]) \(.[2]) \(.[4]) \(.[6])"'
-"""
+ovsdb-client transact '["'"$DB"'",{neighbors_txn}]' | \
+jq -rn --stream 'limit({rows_max}; fromstream(3|truncate_stream(inputs))) | "\(.address_family) \(.dp_state) \(.from) \(.ip_address)"'
+""".format(rows_max=OVSDB_INCOMPLETE_ROWS_MAX,
+           routes_txn=INCOMPLETE_ROUTES_TXN[1:-1],
+           neighbors_txn=INCOMPLETE_NEIGHBORS_TXN[1:-1])
     L3RESMGR_CAP_SCRIPT = """
 #!/usr/bin/env bash
 
@@ -1200,113 +2712,158 @@ if [ $? -eq 1 ]; then echo "---No such routes found---"; else exit $? ; fi
         "Five_Minute",
         "Ten_Minute"
     )
+    copp_window_names = {1: "one", 5: "five", 10: "ten"}
+    UCAST_DROPPED = 'unresolved_ip_unicast_packets_dropped'
 
     def __init__(self, agent, alm):
         # dprint("WIP------- CoppAgent:__init__")
         self.agent = agent
         self.alm = alm
+        self.copp_migrate_variables()
+        self.stats_ring = SampleRing(agent, 'copp_stats_q')
+        self.tracked = (None, None, [])
+
+    def copp_migrate_variables(self):
+        """
+        converts the unresolved ip unicast drop samples, total and mva
+        violation stored by an earlier version of the script. The samples
+        were stored as a json list, later as comma separated integers with
+        the ones added since in copp_ucast_dropped_q_delta.
+        """
+        variables = self.agent.variables
+        if 'copp_stats_q_columns' in variables.keys() or \
+                'copp_ucast_total_dropped' not in variables.keys():
+            return
+        samples = []
+        for name in ['copp_ucast_dropped_q', 'copp_ucast_dropped_q_delta']:
+            if name in variables.keys():
+                samples += [int(sample) for sample in
+                            variables[name].strip('[]').split(',')
+                            if sample.strip()]
+        variables['copp_stats_q'] = ' '.join(str(sample)
+                                             for sample in samples)
+        variables['copp_stats_q_delta'] = ''
+        variables['copp_stats_q_columns'] = json.dumps({
+            'columns': [self.UCAST_DROPPED], 'counts': [len(samples)]})
+        variables['copp_stats_totals'] = json.dumps({
+            self.UCAST_DROPPED: int(variables['copp_ucast_total_dropped'])})
+        if 'copp_mva_violation' in variables.keys():
+            variables['copp_mva_violations'] = json.dumps({
+                self.UCAST_DROPPED: variables['copp_mva_violation']})
 
     def copp_handler(self):
         # dprint("WIP------- copp_handler")
+        self.stats_ring.set_windows(self.copp_window_sizes())
         self.copp_collect_stats()
         self.copp_analyze_stats()
 
+    def copp_window_sizes(self):
+        """
+        returns the number of poll cycles in each moving average window of
+        self.agent.copp_windows, at least 1.
+        """
+        pollHz = self.agent.params['poll_interval'].value / DURATION_SECONDS
+        return [max(1, int(round(minutes / pollHz)))
+                for minutes in self.agent.copp_windows]
+
+    def copp_tracked_stats(self, copp_stats):
+        """
+        returns the sorted names of the copp stats matching
+        copp_statistics. Only recomputed when the statistics in the reply
+        or copp_statistics change.
+        """
+        names = tuple(copp_stats)
+        patterns = self.agent.copp_statistics
+        if self.tracked[0] != names or self.tracked[1] != patterns:
+            self.tracked = (names, patterns, sorted(
+                name for name in names
+                if any(fnmatchcase(name, pattern) for pattern in patterns)))
+        return self.tracked[2]
+
     def copp_collect_stats(self):
         dprint("WIP------- copp_collect_stats")
 
-        ucast_drop_q = \
-            self.copp_q_to_list(self.agent.variables['copp_ucast_dropped_q'])
-
-        ucast_dropped = ''
-        ucast_dropped = ''
         url = self.COPP_STATS_URL
         try:
             r_map = self.agent.get_rest_request_json(url)
             # cops stats uri reply is json:
             #   {'copp_stats': {'statname': stat}}
-            ucast_name = 'unresolved_ip_unicast_packets_dropped'
-            ucast_dropped = r_map['copp_statistics'][ucast_name]
+            copp_stats = r_map['copp_statistics']
         except Exception as e:
-            self.logger.error("system error {} While collecting copp stat {}"
+            self.agent.logger.error("system error {} While collecting copp stat {}"
                               .format(e, url))
             return None
 
         dprint("WIP------- copp_collect_stats 10")
-        # format ucast dropped stats
-        total_ucast_dropped = \
-            int(self.agent.variables['copp_ucast_total_dropped'])
-        if len(ucast_drop_q) > 0:
-            increment = ucast_dropped - total_ucast_dropped
-        else:
-            increment = ucast_dropped
+        ring = self.stats_ring
+        names = self.copp_tracked_stats(copp_stats)
+        if names != ring.columns:
+            ring.set_columns(names)
+
+        # format stats as increments since the previous poll
+        totals = json.loads(self.agent.variables['copp_stats_totals'])
+        row = []
+        cleared = []
+        for i, name in enumerate(names):
+            stat = copp_stats[name]
+            if ring.count(i) > 0 and name in totals:
+                increment = stat - totals[name]
+            else:
+                increment = stat
+
+            if increment < 0:
+                # Assume a clear copp stats happened.
+                # start the sample series over from here.
 
-        if increment < 0:
-            # Assume a clear copp stats happened.
-            # start the sample series over from here.
+                # erase old queued data
+                ring.clear_column(name)
+                # let increment be the current sample - 0
+                increment = stat
+                cleared.append(name)
 
-            # erase old queued data
-            ucast_drop_q = []
-            # let increment be the current sample - 0
-            increment = ucast_dropped
+            row.append(increment)
+            totals[name] = stat
 
+        if cleared:
             # Note about alert-level... we purposefully leave it alone here.
             # The math judging an alert-level from the rate(s) of
-            # copp stat unresolved_ip_unicast_packets_dropped will work out
-            # naturally even if we restart the sample series from here.
+            # copp stats will work out naturally even if we restart the
+            # sample series from here.
+            stat_names = '{} {}'.format(
+                'statistic' if len(cleared) == 1 else 'statistics',
+                ', '.join(cleared))
             self.agent.logger.info(
                 'NAE Agent {}: '
-                'COPP stat {} went down, not up. '
+                'COPP {} went down, not up. '
                 'Perhpas someone cleared copp stats. '
                 'Taking this sample as new base value.'
-                .format(self.agent.name, ucast_name)
+                .format(self.agent.name, stat_names)
             )
             self.agent.action_syslog(
                 Log.INFO,
                 'NAE Agent {}: '
-                'Detected decrease in COPP statistic {}. Resetting '
+                'Detected decrease in COPP {}. Resetting '
                 'moving average data'
-                .format(self.agent.name, ucast_name)
+                .format(self.agent.name, stat_names)
             )
             self.agent.set_alert_description_for_key(
-                COPP, 'Detected decrease in COPP statistic {}'.format(ucast_name))
-
-        total_ucast_dropped = ucast_dropped
-        self.copp_q_append(ucast_drop_q, increment)
-        # dprint("WIP---- new droppQ: ", ucast_drop_q)
+                COPP, 'Detected decrease in COPP {}'.format(stat_names))
 
-        self.agent.variables['copp_ucast_dropped_q'] = \
-            self.copp_q_to_str(ucast_drop_q)
-        self.agent.variables['copp_ucast_total_dropped'] = \
-            str(total_ucast_dropped)
+        ring.append(row)
+        self.agent.variables['copp_stats_totals'] = json.dumps(
+            {name: totals[name] for name in names}, separators=(',', ':'))
 
         return None
 
-    def copp_publish_alert_info(self):
-        self.agent.action_cli("show copp-policy statistics non-zero")
-        self.agent.action_cli("show ip route summary  all-vrfs")
-        self.agent.action_shell(self.INCOMPLETE_ROUTES_HOSTS_SCRIPT)
-        self.agent.action_shell(self.L3RESMGR_CAP_SCRIPT)
-        self.agent.action_shell(self.SOFTWARE_ONLY_ROUTES_SWNS_SCRIPT)
-
-    def copp_moving_average(self, numbers, window_size):
-        """
-        take a window_size slice from the tail of numbers and calculate the
-        average.
-
-        Some corner cases:
-        1. if len(numbers) is less than window_size, give up and return 0
-        2. ignore the first element of numbers, based on the idea that the
-           first sample of copp stats will have no previous diff and may be
-           seemingly over-large.
-        """
-
-        i = len(numbers)
-        if i <= window_size:
-            return 0
-
-        tail_numbers = numbers[-window_size:]
-        window_average = sum(tail_numbers) / window_size
-        return window_average
+    def copp_publish_alert_info(self, level):
+        planner = self.agent.planner
+        planner.request_cli(COPP, level, [
+            "show copp-policy statistics non-zero",
+            "show ip route summary all-vrfs"])
+        planner.request_shell(COPP, level, self.INCOMPLETE_ROUTES_HOSTS_SCRIPT)
+        planner.request_shell(COPP, level, self.L3RESMGR_CAP_SCRIPT)
+        planner.request_shell(
+            COPP, level, self.SOFTWARE_ONLY_ROUTES_SWNS_SCRIPT)
 
     def copp_analyze_stats(self):
         """
@@ -1315,131 +2872,138 @@ if [ $? -eq 1 ]; then echo "---No such routes found---"; else exit $? ; fi
         large alert if 10 minute pass mva crosses above copp_max_burst_packets
 
         alert if 5 minute drop mva exceeds copp_max_burst_packets/2
-        """
-        dprint("WIP------- copp_analyze_stats")
-        ucast_stats = self.copp_q_to_list(
-            self.agent.variables['copp_ucast_dropped_q'])
-
-        self.copp_alert_on_stats(ucast_stats, "unresolved ip unicast")
 
-    def copp_alert_on_stats(self, stats, stats_name):
+        The moving averages of all tracked stats are computed in one pass,
+        the packets dropped stats matching copp_alert_statistics are then
+        evaluated one by one against the packets per second capacity and the
+        copp alert level follows the highest mva violation among them.
         """
-        Evaluate a set of copp stats. Determine their 1,5,10 minute moving
-        averages. Decide if alert level should be raised or lowered depending
-        on how 1,5,10 mvas have changed.
-        """
-        dprint("WIP------- copp_alert_on_stats")
-        dprint("WIP------- {} stats: ".format(stats_name), stats)
+        dprint("WIP------- copp_analyze_stats")
+        ring = self.stats_ring
+        averages = ring.averages()
+        self.agent.variables['copp_stats_averages'] = json.dumps(
+            {'windows': self.agent.copp_windows,
+             'averages': {name: [round(window[i], 2) for window in averages]
+                          for i, name in enumerate(ring.columns)}},
+            separators=(',', ':'))
 
         # rate in pps
         max_rate = self.copp_get_system_max_rate()
-        pollHz = self.agent.params['poll_interval'].value / DURATION_SECONDS
-        one_min_win_size = int(round(1 / pollHz))
-        five_min_win_size = int(round(5 / pollHz))
-        ten_min_win_size = int(round(10 / pollHz))
-
-        mva_one = self.copp_moving_average(stats, one_min_win_size)
-        mva_five = self.copp_moving_average(stats, five_min_win_size)
-        mva_ten = self.copp_moving_average(stats, ten_min_win_size)
-
         upper_threshold = max_rate * .10
         lower_threshold = max_rate * .01
-        u_thresh_int = int(round(upper_threshold))
-        l_thresh_int = int(round(lower_threshold))
-        dprint("WIP---- oneMinAvg {}, fiveMinAvg {}, tenMinAvg {} \
-            ".format(mva_one, mva_five, mva_ten))
         dprint("WIP---- max_rate {}, upper {}, lower {}\
             ".format(max_rate, upper_threshold, lower_threshold))
 
-        alert = False
-        # raise alert if drop rate above 10%
-        mva_violation_level = \
-            self.copp_mva_violations.index(
-                self.agent.variables['copp_mva_violation'])
-        if mva_one > u_thresh_int:
-            if mva_violation_level < \
-                    self.copp_mva_violations.index("One_Minute"):
-                message = "COPP drop rate for {} one minute moving average {} went above {}".format(
-                    stats_name, mva_one, u_thresh_int)
-                self.agent.action_syslog(Log.INFO, message)
-                self.agent.set_alert_description_for_key(COPP, message)
-                alert = AlertLevel.MINOR
-                self.agent.variables['copp_mva_violation'] = "One_Minute"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("One_Minute")
-
-        if mva_five > u_thresh_int:
-            if mva_violation_level < \
-                    self.copp_mva_violations.index("Five_Minute"):
-                message = "COPP drop rate for {} five minute moving average {} went above {}".format(
-                    stats_name, mva_five, u_thresh_int)
-                self.agent.action_syslog(Log.INFO, message)
-                self.agent.set_alert_description_for_key(COPP, message)
-                alert = AlertLevel.MAJOR
-                self.agent.variables['copp_mva_violation'] = "Five_Minute"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("Five_Minute")
-
-        if mva_ten > u_thresh_int:
-            if mva_violation_level < \
-                    self.copp_mva_violations.index("Ten_Minute"):
-                message = "COPP drop rate for {} ten minute moving average {} went above {}".format(
-                    stats_name, mva_ten, u_thresh_int)
-                self.agent.action_syslog(Log.WARNING, message)
-                self.agent.set_alert_description_for_key(COPP, message)
-                alert = AlertLevel.CRITICAL
-                self.agent.variables['copp_mva_violation'] = "Ten_Minute"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("Ten_Minute")
-
+        violation_names = self.copp_violation_names()
+        violations = json.loads(self.agent.variables['copp_mva_violations'])
+        levels = {}
+        raised = False
+        lowered = False
+        alerting = self.agent.copp_alert_statistics
+        for i, name in enumerate(ring.columns):
+            if not name.endswith('_packets_dropped') or \
+                    not any(fnmatchcase(name, pattern)
+                            for pattern in alerting):
+                continue
+            # A violation of a window no longer configured is taken as one
+            # of the largest window left.
+            violation = violations.get(name, "None")
+            if violation in violation_names:
+                level = violation_names.index(violation)
+            else:
+                level = len(violation_names) - 1
+            new_level = self.copp_alert_on_stats(
+                [window[i] for window in averages], self.copp_stats_name(name),
+                level, int(round(upper_threshold)),
+                int(round(lower_threshold)))
+            raised = raised or new_level > level
+            lowered = lowered or new_level < level
+            levels[name] = violation_names[new_level]
+        # The stats no longer alerting are cleared
+        lowered = lowered or any(
+            name not in levels and violation != "None"
+            for name, violation in violations.items())
+        if levels != violations:
+            self.agent.variables['copp_mva_violations'] = json.dumps(levels)
+
+        alert = self.copp_window_alert(max(
+            [violation_names.index(level) for level in levels.values()],
+            default=0))
         # If drop rate went above 10%, increase alert level for agent
-        if alert:
+        if raised:
             self.copp_alert_level_vote_up(alert)
-            alert = False
+        # If drop rate went below 1%, lower alert level for agent
+        if lowered:
+            if alert == AlertLevel.NONE:
+                self.agent.clear_alert_description_for_key(COPP)
+            self.copp_alert_level_vote_down(alert)
+
+    def copp_stats_name(self, name):
+        """
+        returns the name of a copp stat used in messages, e.g.
+        'unresolved ip unicast' for unresolved_ip_unicast_packets_dropped.
+        """
+        if name.endswith('_packets_dropped'):
+            name = name[:-len('_packets_dropped')]
+        return name.replace('_', ' ')
+
+    def copp_violation_names(self):
+        """
+        returns the mva violation levels, the extra windows following the
+        ten minute one.
+        """
+        return self.copp_mva_violations + tuple(
+            "{}_Minute".format(minutes)
+            for minutes in self.agent.copp_windows[len(COPP_WINDOWS):])
+
+    def copp_window_alert(self, violation_level):
+        """
+        returns the alert level of an mva violation level.
+        """
+        return (AlertLevel.NONE, AlertLevel.MINOR,
+                AlertLevel.MAJOR)[violation_level] \
+            if violation_level < 3 else AlertLevel.CRITICAL
+
+    def copp_alert_on_stats(self, mvas, stats_name, mva_violation_level,
+                            u_thresh_int, l_thresh_int):
+        """
+        Evaluate the 1,5,10 minute (and extra windows) moving averages of a
+        copp stat. Decide if its mva violation level should be raised or
+        lowered depending on how the mvas have changed.
+
+        returns the new mva violation level.
+        """
+        dprint("WIP------- copp_alert_on_stats")
+        dprint("WIP---- {} window minutes {}, averages {} \
+            ".format(stats_name, self.agent.copp_windows, mvas))
+
+        # raise alert if drop rate above 10%
+        for level, (minutes, mva) in enumerate(
+                zip(self.agent.copp_windows, mvas), 1):
+            if mva > u_thresh_int and mva_violation_level < level:
+                message = "COPP drop rate for {} {} minute moving average {} went above {}".format(
+                    stats_name, self.copp_window_names.get(minutes, minutes),
+                    mva, u_thresh_int)
+                self.agent.action_syslog(
+                    Log.WARNING if level >= 3 else Log.INFO, message)
+                self.agent.set_alert_description_for_key(COPP, message)
+                mva_violation_level = level
 
         # lower alert if drop rate below 1%
         # Strategy for lowering volation level:
         #   if curent mvl == test_level, then lower level one notch
-        if mva_one < l_thresh_int:
-            if mva_violation_level == \
-                    self.copp_mva_violations.index("One_Minute"):
-                self.agent.action_syslog(Log.INFO,
-                                         "COPP drop rate for {} one minute moving average {} went "
-                                         "below {}".format(
-                                             stats_name, mva_one, l_thresh_int))
-                self.agent.clear_alert_description_for_key(COPP)
-                alert = AlertLevel.NONE
-                self.agent.variables['copp_mva_violation'] = "None"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("None")
-
-        if mva_five < l_thresh_int:
-            if mva_violation_level == \
-                    self.copp_mva_violations.index("Five_Minute"):
-                message = "COPP drop rate for {} five minute moving average {} went below {}".format(
-                    stats_name, mva_five, l_thresh_int)
-                self.agent.action_syslog(Log.INFO, message)
-                self.agent.set_alert_description_for_key(COPP, message)
-                alert = AlertLevel.MINOR
-                self.agent.variables['copp_mva_violation'] = "One_Minute"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("One_Minute")
-
-        if mva_ten < l_thresh_int:
-            if mva_violation_level == \
-                    self.copp_mva_violations.index("Ten_Minute"):
-                message = "COPP drop rate for {} ten minute moving average {} went below {}".format(
-                    stats_name, mva_ten, l_thresh_int)
+        for level, (minutes, mva) in enumerate(
+                zip(self.agent.copp_windows, mvas), 1):
+            if mva < l_thresh_int and mva_violation_level == level:
+                message = "COPP drop rate for {} {} minute moving average {} went below {}".format(
+                    stats_name, self.copp_window_names.get(minutes, minutes),
+                    mva, l_thresh_int)
                 self.agent.action_syslog(Log.INFO, message)
-                self.agent.set_alert_description_for_key(COPP, message)
-                alert = AlertLevel.MAJOR
-                self.agent.variables['copp_mva_violation'] = "Five_Minute"
-                mva_violation_level = \
-                    self.copp_mva_violations.index("Five_Minute")
+                if level > 1:
+                    self.agent.set_alert_description_for_key(COPP, message)
+                mva_violation_level = level - 1
 
-        # If drop rate went below 1%, lower alert level for agent
-        if alert:
-            self.copp_alert_level_vote_down(alert)
+        return mva_violation_level
 
     def copp_get_system_max_rate(self):
         """
@@ -1462,7 +3026,7 @@ if [ $? -eq 1 ]; then echo "---No such routes found---"; else exit $? ; fi
                                 "'copp_max_rate_kbps' in capacities")
             return copp_capacity
         except Exception as e:
-            self.logger.error(
+            self.agent.logger.error(
                 "system error while collecting system capacities: {}\
                     ".format(str(e)))
 
@@ -1483,7 +3047,7 @@ if [ $? -eq 1 ]; then echo "---No such routes found---"; else exit $? ; fi
             if speeds is not None and len(speeds) > 0:
                 min_speed = min(speeds)
         except Exception as e:
-            self.logger.error(
+            self.agent.logger.error(
                 "system error while collecting link speeds: {}".format(str(e)))
         return min_speed
 
@@ -1568,79 +3132,10 @@ if [ $? -eq 1 ]; then echo "---No such routes found---"; else exit $? ; fi
             #     ", current, " to: ",  desired)
             self.copp_set_alert_level(desired)
 
-    def copp_q_to_list(self, q_str):
-        """
-        given a copp_q string, return a copp Q list.
-
-        param q_str      A copp stats queue string is the json representation
-                        of a list of (upto)  COPP_QDEPTH_MAX positive integers.
-                        "[1, 2, 42, 567,...]"
-
-        returns  python list of integers
-                 [1, 2, 42, 567,...]
-        """
-        if q_str is None:
-            return []
-        if q_str == "":
-            return []
-        return json.loads(q_str)
-
-    def copp_q_to_str(self, q_list):
-        """
-        given a pyton list of ints, return a copp Q string.
-
-        param q_list a python list of ints. If the list is longer than
-                    COPP_QDEPTH_MAX, it will be trimmed to only the tail
-                    entries which fit in COPP_QDEPTH_MAX.
-                    It only makes sense to keep positive integers in a copp
-                    stats Q. But this function does not impose that sanity
-                    checking. Caller should manage that.
-
-        returns     (json format) string of the python list of ints.
-                    "[1, 2, 42, 567,...]"
-        """
-        if q_list is None:
-            return "[]"
-
-        if len(q_list) > self.COPP_QDEPTH_MAX:
-            q_list = q_list[-self.COPP_QDEPTH_MAX:]
-
-        return json.dumps(q_list)
-
-    def copp_q_append(self, q_list, q_item):
-        """
-        given a copp stats q_list and q_item, append q_item to q_list. If
-        len(q_list) exceeds COPP_QDEPTH_MAX, trim qlist to be only the
-        tail entries  (most recent) that fit.
-
-        param q_list (in/out) a copp queue which is a pyhon list of postive
-                             integers. note: q_list will be modified.
-        param q_item (in)    a positive integer to be tail appended to q_list
-
-        returns None. May raise exceptions.
-        """
-        if q_list is None:
-            self.agent.logger.info("q_list is None")
-            raise Exception("q_list may not be None")
-        if not isinstance(q_list, list):
-            self.agent.logger.info("q_list is not a list")
-            raise Exception("q_list must be a python list")
-        if not isinstance(q_item, int):
-            self.agent.logger.info("q_item is not an int")
-            raise Exception("q_item must be an integer")
-        if q_item < 0:
-            raise Exception("q_item must be positive. not {}".format(q_item))
-
-        q_list.append(q_item)
-        if len(q_list) > self.COPP_QDEPTH_MAX:
-            q_list = q_list[-self.COPP_QDEPTH_MAX:]
-
-        return None
-
     def copp_set_alert_level(self, level):
         self.alm.alert_levels_generated_within_poll_per_subagent['copp'].add(
             level)
-        self.copp_publish_alert_info()
+        self.copp_publish_alert_info(level)
 
 
 class OSPFAgent:
@@ -1652,11 +3147,27 @@ class OSPFAgent:
         self.alm = alm
         self.ospf_alert_on_this_cycle = False
         self.ospf_neighbor_not_in_stable_state = False
-        self.ospfv2_url_list = self.get_url_list(
-            self.agent.params['ospf_interface'].value, '')
-        self.ospfv3_url_list = self.get_url_list(
-            self.agent.params['ospf_interface'].value, 'v3')
-        self.action = set()
+        # Only the fields read from the neighbors of the previous poll
+        self.neighbor_store = NeighborStateStore(
+            agent, 'ospf_neighbor_list', ('nfsm_state', 'vrf'))
+        self.ospf_interface_filter = None
+        if self.agent.params['ospf_wildcard_query'].value == 'true':
+            interface_list = [
+                interface.strip() for interface in
+                self.agent.params['ospf_interface'].value.split(",")]
+            if '*' not in interface_list:
+                self.ospf_interface_filter = frozenset(interface_list)
+            self.ospf_interface_list = ['*']
+            self.ospfv2_url_list = [self.get_wildcard_url('')]
+            self.ospfv3_url_list = [self.get_wildcard_url('v3')]
+        else:
+            self.ospf_interface_list = [
+                interface.strip() for interface in
+                self.agent.params['ospf_interface'].value.split(",")]
+            self.ospfv2_url_list = self.get_url_list(
+                self.agent.params['ospf_interface'].value, '')
+            self.ospfv3_url_list = self.get_url_list(
+                self.agent.params['ospf_interface'].value, 'v3')
         # self.ospfv2_base_url = HTTP_ADDRESS + \
         #     URI_PREFIX_GET + 'system/vrfs/' + \
         #     self.agent.params['vrf'].value + \
@@ -1685,40 +3196,36 @@ class OSPFAgent:
                 '/ospf' + version + '_routers/*/areas/' + \
                 self.agent.params['ospf_area'].value + \
                 '/ospf_interfaces/' + \
-                (interface).replace(
+                (interface.strip()).replace(
                     "/", "%2F") + '/ospf_neighbors?depth=2'
             url_list.append(url)
         return url_list
 
-    # Function to check if ospf is supported before trying to handle data
-    def check_ospfv2_supported(self):
-        url = (HTTP_ADDRESS + URI_PREFIX_GET + 'system/vrfs/' +
-               self.agent.params['vrf'].value + '?depth=2')
-        response = self.agent.fetch_url(url)
-        if ('"ospf_routers"' in str(response) or
-                "'ospf_routers'" in str(response)):
-            return "true"
-        else:
-            self.agent.logger.debug(
-                "OSPF is not supported on this platform, script will not "
-                "attempt to fetch OSPF data"
-            )
-            return "false"
-
-    # Function to check if ospfv3 is supported before trying to handle data
-    def check_ospfv3_supported(self):
-        url = (HTTP_ADDRESS + URI_PREFIX_GET + 'system/vrfs/' +
-               self.agent.params['vrf'].value + '?depth=2')
-        response = self.agent.fetch_url(url)
-        if ('"ospfv3_routers"' in str(response) or
-                "'ospfv3_routers'" in str(response)):
-            return "true"
-        else:
-            self.agent.logger.debug(
-                "OSPFv3 is not supported on this platform, script will not "
-                "attempt to fetch OSPFv3 data"
-            )
-            return "false"
+    # Function to form the URL querying the neighbors of all the interfaces
+    # of the VRF/area at once. Only the attributes read by analyze_ospf_data
+    # are requested, time_of_last_change is part of status
+    def get_wildcard_url(self, version):
+        '''Function to form the wildcard URL string to be queried'''
+        return HTTP_ADDRESS + \
+            URI_PREFIX_GET + 'system/vrfs/' + \
+            self.agent.params['vrf'].value + \
+            '/ospf' + version + '_routers/*/areas/' + \
+            self.agent.params['ospf_area'].value + \
+            '/ospf_interfaces/*/ospf_neighbors?depth=2' + \
+            '&attributes=nbr_if_addr,nfsm_state,status'
+
+    # Function to drop the interfaces not listed in ospf_interface from a
+    # wildcard query response
+    def filter_ospf_response(self, res):
+        '''Function to filter a wildcard OSPF response on interface'''
+        for vrf_data in res.values():
+            for router_data in vrf_data.values():
+                for area_data in router_data.values():
+                    for ospf_interface in list(area_data):
+                        if (ospf_interface.replace("%2F", "/") not in
+                                self.ospf_interface_filter):
+                            del area_data[ospf_interface]
+        return res
 
     # Funtion to collect OSPF Data
     def collect_ospf_data(self):
@@ -1729,40 +3236,33 @@ class OSPFAgent:
         #     dprint(url)
         response_list = []
 
-        if 'is_ospfv2_supported' not in self.agent.variables:
-            self.agent.variables['is_ospfv2_supported'] = (
-                self.check_ospfv2_supported()
-            )
-
-        if 'is_ospfv3_supported' not in self.agent.variables:
-            self.agent.variables['is_ospfv3_supported'] = (
-                self.check_ospfv3_supported()
-            )
-
-        ospfv2_supported = self.agent.variables['is_ospfv2_supported']
-        ospfv3_supported = self.agent.variables['is_ospfv3_supported']
-
-        if ospfv2_supported == "true":
-            for url in url_list:
-                response = self.agent.fetch_url(url)
-                if response is None:
-                    continue
-                else:
-                    response_list.append(response)
-
-        dprint('Response list length after fetch ospfv2:', len(response_list))
-
-        if ospfv3_supported == "true":
-            for url in v3_url_list:
-                response = self.agent.fetch_url(url)
-                if response is None:
-                    continue
-                else:
-                    response_list.append(response)
+        # Each job is (url, interface, version)
+        jobs = []
+        if self.agent.capabilities.configured('ospfv2'):
+            jobs.extend((url, interface, '') for url, interface in
+                        zip(url_list, self.ospf_interface_list))
+        if self.agent.capabilities.configured('ospfv3'):
+            jobs.extend((url, interface, 'v3') for url, interface in
+                        zip(v3_url_list, self.ospf_interface_list))
+
+        response_list, timed_out = self.fetch_ospf_urls(jobs)
+        dprint('Response list length after fetch:', len(response_list))
+        if self.ospf_interface_filter is not None:
+            response_list = [self.filter_ospf_response(response)
+                             for response in response_list]
+
+        self.agent.variables['ospf_timed_out_interfaces'] = json.dumps(
+            timed_out)
+        if timed_out:
+            self.agent.logger.info(
+                "OSPF neighbor query did not complete within {0} seconds for "
+                "interfaces {1}, keeping their last known neighbors".format(
+                    self.agent.params['ospf_fetch_deadline'].value,
+                    ", ".join("{0}{1}".format(interface, version)
+                              for interface, version in timed_out)))
 
-        dprint('Response list length after fetch ospfv3:', len(response_list))
         self.cleanup_ospf_data()
-        self.analyze_ospf_data(response_list)
+        self.analyze_ospf_data(response_list, timed_out)
 
         # bring the alert back to normal
         # all neighbors should be in good state,
@@ -1775,24 +3275,85 @@ class OSPFAgent:
 
         return None
 
+    # Function to fetch the OSPF neighbor URLs of the poll. With more than
+    # one ospf_fetch_workers the queries run in parallel and are given
+    # ospf_fetch_deadline seconds in total, so a slow query only delays the
+    # poll by the deadline.
+    # Input Parameters:
+    # jobs : list of (url, interface, version)
+    # Returns the responses in job order and the [interface, version] of
+    # the jobs which did not complete in time
+    def fetch_ospf_urls(self, jobs):
+        '''Function to fetch the OSPF neighbor URLs of the poll'''
+        workers = min(self.agent.params['ospf_fetch_workers'].value,
+                      len(jobs))
+        if workers <= 1:
+            response_list = []
+            for url, _, _ in jobs:
+                response = self.agent.fetch_url(url)
+                if response is not None:
+                    response_list.append(response)
+            return response_list, []
+
+        # The queries outliving the deadline are counted in this sub-agent
+        # only, not in the one running when they end
+        running = self.agent.poll_stats.current()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(self.agent.fetch_url, url, running)
+                   for url, _, _ in jobs]
+        done, _ = wait(futures,
+                       timeout=self.agent.params['ospf_fetch_deadline'].value)
+        # Do not wait for the queries still running, they are abandoned
+        executor.shutdown(wait=False)
+
+        response_list = []
+        timed_out = []
+        for (_, interface, version), future in zip(jobs, futures):
+            if future not in done:
+                future.cancel()
+                timed_out.append([interface, version])
+            elif future.result() is not None:
+                response_list.append(future.result())
+        return response_list, timed_out
+
+    # Function to check if a neighbor of the previous poll belongs to an
+    # interface whose query timed out in this poll
+    # Input Parameters:
+    # key : "ospf_interface|nbr_if_addr", the interface is URL encoded
+    # timed_out : list of [interface, version] returned by fetch_ospf_urls
+    def is_neighbor_timed_out(self, key, timed_out):
+        '''Function to check if a neighbor query timed out in this poll'''
+        interface, nbr_if_addr = key.split("|", 1)
+        interface = interface.replace("%2F", "/")
+        if type(ip_address(nbr_if_addr)) is IPv4Address:
+            version = ''
+        else:
+            version = 'v3'
+        for timed_out_interface, timed_out_version in timed_out:
+            if (timed_out_version == version and
+                    timed_out_interface in ('*', interface)):
+                return True
+        return False
+
     # Function to execute no debug in case of no errors in the last 5 cycles
     def cleanup_ospf_data(self):
         '''Function to execute no debug in case of no errors in the last 5
          cycles'''
         if int(self.agent.variables['ospfv2_debug_packet_cycles_left']) == 1:
-            self.action.add("no debug ospfv2 packet")
-            self.action.add("show debug buffer")
+            self.agent.planner.request_cli(OSPF, None, [
+                "no debug ospfv2 packet", "show debug buffer"])
             self.agent.variables['ospfv2_debug_packet_cycles_left'] = str(0)
         if int(self.agent.variables['ospfv3_debug_packet_cycles_left']) == 1:
-            self.action.add("no debug ospfv3 packet")
-            self.action.add("show debug buffer")
+            self.agent.planner.request_cli(OSPF, None, [
+                "no debug ospfv3 packet", "show debug buffer"])
             self.agent.variables['ospfv3_debug_packet_cycles_left'] = str(0)
 
     # Function to parse and analyze OSPF response
     # Input Parameters:
     # res : ospf response to be parsed and analyzed
-    # ospf_version : ospf version to be parsed and analyzed(ospfv2/ospfv3)
-    def analyze_ospf_data(self, res_list):
+    # timed_out : [interface, version] whose query did not complete, their
+    #             neighbors are carried over from the previous poll
+    def analyze_ospf_data(self, res_list, timed_out=()):
         '''Function to parse and analyze OSPF response'''
         # res_list = [] if res_list is None else res_list
         cycles = int(
@@ -1883,8 +3444,7 @@ class OSPFAgent:
                                     "vrf": vrf
                                 }
 
-        neighbor_dict_old = json.loads(
-            self.agent.variables["ospf_neighbor_list"])
+        neighbor_dict_old = self.neighbor_store.load()
         dprint('nbr_dict_old: {0}'.format(neighbor_dict_old))
         dprint('nbr_dict_new: {0}'.format(neighbor_dict_new))
         dprint('Old ospf dict:')
@@ -1901,11 +3461,18 @@ class OSPFAgent:
 
         self.monitor_nfsm_state_changes_and_timeout(
             neighbor_dict_old, neighbor_dict_new)
+
+        # Neighbors of interfaces which could not be queried in time are
+        # not expired, keep them as they were in the previous poll
+        if timed_out:
+            for key in neighbor_dict_old:
+                if (key not in neighbor_dict_new and
+                        self.is_neighbor_timed_out(key, timed_out)):
+                    neighbor_dict_new[key] = neighbor_dict_old[key]
+
         self.monitor_neighbor(neighbor_dict_old, neighbor_dict_new)
-        self.agent.actions_ospf_bgp.update(self.action)
 
-        self.agent.variables["ospf_neighbor_list"] = json.dumps(
-            neighbor_dict_new)
+        self.neighbor_store.save(neighbor_dict_new)
         self.agent.variables['neighbor_count'] = str(neighbor_count)
 
     # Structure of neighbor_dict_new/neighbor_dict_old
@@ -1918,27 +3485,30 @@ class OSPFAgent:
     # }
 
     def update_action_cli(self, neighbor_ip, interface, vrf, alert_level):
-        '''Function to update the action CLIs to the action set'''
+        '''Function to request the action CLIs from the planner'''
         self.alm.alert_levels_generated_within_poll_per_subagent['ospf'].add(
             alert_level)
         self.ospf_alert_on_this_cycle = True
+        commands = []
         if type(ip_address(neighbor_ip)) is IPv4Address:
-            self.action.add("show ip ospf statistics interface {0} vrf "
+            commands.append("show ip ospf statistics interface {0} vrf "
                             "{1}".format(interface, vrf))
-            self.action.add(
+            commands.append(
                 "ping {0} vrf {1} repetitions 2".format(neighbor_ip, vrf))
-            self.action.add("debug ospfv2 packet port {0}".format(interface))
+            commands.append("debug ospfv2 packet port {0}".format(interface))
 
             self.agent.variables['ospfv2_debug_packet_cycles_left'] = str(5)
         else:
-            self.action.add("show ipv6 ospfv3 statistics interface {}".format(
+            commands.append("show ipv6 ospfv3 statistics interface {}".format(
                 interface))
-            self.action.add("ping6 {0} vrf {1} source {2} repetitions 2".format(
+            commands.append("ping6 {0} vrf {1} source {2} repetitions 2".format(
                 neighbor_ip, vrf, interface))
-            self.action.add("debug ospfv3 packet port {0}".format(interface))
+            commands.append("debug ospfv3 packet port {0}".format(interface))
 
             self.agent.variables['ospfv3_debug_packet_cycles_left'] = str(
                 5)
+        self.agent.planner.request_cli(OSPF, alert_level, commands)
+
     # Function to track ospf state changes and timeout
     # Input Parameters
     # neighbor_dict_old : Data structure conatining neighbor dictionary of
@@ -2110,12 +3680,28 @@ class BGPAgent:
     def __init__(self, agent, alm):
         self.agent = agent
         self.alm = alm
-        self.action = set()
         self.bgp_alert_on_this_cycle = False
         self.bgp_neighbor_not_in_stable_state = False
-        self.unique_vrf_base_url = HTTP_ADDRESS + \
-            URI_PREFIX_GET_V10_13 + 'system/vrfs/' + \
-            self.agent.params['vrf'].value + '/bgp_routers?depth=4'
+        self.nbr_store = NeighborStateStore(agent, 'bgp_nbr_list', (
+            "bgp_peer_state", "bgp_peer_uptime", "bgp_peer_last_err_rx",
+            "bgp_peer_last_err_tx", "bgp_peer_last_sub_err_rx",
+            "bgp_peer_last_sub_err_tx", "bgp_peer_established_count",
+            "bgp_local_interface", "bgp_update_source",
+            "bgp_peer_stuck_state"))
+        self.bgp_projected_query = \
+            self.agent.params['bgp_projected_query'].value == 'true'
+        if self.bgp_projected_query:
+            # Only the attributes read by compact_bgp_neighbor
+            self.unique_vrf_base_url = HTTP_ADDRESS + \
+                URI_PREFIX_GET_V10_13 + 'system/vrfs/' + \
+                self.agent.params['vrf'].value + \
+                '/bgp_routers/*/bgp_neighbors?depth=2' + \
+                '&attributes=is_peer_group,local_interface,statistics,' + \
+                'status,update_source'
+        else:
+            self.unique_vrf_base_url = HTTP_ADDRESS + \
+                URI_PREFIX_GET_V10_13 + 'system/vrfs/' + \
+                self.agent.params['vrf'].value + '/bgp_routers?depth=4'
 
     def bgp_handler(self):
         '''This function is wrapper for handle_bgp_data'''
@@ -2126,28 +3712,34 @@ class BGPAgent:
     # vrf/bgp_nbr_addr as key and its corresponding neighbor info as value
 
     # Input Parameters
-    # response_dict : Contains key as vrf and value as all the neighbors
+    # response_dict : Contains key as vrf and value as all the neighbors of
+    #                 every bgp router of the vrf (under bgp_neighbors unless
+    #                 bgp_projected_query is set)
     # Example:
     # response_dict = {
     #       vrf1:{
-    #           neighbor1:{neighborinfo}
-    #           neighbor2:{neighborinfo}
+    #           asn:{
+    #               neighbor1:{neighborinfo}
+    #               neighbor2:{neighborinfo}
+    #           }
     #       }
     #       vrf2:{
-    #           neighbor1:{neighborinfo}
-    #           neighbor3:{neighborinfo}
+    #           asn:{
+    #               neighbor1:{neighborinfo}
+    #               neighbor3:{neighborinfo}
+    #           }
     #       }
     # }
 
     # Output Parameters
-    # final_response: Conatins key vrf/neighbor_ip_addr and value as neighbor
-    #                 info
+    # final_response: Conatins key vrf/neighbor_ip_addr and value as the
+    #                 compact neighbor info returned by compact_bgp_neighbor
     # Example:
     # final_response = {
-    #       vrf1/neighbor1:{neighborinfo}
-    #       vrf1/neighbor2:{neighborinfo}
-    #       vrf2/neighbor1:{neighborinfo}
-    #       vrf2/neighbor3:{neighborinfo}
+    #       vrf1/neighbor1:{compact neighborinfo}
+    #       vrf1/neighbor2:{compact neighborinfo}
+    #       vrf2/neighbor1:{compact neighborinfo}
+    #       vrf2/neighbor3:{compact neighborinfo}
     # }
     def simplify_response(self, response_dict):
         '''Function to modify input response dict into a simplified dict
@@ -2160,7 +3752,9 @@ class BGPAgent:
         final_response = {}
         for vrf, vrf_data in response_dict.items():
             for _, bgp_data in vrf_data.items():
-                for bgp_nbr_addr, bgp_nbr_data in bgp_data['bgp_neighbors'].items():
+                if not self.bgp_projected_query:
+                    bgp_data = bgp_data['bgp_neighbors']
+                for bgp_nbr_addr, bgp_nbr_data in bgp_data.items():
                     # skip adding bgp peer group to bgp neighbors:
                     # REST output of bgp nbrs will have the individual bgp nbrs
                     # and an entry for each peer group which is configured.
@@ -2171,28 +3765,59 @@ class BGPAgent:
                     if bgp_nbr_data["is_peer_group"] is True:
                         continue
                     if user_input_neighbor_list[0] == '*':
-                        final_response["{}/{}".format(vrf,
-                                                      bgp_nbr_addr)] = bgp_nbr_data
+                        final_response["{}/{}".format(vrf, bgp_nbr_addr)] = \
+                            self.compact_bgp_neighbor(bgp_nbr_data)
                     else:
                         if bgp_nbr_addr in user_input_neighbor_list:
                             # dprint("{0} {1}".format(vrf, bgp_nbr_addr))
-                            final_response["{}/{}".format(vrf,
-                                                          bgp_nbr_addr)] = bgp_nbr_data
+                            final_response["{}/{}".format(
+                                vrf, bgp_nbr_addr)] = \
+                                self.compact_bgp_neighbor(bgp_nbr_data)
         return final_response
 
-    # Function to check if bgp is supported before trying to handle data
-    def check_bgp_supported(self):
-        url = (HTTP_ADDRESS + URI_PREFIX_GET + 'system/vrfs/' +
-               self.agent.params['vrf'].value + '?depth=2')
-        response = self.agent.fetch_url(url)
-        if '"bgp_routers"' in str(response) or "'bgp_routers'" in str(response):
-            return "true"
-        else:
-            self.agent.logger.debug(
-                "BGP is not supported on this platform, script will not "
-                "attempt to fetch bgp data"
-            )
-            return "false"
+    # Function to reduce the REST neighbor info to the fields monitored by
+    # the script, so the REST response can be released right after it is
+    # simplified
+    # Input Parameters
+    # bgp_nbr_data: neighbor info as returned by REST
+    # Output Parameters
+    # Compact neighbor info, see Structure of bgp neighbor dict below
+    def compact_bgp_neighbor(self, bgp_nbr_data):
+        '''Function to reduce the REST neighbor info to the monitored
+         fields'''
+        status = bgp_nbr_data["status"]
+        statistics = bgp_nbr_data.get("statistics")
+
+        bgp_peer_uptime = 0
+        bgp_peer_established_count = 0
+        if statistics:
+            bgp_peer_uptime = statistics["bgp_peer_uptime"]
+            bgp_peer_established_count = \
+                statistics["bgp_peer_established_count"]
+
+        bgp_local_interface = "None"
+        if bgp_nbr_data.get('local_interface'):
+            bgp_local_interface = list(
+                bgp_nbr_data["local_interface"].keys())[0]
+
+        bgp_update_source = "None"
+        if bgp_nbr_data.get('update_source'):
+            bgp_update_source = bgp_nbr_data["update_source"]
+
+        return {
+            "bgp_peer_state": status["bgp_peer_state"],
+            "bgp_peer_uptime": bgp_peer_uptime,
+            "bgp_peer_last_err_rx": status.get(
+                "bgp_rcvd_err_code", "No Error"),
+            "bgp_peer_last_err_tx": status.get(
+                "bgp_sent_err_code", "No Error"),
+            "bgp_peer_last_sub_err_rx": status.get(
+                "bgp_rcvd_err_sub_code", "No Error"),
+            "bgp_peer_last_sub_err_tx": status.get(
+                "bgp_sent_err_sub_code", "No Error"),
+            "bgp_peer_established_count": bgp_peer_established_count,
+            "bgp_local_interface": bgp_local_interface,
+            "bgp_update_source": bgp_update_source}
 
     # Function to fetch bgp neighbor response and handle it
     def handle_bgp_data(self):
@@ -2200,14 +3825,7 @@ class BGPAgent:
         response_dict = {}
         final_response = None
 
-        if 'is_bgp_supported' not in self.agent.variables:
-            self.agent.variables['is_bgp_supported'] = (
-                self.check_bgp_supported()
-            )
-
-        bgp_supported = self.agent.variables['is_bgp_supported']
-
-        if bgp_supported == "true":
+        if self.agent.capabilities.configured('bgp'):
             response = self.agent.fetch_url(self.unique_vrf_base_url)
             dprint("unique_vrf_base_url={}".format(self.unique_vrf_base_url))
             dprint("response unique_vrf_base_url={}".format(response))
@@ -2356,67 +3974,12 @@ class BGPAgent:
         res = {} if res is None else res
         bgp_nbr_dict_new = {}
         bgp_nbr_count = 0
-        for bgp_nbr_key in res:
+        for bgp_nbr_key, bgp_nbr_data in res.items():
             bgp_nbr_count += 1
-            bgp_peer_state = res[bgp_nbr_key]["status"]["bgp_peer_state"]
-            bgp_peer_uptime = 0
-            if res[bgp_nbr_key]["statistics"]:
-                bgp_peer_uptime = res[bgp_nbr_key]["statistics"]["bgp_peer_uptime"]
-
-            bgp_local_interface = "None"
-            if 'local_interface' in res[bgp_nbr_key] and res[bgp_nbr_key]['local_interface']:
-                bgp_local_interface = list(
-                    res[bgp_nbr_key]["local_interface"].keys())[0]
-
-            bgp_update_source = "None"
-            if 'update_source' in res[bgp_nbr_key] and res[bgp_nbr_key]['update_source']:
-                bgp_update_source = res[bgp_nbr_key]["update_source"]
-
-            if "bgp_rcvd_err_code" in res[bgp_nbr_key]["status"]:
-                bgp_peer_last_err_rx = res[bgp_nbr_key]["status"][
-                    "bgp_rcvd_err_code"]
-            else:
-                bgp_peer_last_err_rx = "No Error"
-
-            if "bgp_rcvd_err_sub_code" in res[bgp_nbr_key]["status"]:
-                bgp_peer_last_sub_err_rx = res[bgp_nbr_key]["status"][
-                    "bgp_rcvd_err_sub_code"]
-            else:
-                bgp_peer_last_sub_err_rx = "No Error"
-
-            if "bgp_sent_err_code" in res[bgp_nbr_key]["status"]:
-                bgp_peer_last_err_tx = res[bgp_nbr_key]["status"][
-                    "bgp_sent_err_code"]
-            else:
-                bgp_peer_last_err_tx = "No Error"
+            bgp_nbr_dict_new[bgp_nbr_key] = dict(
+                bgp_nbr_data, bgp_peer_stuck_state="None")
 
-            if "bgp_sent_err_sub_code" in res[bgp_nbr_key]["status"]:
-                bgp_peer_last_sub_err_tx = res[bgp_nbr_key]["status"][
-                    "bgp_sent_err_sub_code"]
-            else:
-                bgp_peer_last_sub_err_tx = "No Error"
-
-            bgp_peer_established_count = 0
-            if res[bgp_nbr_key]["statistics"]:
-                bgp_peer_established_count = res[bgp_nbr_key]["statistics"][
-                    "bgp_peer_established_count"
-                ]
-
-            bgp_peer_stuck_state = "None"
-
-            bgp_nbr_dict_new[bgp_nbr_key] = {
-                "bgp_peer_state": bgp_peer_state,
-                "bgp_peer_uptime": bgp_peer_uptime,
-                "bgp_peer_last_err_rx": bgp_peer_last_err_rx,
-                "bgp_peer_last_err_tx": bgp_peer_last_err_tx,
-                "bgp_peer_last_sub_err_rx": bgp_peer_last_sub_err_rx,
-                "bgp_peer_last_sub_err_tx": bgp_peer_last_sub_err_tx,
-                "bgp_peer_established_count": bgp_peer_established_count,
-                "bgp_local_interface": bgp_local_interface,
-                "bgp_update_source": bgp_update_source,
-                "bgp_peer_stuck_state": bgp_peer_stuck_state}
-
-        bgp_nbr_dict_old = json.loads(self.agent.variables["bgp_nbr_list"])
+        bgp_nbr_dict_old = self.nbr_store.load()
 
         dprint("---------------------------")
         dprint('BGP dict old:')
@@ -2432,24 +3995,31 @@ class BGPAgent:
                 bgp_nbr_dict_new[key]['bgp_update_source']))
         dprint("---------------------------")
 
-        self.monitor_bgp_nbr_state_changes(bgp_nbr_dict_old, bgp_nbr_dict_new)
-        self.monitor_bgp_nbr_stuck(bgp_nbr_dict_old, bgp_nbr_dict_new)
-        self.monitor_bgp_nbr_flaps(bgp_nbr_dict_old, bgp_nbr_dict_new)
-        self.monitor_bgp_nbr_add_delete(bgp_nbr_dict_old, bgp_nbr_dict_new)
+        events = self.diff_bgp_neighbors(bgp_nbr_dict_old, bgp_nbr_dict_new)
+        self.monitor_bgp_nbr_state_changes(events[BGP_NBR_STATE_CHANGE])
+        self.monitor_bgp_nbr_stuck(events[BGP_NBR_STUCK])
+        self.monitor_bgp_nbr_flaps(events[BGP_NBR_FLAP])
+        self.monitor_bgp_nbr_add_delete(events[BGP_NBR_ADDED],
+                                        events[BGP_NBR_DELETED])
 
         if self.agent.variables['bgp_nbr_alert'] == "false":
-            self.monitor_bgp_nbr_errors(bgp_nbr_dict_old, bgp_nbr_dict_new)
+            self.monitor_bgp_nbr_errors(events[BGP_NBR_NEW_ERROR])
 
         # All common BGP alerts to be invoked here
         if self.agent.variables['bgp_nbr_alert'] == "true":
-            self.action.add("show bgp all-vrf all summary")
-
-        self.agent.actions_ospf_bgp.update(self.action)
+            self.agent.planner.request_cli(BGP, self.alm.max_alert(
+                self.alm.alert_levels_generated_within_poll_per_subagent[
+                    'bgp']), ["show bgp all-vrf all summary"])
 
         # dprint("Test BGP-State change, time-out and error codes for"
         #        "adjacency")
 
-        self.agent.variables['bgp_nbr_list'] = json.dumps(bgp_nbr_dict_new)
+        # The uptime is only compared while a neighbor is down, dropping it
+        # otherwise keeps established neighbors out of the stored delta
+        for bgp_nbr_data in bgp_nbr_dict_new.values():
+            if bgp_nbr_data["bgp_peer_state"] == "Established":
+                bgp_nbr_data["bgp_peer_uptime"] = 0
+        self.nbr_store.save(bgp_nbr_dict_new)
         self.agent.variables['bgp_nbr_count'] = str(bgp_nbr_count)
         self.agent.variables['bgp_nbr_alert'] = "false"
 
@@ -2464,645 +4034,250 @@ class BGPAgent:
         bgp_peer_established_count,
         bgp_peer_last_sub_err_rx,
         bgp_peer_last_sub_err_tx,
+        bgp_local_interface,
+        bgp_update_source,
         bgp_peer_stuck_state
     }
     '''
 
     def update_action_cli(self, bgp_peer_addr, vrf, update_source,
                           local_interface, alert_level):
-        '''Function to update the action CLIs to the action set'''
+        '''Function to request the action CLIs from the planner'''
         self.alm.alert_levels_generated_within_poll_per_subagent[
             'bgp'].add(alert_level)
         self.agent.variables['bgp_nbr_alert'] = "true"
         self.bgp_alert_on_this_cycle = True
+        commands = []
         if type(ip_address(bgp_peer_addr)) is IPv4Address:
-            self.action.add("show ip route {0} vrf {1}".format(
+            commands.append("show ip route {0} vrf {1}".format(
                 bgp_peer_addr, vrf))
             if update_source != "None":
-                self.action.add("ping {0} source {1} vrf {2} repetitions 2"
+                commands.append("ping {0} source {1} vrf {2} repetitions 2"
                                 .format(bgp_peer_addr, update_source, vrf))
             elif local_interface != "None":
-                self.action.add("ping {0} source {1} vrf {2} repetitions 2"
+                commands.append("ping {0} source {1} vrf {2} repetitions 2"
                                 .format(bgp_peer_addr, local_interface, vrf))
             else:
-                self.action.add("ping {0} vrf {1} repetitions 2".format(
+                commands.append("ping {0} vrf {1} repetitions 2".format(
                     bgp_peer_addr, vrf))
-            self.action.add("traceroute {0} vrf {1} probes 1 maxttl 6".format(
+            commands.append("traceroute {0} vrf {1} probes 1 maxttl 6".format(
                 bgp_peer_addr, vrf))
 
         else:
-            self.action.add("show ipv6 route {0} vrf {1}".format(
+            commands.append("show ipv6 route {0} vrf {1}".format(
                 bgp_peer_addr, vrf))
             if update_source != "None":
-                self.action.add("ping6 {0} source {1} vrf {2} repetitions 2"
+                commands.append("ping6 {0} source {1} vrf {2} repetitions 2"
                                 .format(bgp_peer_addr, update_source, vrf))
             elif local_interface != "None":
-                self.action.add("ping6 {0} source {1} vrf {2} repetitions 2"
+                commands.append("ping6 {0} source {1} vrf {2} repetitions 2"
                                 .format(bgp_peer_addr, local_interface, vrf))
             else:
-                self.action.add("ping6 {0} vrf {1} repetitions 2".format(
+                commands.append("ping6 {0} vrf {1} repetitions 2".format(
                     bgp_peer_addr, vrf))
-            self.action.add("traceroute6 {0} vrf {1} probes 1 maxttl 6".format(
+            commands.append("traceroute6 {0} vrf {1} probes 1 maxttl 6".format(
                 bgp_peer_addr, vrf))
+        self.agent.planner.request_cli(BGP, alert_level, commands)
 
-    # Function to monitor bgp neighbor state changes
+    # Function to diff the bgp neighbor dictionaries of the previous and
+    # current cycle in a single pass. The events are grouped per type so the
+    # detectors below only visit the neighbors which changed.
     # Input Parameters
     # bgp_nbr_dict_old: Data structure conatining neighbor dictionary of
     #                   previous cycle
     # bgp_nbr_dict_new: Data structure conatining neighbor dictionary of
     #                   current cycle
-    def monitor_bgp_nbr_state_changes(self, bgp_nbr_dict_old,
-                                      bgp_nbr_dict_new):
-        '''Function to monitor bgp neighbor state changes'''
-        for bgp_nbr_key in bgp_nbr_dict_new:
-            if bgp_nbr_key in bgp_nbr_dict_old:
-                vrf = bgp_nbr_key.split("/")[0]
-                bgp_peer_addr = bgp_nbr_key.split("/")[1]
-                update_source = bgp_nbr_dict_old[bgp_nbr_key][
-                    'bgp_update_source']
-                local_interface = bgp_nbr_dict_old[bgp_nbr_key][
-                    'bgp_local_interface']
-
-                # Detecting if any BGP neighbor is not in Established state
-                # This is mainly for clearing the alert
-                if (bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"] !=
-                   "Established"):
-                    self.bgp_neighbor_not_in_stable_state = True
-
-                # Detecting a neighbor's state change from established to idle
-                if (
-                        bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Established"
-                        and bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Idle"
-                ):
-                    self.update_action_cli(
-                        bgp_peer_addr, vrf, update_source, local_interface,
-                        AlertLevel.CRITICAL)
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'BGP Peer {0} state changed from Established to Idle. '
-                        'Last Error Sent - {1} , '
-                        'Last Sub Error Sent - {2} ,'
-                        'Last Error Received - {3} , '
-                        'Last Sub Error Received - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, 'BGP Peer {0} state changed from Established to Idle'.format(bgp_peer_addr))
-                    self.agent.logger.debug(
-                        'For debugging: BGP Peer {0} '
-                        'changed from Established to Idle'.format(
-                            bgp_peer_addr
-                        )
-                    )
+    # Output Parameters
+    # events: dict of event type to list of events
+    #   BGP_NBR_ADDED, BGP_NBR_DELETED, BGP_NBR_STATE_CHANGE, BGP_NBR_FLAP,
+    #   BGP_NBR_STUCK : (bgp_nbr_key, nbr_old, nbr_new)
+    #   BGP_NBR_NEW_ERROR : (bgp_nbr_key, nbr_old, nbr_new, direction) with
+    #                       direction "tx" or "rx"
+    def diff_bgp_neighbors(self, bgp_nbr_dict_old, bgp_nbr_dict_new):
+        '''Function to diff the bgp neighbor dictionaries in a single pass'''
+        events = {event_type: [] for event_type in BGP_NBR_EVENTS}
+        for bgp_nbr_key, nbr_new in bgp_nbr_dict_new.items():
+            nbr_old = bgp_nbr_dict_old.get(bgp_nbr_key)
+            if nbr_old is None:
+                events[BGP_NBR_ADDED].append((bgp_nbr_key, None, nbr_new))
+                continue
 
-                # Detecting a neighbor's state change from established to
-                # connect
-                elif (
-                        bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Established"
-                        and bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Connect"
-                ):
-                    self.update_action_cli(
-                        bgp_peer_addr, vrf, update_source, local_interface,
-                        AlertLevel.CRITICAL
-                    )
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        "BGP Peer {0} state changed from Established to "
-                        "Connect. "
-                        "Last Error Sent - {1} "
-                        "Last Sub Error Sent - {2}, "
-                        "Last Error Received - {3} "
-                        "Last Sub Error Received - {4}".format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, "BGP Peer {0} state changed from Established to Connect".format(bgp_peer_addr))
-                    self.agent.logger.debug(
-                        "For debugging: BGP Peer {0} changed from "
-                        "Established to Connect".format(
-                            bgp_peer_addr
-                        )
-                    )
+            state_old = nbr_old["bgp_peer_state"]
+            state_new = nbr_new["bgp_peer_state"]
+            established_count_unchanged = (
+                nbr_new["bgp_peer_established_count"] ==
+                nbr_old["bgp_peer_established_count"])
+
+            # Detecting if any BGP neighbor is not in Established state
+            # This is mainly for clearing the alert
+            if state_new != "Established":
+                self.bgp_neighbor_not_in_stable_state = True
+
+            if state_old != state_new:
+                # Detecting a neighbor going down from established
+                if (state_old == "Established" and
+                        state_new in BGP_NBR_DOWN_STATES):
+                    events[BGP_NBR_STATE_CHANGE].append(
+                        (bgp_nbr_key, nbr_old, nbr_new))
+            elif state_new == "Established":
+                # Detecting if neighbor is flapping
+                if (nbr_new["bgp_peer_established_count"] >
+                        nbr_old["bgp_peer_established_count"]):
+                    events[BGP_NBR_FLAP].append(
+                        (bgp_nbr_key, nbr_old, nbr_new))
+            elif state_new in BGP_NBR_DOWN_STATES:
+                # Detecting a neighbor being stuck. An Idle neighbor is not
+                # retrying, its uptime may not move
+                uptime_new = nbr_new["bgp_peer_uptime"]
+                uptime_old = nbr_old["bgp_peer_uptime"]
+                if established_count_unchanged and (
+                        uptime_new > uptime_old or
+                        (state_new == "Idle" and uptime_new == uptime_old)):
+                    if nbr_old["bgp_peer_stuck_state"] != state_new:
+                        events[BGP_NBR_STUCK].append(
+                            (bgp_nbr_key, nbr_old, nbr_new))
+                    nbr_new["bgp_peer_stuck_state"] = state_new
+
+            for direction in ("tx", "rx"):
+                err = nbr_new["bgp_peer_last_err_" + direction]
+                if (err != "No Error" and
+                        err != nbr_old["bgp_peer_last_err_" + direction]):
+                    events[BGP_NBR_NEW_ERROR].append(
+                        (bgp_nbr_key, nbr_old, nbr_new, direction))
+
+        for bgp_nbr_key, nbr_old in bgp_nbr_dict_old.items():
+            if bgp_nbr_key not in bgp_nbr_dict_new:
+                events[BGP_NBR_DELETED].append((bgp_nbr_key, nbr_old, None))
+        return events
+
+    # Function to format the last errors of a bgp neighbor for the syslogs
+    def format_bgp_nbr_errors(self, nbr):
+        '''Function to format the last errors of a bgp neighbor'''
+        return ('Last Error Sent - {0} '
+                'Last Sub Error Sent - {1}, '
+                'Last Error Received - {2} '
+                'Last Sub Error Received - {3}'.format(
+                    nbr["bgp_peer_last_err_tx"],
+                    nbr["bgp_peer_last_sub_err_tx"],
+                    nbr["bgp_peer_last_err_rx"],
+                    nbr["bgp_peer_last_sub_err_rx"]))
 
-                # Detecting a neighbor's state change from established to active
-                elif (
-                        bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Established"
-                        and bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Active"
-                ):
-                    self.update_action_cli(
-                        bgp_peer_addr, vrf, update_source, local_interface,
-                        AlertLevel.CRITICAL
-                    )
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'BGP Peer {0} state changed from Established to '
-                        'Active. '
-                        'Last Error Sent - {1} '
-                        'Last Sub Error Sent - {2}, '
-                        'Last Error Received - {3} '
-                        'Last Sub Error Received - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, "BGP Peer {0} state changed from Established to Active".format(bgp_peer_addr))
-                    self.agent.logger.debug("For debugging: BGP Peer {0} "
-                                            "changed from Established"
-                                            " to Active".format(bgp_peer_addr))
-                # Detecting a neighbor's state change from established to
-                # openconfirm
-                elif (
-                        bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                        "Established"
-                        and
-                        bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"] ==
-                        "OpenConfirm"
-                ):
-                    self.update_action_cli(bgp_peer_addr, vrf, update_source,
-                                           local_interface, AlertLevel.CRITICAL
-                                           )
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'BGP Peer {0} state changed from Established to'
-                        ' OpenConfirm. '
-                        'Last Error Sent - {1} '
-                        'Last Sub Error Sent - {2}, '
-                        'Last Error Received - {3} '
-                        'Last Sub Error Received - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, "BGP Peer {0} state changed from Established to OpenConfirm".format(bgp_peer_addr))
-                    self.agent.logger.debug("For debugging: BGP Peer {0} "
-                                            "changed from Established to "
-                                            "OpenConfirm".format(bgp_peer_addr)
-                                            )
+    # Function to monitor bgp neighbor state changes
+    # Input Parameters
+    # events: BGP_NBR_STATE_CHANGE events of diff_bgp_neighbors
+    def monitor_bgp_nbr_state_changes(self, events):
+        '''Function to monitor bgp neighbor state changes'''
+        for bgp_nbr_key, nbr_old, nbr_new in events:
+            vrf, bgp_peer_addr = bgp_nbr_key.split("/")
+            state_new = nbr_new["bgp_peer_state"]
+            self.update_action_cli(
+                bgp_peer_addr, vrf, nbr_old['bgp_update_source'],
+                nbr_old['bgp_local_interface'], AlertLevel.CRITICAL)
+            self.agent.action_syslog(
+                Log.WARNING,
+                'BGP Peer {0} state changed from Established to {1}. '
+                '{2}'.format(bgp_peer_addr, state_new,
+                             self.format_bgp_nbr_errors(nbr_new)))
+            self.agent.set_alert_description_for_key(
+                BGP, 'BGP Peer {0} state changed from Established to '
+                '{1}'.format(bgp_peer_addr, state_new))
+            self.agent.logger.debug(
+                'For debugging: BGP Peer {0} changed from Established to '
+                '{1}'.format(bgp_peer_addr, state_new))
 
     # Function to monitor bgp neighbor in stuck state
     # Input Parameters
-    # bgp_nbr_dict_old: Data structure conatining neighbor dictionary of
-    #                   previous cycle
-    # bgp_nbr_dict_new: Data structure conatining neighbor dictionary of
-    #                   current cycle
-    def monitor_bgp_nbr_stuck(self, bgp_nbr_dict_old, bgp_nbr_dict_new):
+    # events: BGP_NBR_STUCK events of diff_bgp_neighbors
+    def monitor_bgp_nbr_stuck(self, events):
         '''Function to monitor bgp neighbor in stuck state'''
-        for bgp_nbr_key in bgp_nbr_dict_new:
-            if bgp_nbr_key in bgp_nbr_dict_old:
-                vrf = bgp_nbr_key.split("/")[0]
-                bgp_peer_addr = bgp_nbr_key.split("/")[1]
-                update_source = bgp_nbr_dict_old[bgp_nbr_key][
-                    "bgp_update_source"]
-                local_interface = bgp_nbr_dict_old[bgp_nbr_key][
-                    "bgp_local_interface"]
-
-                # Detecting a neighbor being stuck in idle
-                if (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                            "Idle"
-                            and bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_state"] == "Idle"
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_uptime"]
-                            >= bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_uptime"]
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                            == bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                        )
-                ):
-                    if (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_stuck_state"] != "Idle"
-                    ):
-                        self.update_action_cli(
-                            bgp_peer_addr,
-                            vrf,
-                            update_source,
-                            local_interface,
-                            AlertLevel.MINOR,
-                        )
-                        self.agent.action_syslog(
-                            Log.WARNING,
-                            'BGP Peer {0} stuck in Idle state. '
-                            'Last Error Sent - {1} '
-                            'Last Sub Error Sent - {2}, '
-                            'Last Error Received - {3} '
-                            'Last Sub Error Received - {4}'.format(
-                                bgp_peer_addr,
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_rx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_rx"],
-                            ),
-                        )
-                        self.agent.set_alert_description_for_key(
-                            BGP, 'BGP Peer {0} stuck in Idle'.format(bgp_peer_addr))
-                        self.agent.logger.debug(
-                            "For debugging: BGP Peer {0} stuck in Idle "
-                            "State".format(
-                                bgp_peer_addr
-                            )
-                        )
-                    bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_stuck_state"] = \
-                        "Idle"
-                # Detecting a neighbor being stuck in connect
-                elif (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                            "Connect"
-                            and bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_state"] == "Connect"
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_uptime"]
-                            > bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_uptime"]
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                            == bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                        )
-                ):
-                    if (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_stuck_state"] != "Connect"
-                    ):
-                        self.update_action_cli(
-                            bgp_peer_addr,
-                            vrf,
-                            update_source,
-                            local_interface,
-                            AlertLevel.MINOR,
-                        )
-                        self.agent.action_syslog(
-                            Log.WARNING,
-                            'BGP Peer {0} stuck in Connect state. '
-                            'Last Error Sent - {1} '
-                            'Last Sub Error Sent - {2}, '
-                            'Last Error Received - {3} '
-                            'Last Sub Error Received - {4}'.format(
-                                bgp_peer_addr,
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_rx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_rx"],
-                            ),
-                        )
-                        self.agent.set_alert_description_for_key(
-                            BGP, 'BGP Peer {0} stuck in Connect'.format(bgp_peer_addr))
-                        self.agent.logger.debug(
-                            "For debugging: BGP Peer {0} stuck in Connect "
-                            "State".format(
-                                bgp_peer_addr
-                            )
-                        )
-                    bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_stuck_state"] = \
-                        "Connect"
-                # Detecting a neighbor being stuck in active
-                elif (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_state"] == "Active"
-                            and bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_state"] == "Active"
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_uptime"]
-                            > bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_uptime"]
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                            == bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                        )
-                ):
-                    if (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_stuck_state"] != "Active"
-                    ):
-                        self.update_action_cli(
-                            bgp_peer_addr,
-                            vrf,
-                            update_source,
-                            local_interface,
-                            AlertLevel.MINOR,
-                        )
-                        self.agent.action_syslog(
-                            Log.WARNING,
-                            'BGP Peer {0} stuck in Active state. '
-                            'Last Error Sent - {1} '
-                            'Last Sub Error Sent - {2}, '
-                            'Last Error Received - {3} '
-                            'Last Sub Error Received - {4}'.format(
-                                bgp_peer_addr,
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_rx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_rx"],
-                            ),
-                        )
-                        self.agent.set_alert_description_for_key(
-                            BGP, 'BGP Peer {0} stuck in Active'.format(bgp_peer_addr))
-                        self.agent.logger.debug(
-                            "For debugging: BGP Peer {0} stuck in Active "
-                            "State".format(
-                                bgp_peer_addr
-                            )
-                        )
-                    bgp_nbr_dict_new[bgp_nbr_key][
-                        "bgp_peer_stuck_state"] = "Active"
-                # Detecting a neighbor being stuck in openConfirm
-                elif (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_state"] ==
-                            "OpenConfirm"
-                            and bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_state"]
-                            == "OpenConfirm"
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key]["bgp_peer_uptime"]
-                            > bgp_nbr_dict_old[bgp_nbr_key]["bgp_peer_uptime"]
-                        )
-                        and (
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                            == bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                        )
-                ):
-                    if (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_stuck_state"] != "OpenConfirm"
-                    ):
-                        self.update_action_cli(
-                            bgp_peer_addr,
-                            vrf,
-                            update_source,
-                            local_interface,
-                            AlertLevel.MINOR,
-                        )
-                        self.agent.action_syslog(
-                            Log.WARNING,
-                            'BGP Peer {0} stuck in OpenConfirm state. '
-                            'Last Error Sent - {1} '
-                            'Last Sub Error Sent - {2}, '
-                            'Last Error Received - {3} '
-                            'Last Sub Error Received - {4}'.format(
-                                bgp_peer_addr,
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_tx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_err_rx"],
-                                bgp_nbr_dict_new[bgp_nbr_key][
-                                    "bgp_peer_last_sub_err_rx"],
-                            ),
-                        )
-                        self.agent.set_alert_description_for_key(
-                            BGP, 'BGP Peer {0} stuck in OpenConfirm'.format(bgp_peer_addr))
-                        self.agent.logger.debug(
-                            "For debugging: BGP Peer {0} stuck in OpenConfirm "
-                            "State".format(
-                                bgp_peer_addr
-                            )
-                        )
-                    bgp_nbr_dict_new[bgp_nbr_key][
-                        "bgp_peer_stuck_state"] = "OpenConfirm"
+        for bgp_nbr_key, nbr_old, nbr_new in events:
+            vrf, bgp_peer_addr = bgp_nbr_key.split("/")
+            state_new = nbr_new["bgp_peer_state"]
+            self.update_action_cli(
+                bgp_peer_addr, vrf, nbr_old["bgp_update_source"],
+                nbr_old["bgp_local_interface"], AlertLevel.MINOR)
+            self.agent.action_syslog(
+                Log.WARNING,
+                'BGP Peer {0} stuck in {1} state. {2}'.format(
+                    bgp_peer_addr, state_new,
+                    self.format_bgp_nbr_errors(nbr_new)))
+            self.agent.set_alert_description_for_key(
+                BGP, 'BGP Peer {0} stuck in {1}'.format(
+                    bgp_peer_addr, state_new))
+            self.agent.logger.debug(
+                "For debugging: BGP Peer {0} stuck in {1} State".format(
+                    bgp_peer_addr, state_new))
 
     # Function to monitor bgp neighbor flapping
     # Input Parameters
-    # bgp_nbr_dict_old: Data structure conatining neighbor dictionary of
-    #                   previous cycle
-    # bgp_nbr_dict_new: Data structure conatining neighbor dictionary of
-    #                   current cycle
-    def monitor_bgp_nbr_flaps(self, bgp_nbr_dict_old, bgp_nbr_dict_new):
+    # events: BGP_NBR_FLAP events of diff_bgp_neighbors
+    def monitor_bgp_nbr_flaps(self, events):
         '''Function to monitor bgp neighbor flapping'''
-        for bgp_nbr_key in bgp_nbr_dict_new:
-            if bgp_nbr_key in bgp_nbr_dict_old:
-                vrf = bgp_nbr_key.split("/")[0]
-                bgp_peer_addr = bgp_nbr_key.split("/")[1]
-                update_source = bgp_nbr_dict_old[bgp_nbr_key][
-                    'bgp_update_source']
-                local_interface = bgp_nbr_dict_old[bgp_nbr_key][
-                    'bgp_local_interface']
-                # Detecting if neighbor is flapping
-                if (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_state"] == "Established"
-                            and bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_state"] == "Established"
-                        ) and (
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                            > bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_established_count"]
-                        )
-                ):
-                    self.update_action_cli(
-                        bgp_peer_addr, vrf, update_source, local_interface,
-                        AlertLevel.MAJOR
-                    )
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'BGP Peer {0} adjacency went down and came back up. '
-                        'Last Error Sent - {1} '
-                        'Last Sub Error Sent - {2}, '
-                        'Last Error Received - {3} '
-                        'Last Sub Error Received - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, 'BGP Peer {0} adjacency went down and came back up'.format(bgp_peer_addr))
-                    self.agent.logger.debug(
-                        'For debugging: BGP Peer {0} adjacency went down '
-                        'and came back up'.format(
-                            bgp_peer_addr
-                        )
-                    )
+        for bgp_nbr_key, nbr_old, nbr_new in events:
+            vrf, bgp_peer_addr = bgp_nbr_key.split("/")
+            self.update_action_cli(
+                bgp_peer_addr, vrf, nbr_old['bgp_update_source'],
+                nbr_old['bgp_local_interface'], AlertLevel.MAJOR)
+            self.agent.action_syslog(
+                Log.WARNING,
+                'BGP Peer {0} adjacency went down and came back up. '
+                '{1}'.format(bgp_peer_addr,
+                             self.format_bgp_nbr_errors(nbr_new)))
+            self.agent.set_alert_description_for_key(
+                BGP, 'BGP Peer {0} adjacency went down and came back '
+                'up'.format(bgp_peer_addr))
+            self.agent.logger.debug(
+                'For debugging: BGP Peer {0} adjacency went down '
+                'and came back up'.format(bgp_peer_addr))
 
     # Function to monitor bgp neighbor errors
     # Input Parameters
-    # bgp_nbr_dict_old: Data structure conatining neighbor dictionary of
-    #                   previous cycle
-    # bgp_nbr_dict_new: Data structure conatining neighbor dictionary of
-    #                   current cycle
-    def monitor_bgp_nbr_errors(self, bgp_nbr_dict_old, bgp_nbr_dict_new):
+    # events: BGP_NBR_NEW_ERROR events of diff_bgp_neighbors
+    def monitor_bgp_nbr_errors(self, events):
         '''Function to monitor bgp neighbor errors'''
-        for bgp_nbr_key in bgp_nbr_dict_new:
-            if bgp_nbr_key in bgp_nbr_dict_old:
-                bgp_peer_addr = bgp_nbr_key.split("/")[1]
-                if (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"]
-                            != bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"]
-                        ) and (bgp_nbr_dict_new[bgp_nbr_key][
-                            "bgp_peer_last_err_tx"] != "No Error")
-                ):
-                    self.alm.alert_levels_generated_within_poll_per_subagent[
-                        'bgp'].add(AlertLevel.MINOR)
-                    self.agent.variables["bgp_nbr_alert"] = "true"
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'New Error sent to BGP Peer {0}. '
-                        'Previous Error Sent - {1} '
-                        'Previous Sub Error Sent - {2}, '
-                        'Current Error Sent - {3} '
-                        'Current Sub Error Sent - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_tx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, 'New Error sent to BGP Peer {0}'.format(bgp_peer_addr))
-                    self.agent.logger.debug(
-                        'For debugging: Previous Error Sent {0} '
-                        'Current Error Sent {1} to BGP Peer {2}'.format(
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_tx"],
-                            bgp_peer_addr,
-                        )
-                    )
-                if (
-                        (
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"]
-                            != bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"]
-                        ) and bgp_nbr_dict_new[bgp_nbr_key][
-                            "bgp_peer_last_err_rx"] != "No Error"
-                ):
-                    self.alm.alert_levels_generated_within_poll_per_subagent[
-                        'bgp'].add(AlertLevel.MINOR)
-                    self.agent.variables["bgp_nbr_alert"] = "true"
-                    self.agent.action_syslog(
-                        Log.WARNING,
-                        'New Error received from BGP Peer {0}. '
-                        'Previous Error Received - {1} '
-                        'Previous Sub Error Received - {2}, '
-                        'Current Error Received - {3} '
-                        'Current Sub Error Received - {4}'.format(
-                            bgp_peer_addr,
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_sub_err_rx"],
-                        ),
-                    )
-                    self.agent.set_alert_description_for_key(
-                        BGP, 'New Error received from BGP Peer {0}'.format(bgp_peer_addr))
-                    self.agent.logger.debug(
-                        'For debugging: Previous Error Received - {0} '
-                        'Current Error Received - {1} '
-                        'from BGP Peer {2}'.format(
-                            bgp_nbr_dict_old[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_nbr_dict_new[bgp_nbr_key][
-                                "bgp_peer_last_err_rx"],
-                            bgp_peer_addr,
-                        )
-                    )
+        for bgp_nbr_key, nbr_old, nbr_new, direction in events:
+            bgp_peer_addr = bgp_nbr_key.split("/")[1]
+            if direction == "tx":
+                summary = 'New Error sent to BGP Peer {0}'
+                detail = ('Previous Error Sent - {1} '
+                          'Previous Sub Error Sent - {2}, '
+                          'Current Error Sent - {3} '
+                          'Current Sub Error Sent - {4}')
+                debug = ('For debugging: Previous Error Sent {0} '
+                         'Current Error Sent {1} to BGP Peer {2}')
+            else:
+                summary = 'New Error received from BGP Peer {0}'
+                detail = ('Previous Error Received - {1} '
+                          'Previous Sub Error Received - {2}, '
+                          'Current Error Received - {3} '
+                          'Current Sub Error Received - {4}')
+                debug = ('For debugging: Previous Error Received - {0} '
+                         'Current Error Received - {1} '
+                         'from BGP Peer {2}')
+            err = "bgp_peer_last_err_" + direction
+            sub_err = "bgp_peer_last_sub_err_" + direction
+
+            self.alm.alert_levels_generated_within_poll_per_subagent[
+                'bgp'].add(AlertLevel.MINOR)
+            self.agent.variables["bgp_nbr_alert"] = "true"
+            self.agent.action_syslog(
+                Log.WARNING,
+                (summary + '. ' + detail).format(
+                    bgp_peer_addr, nbr_old[err], nbr_old[sub_err],
+                    nbr_new[err], nbr_new[sub_err]))
+            self.agent.set_alert_description_for_key(
+                BGP, summary.format(bgp_peer_addr))
+            self.agent.logger.debug(
+                debug.format(nbr_old[err], nbr_new[err], bgp_peer_addr))
 
     # Function to track BGP neighbors getting added and expired
     # Input Parameters
-    # bgp_nbr_dict_old : Data structure conatining neighbor dictionary of
-    #                    previous poll cycle
-    # bgp_nbr_dict_new : Data structure conatining neighbor dictionary of
-    #                    current poll cycle
-    def monitor_bgp_nbr_add_delete(self, bgp_nbr_dict_old, bgp_nbr_dict_new):
+    # added_events : BGP_NBR_ADDED events of diff_bgp_neighbors
+    # deleted_events : BGP_NBR_DELETED events of diff_bgp_neighbors
+    def monitor_bgp_nbr_add_delete(self, added_events, deleted_events):
         '''Function to monitor BGP nbr added/ deleted'''
-        neighbors_new = set(bgp_nbr_dict_new.keys()).difference(
-            set(bgp_nbr_dict_old.keys()))
-        neighbors_deleted = set(bgp_nbr_dict_old.keys()).difference(
-            set(bgp_nbr_dict_new.keys()))
-
-        for key in neighbors_new:
-            vrf = key.split("/")[0]
-            bgp_peer_addr = key.split("/")[1]
+        for key, _, _ in added_events:
+            vrf, bgp_peer_addr = key.split("/")
             self.agent.action_syslog(Log.WARNING,
                                      "New BGP Peer configured [Peer: {0} "
                                      "VRF: {1}]"
@@ -3113,11 +4288,10 @@ class BGPAgent:
                 "BGP-Neighbor-Monitor: BGP Peer configured [Neighbor: {0} "
                 "VRF: {1}]".format(bgp_peer_addr, vrf))
 
-        for key in neighbors_deleted:
-            vrf = key.split("/")[0]
-            bgp_peer_addr = key.split("/")[1]
-            update_source = bgp_nbr_dict_old[key]["bgp_update_source"]
-            local_interface = bgp_nbr_dict_old[key]["bgp_local_interface"]
+        for key, nbr_old, _ in deleted_events:
+            vrf, bgp_peer_addr = key.split("/")
+            update_source = nbr_old["bgp_update_source"]
+            local_interface = nbr_old["bgp_local_interface"]
             self.agent.action_syslog(Log.WARNING,
                                      "BGP Peer unconfigured [Peer: {0} "
                                      "VRF: {1}]"
@@ -3141,60 +4315,32 @@ class PrefixAgent(Agent):
         self.alm = alm
         self.prefix_alert_on_this_cycle = False
         self.action_prefix = set()
+        self.watch_table = compile_prefix_watch_table([])
+        # vrf to RouteIndex, kept across polls to be updated incrementally,
+        # and the version of the RouteSnapshot listing it was updated to
+        self.route_indexes = {}
+        self.route_index_versions = {}
 
-    def get_url_list(self, user_prefix_list):
-        '''Takes prefixes as input and generate
-         list of corresponding REST URI'''
-        dprint(user_prefix_list)
-        prefix_url_dict = {}
-        user_prefix_dict = {}
-        for ele in user_prefix_list:
-            prefix, vrf = ele.split('|')
-            if vrf not in user_prefix_dict.keys():
-                user_prefix_dict[vrf] = []
-            user_prefix_dict[vrf].append(prefix)
-        dprint(user_prefix_dict)
-        for vrf, prefix_list in user_prefix_dict.items():
-            url_first_half = HTTP_ADDRESS + URI_PREFIX_GET_V10_13 + 'system/vrfs/' + vrf
-            for prefix in prefix_list:
-                prefix_url_fmt = prefix.replace('/', '%2F')
-                prefix_url_fmt = prefix_url_fmt.replace(':', '%3A')
-                url_second_half = '/routes/' + prefix_url_fmt + '?depth=2'
-                url = url_first_half + url_second_half
-                count_url = url_first_half + '/routes/' + prefix_url_fmt + '?count=true'
-                key = prefix + '|' + vrf
-                if key not in prefix_url_dict.keys():
-                    prefix_url_dict[key] = []
-                prefix_url_dict[key].append(count_url)
-                prefix_url_dict[key].append(url)
-        dprint(prefix_url_dict)
-        # prefix_url_dict example:
-        # {
-        #     "default|10.0.0.1/32": [
-        #         "http://127.0.0.1:8080/rest/v10.08/system/vrfs/default/routes/10.0.0.1%2F32?count=true",
-        #         "http://127.0.0.1:8080/rest/v10.08/system/vrfs/default/routes/10.0.0.1%2F32?depth=2"
-        #     ],
-        #     "red|20.0.0.1/32": [
-        #         "http://127.0.0.1:8080/rest/v10.08/system/vrfs/red/routes/20.0.0.1%2F32?count=true",
-        #         "http://127.0.0.1:8080/rest/v10.08/system/vrfs/red/routes/20.0.0.1%2F32?depth=2"
-        #     ]
-        # }
-        return prefix_url_dict
-
-    def prefix_handler(self, user_prefix_list):
+    def prefix_handler(self, watch_table):
         '''Wrapper for collect_prefix_data. Invoked from main agent'''
         dprint("WIP------- prefix_handler")
 
-        if not self.agent.params['prefix_list'].value:
+        self.watch_table = watch_table
+        if not watch_table.entries:
             if json.loads(self.agent.variables['prefix_alert']) != AlertLevel.NONE:
                 dprint(
                     "prefix_list is None and prefix alert is raised. Bring back to normal")
                 self.prefix_set_alert_level(AlertLevel.NONE)
             return
 
-        prefix_url_list = self.get_url_list(user_prefix_list)
-        data = self.collect_prefix_data(prefix_url_list)
+        data = self.collect_prefix_data(watch_table)
         self.analyze_prefix_data(data)
+        if self.agent.params['prefix_lpm'].value == 'true':
+            self.monitor_covering_routes(watch_table)
+        self.agent.planner.request_cli(PREFIX, self.alm.max_alert(
+            self.alm.alert_levels_generated_within_poll_per_subagent[
+                'prefix']), self.action_prefix)
+        self.action_prefix = set()
 
         # bring the alert back to normal
         if not self.prefix_alert_on_this_cycle and json.loads(self.agent.variables['prefix_alert']) != AlertLevel.NONE:
@@ -3203,29 +4349,124 @@ class PrefixAgent(Agent):
             self.prefix_set_alert_level(AlertLevel.NONE)
 
     # Funtion to collect prefix Data
-    def collect_prefix_data(self, prefix_url_list):
+    def collect_prefix_data(self, watch_table):
         '''Fetch prefix from REST query and Analyze'''
         prefix_response_dict = {}
-
-        for key, url in prefix_url_list.items():
-            response = self.agent.fetch_url(url[0])
-            dprint("url: {0}".format(url[0]))
+        batch_max_routes = self.agent.params['prefix_batch_max_routes'].value
+        if batch_max_routes > 0:
+            prefix_response_dict = self.collect_prefix_data_per_vrf(
+                watch_table, batch_max_routes)
+
+        for entry in watch_table.entries:
+            # Prefixes found by the VRF queries
+            if entry.key in prefix_response_dict:
+                continue
+            response = self.agent.fetch_url(entry.count_url)
+            dprint("url: {0}".format(entry.count_url))
             # dprint("response: {0}".format(response))
-            prefix_response_dict[key] = {}
+            prefix_response_dict[entry.key] = {}
             if not response:
                 continue
             if int(response['count']) == 0:
                 continue
-            response = self.agent.fetch_url(url[1])
-            dprint("url: {0}".format(url[1]))
+            response = self.agent.fetch_url(entry.route_url)
+            dprint("url: {0}".format(entry.route_url))
             # dprint("response: {0}".format(response))
             if not response:
                 continue
-            prefix_response_dict[key] = response
+            prefix_response_dict[entry.key] = response
 
         dprint('prefix_response_dict = {0}'.format(prefix_response_dict))
         return prefix_response_dict
 
+    # Function to fetch the routes of the prefixes with one query per VRF
+    # holding several of them. A VRF with more than batch_max_routes routes
+    # is left to the per prefix queries, as are the prefixes not found.
+    # Input Parameters
+    # watch_table : PrefixWatchTable of the prefixes
+    # batch_max_routes : maximum number of routes of a VRF fetched at once
+    # Returns prefix|vrf to route dict of the prefixes found
+    def collect_prefix_data_per_vrf(self, watch_table, batch_max_routes):
+        '''Fetch the routes of the prefixes with one query per VRF'''
+        prefix_response_dict = {}
+        attributes = PREFIX_ROUTE_ATTRIBUTES.split(',')
+        for vrf, url, entries in watch_table.by_vrf:
+            # One prefix costs two queries either way
+            if len(entries) < 2:
+                continue
+            count = self.agent.routes.vrf_count(vrf)
+            if not count or count > batch_max_routes:
+                continue
+            _, response = self.agent.routes.vrf_routes(
+                vrf, RouteSnapshot.FULL, fresh=True)
+            dprint("url: {0}".format(url))
+            if not response:
+                continue
+            routes = {route['prefix']: route for route in response.values()}
+            for entry in entries:
+                route = routes.get(entry.prefix) or \
+                    routes.get(entry.network.with_prefixlen)
+                if route:
+                    prefix_response_dict[entry.key] = {
+                        key: route[key] for key in attributes if key in route}
+        return prefix_response_dict
+
+    # Function to track the route covering each prefix, i.e. its longest
+    # prefix match in the route table of its VRF. The route prefixes of each
+    # VRF are fetched with one query and applied to the RouteIndex of the
+    # VRF.
+    # Input Parameters
+    # watch_table : PrefixWatchTable of the prefixes
+    def monitor_covering_routes(self, watch_table):
+        '''Function to report changes of the routes covering the prefixes'''
+        covering_old = json.loads(
+            self.agent.variables['prefix_covering_routes'])
+        covering_new = {}
+        for vrf, url, entries in watch_table.by_vrf:
+            version, routes = self.agent.routes.vrf_routes(
+                vrf, RouteSnapshot.KEYS, fresh=True)
+            if routes is None:
+                # Keep the previous covering routes until the next poll
+                for entry in entries:
+                    if entry.key in covering_old:
+                        covering_new[entry.key] = covering_old[entry.key]
+                continue
+            if vrf not in self.route_indexes:
+                self.route_indexes[vrf] = RouteIndex()
+            route_index = self.route_indexes[vrf]
+            if self.route_index_versions.get(vrf) != version:
+                route_index.update(routes)
+                self.route_index_versions[vrf] = version
+            for entry in entries:
+                covering_new[entry.key] = route_index.lookup(entry.network)
+        # Indexes of VRFs no longer in prefix_list
+        for vrf in set(self.route_indexes) - \
+                set(vrf for vrf, _, _ in watch_table.by_vrf):
+            del self.route_indexes[vrf]
+            self.route_index_versions.pop(vrf, None)
+
+        dprint("covering routes: {0}".format(covering_new))
+        changes = []
+        for key, covering_route in covering_new.items():
+            if key in covering_old and covering_old[key] != covering_route:
+                changes.append("{0} from {1} to {2}".format(
+                    key, covering_old[key], covering_route))
+                self.prefix_cli_add(key)
+                if covering_route is not None:
+                    entry = watch_table.by_key[key]
+                    self.action_prefix.add("show {0} route {1} vrf {2}".format(
+                        'ipv6' if entry.family == 6 else 'ip',
+                        covering_route, entry.vrf))
+        if changes:
+            syslog = "Covering route changed for prefixes: {0}".format(
+                ', '.join(changes))
+            self.agent.action_syslog(Log.WARNING, syslog)
+            self.agent.set_alert_description_for_key(PREFIX, syslog)
+            self.prefix_alert_on_this_cycle = True
+            self.prefix_set_alert_level(AlertLevel.MINOR)
+        self.agent.variables['prefix_covering_routes'] = json.dumps(
+            covering_new)
+
     # Function to set alert levels
     # Input Parameters
     # level : alert level to be set(AlertLevel.MINOR, AlertLevel.MAJOR,
@@ -3337,13 +4578,14 @@ class PrefixAgent(Agent):
         self.get_prefixes_added_back_deleted(prefix_dict_old, prefix_dict_new)
         self.get_prefix_options_changes(prefix_dict_old, prefix_dict_new)
         self.get_nh_added_deleted(prefix_dict_old, prefix_dict_new)
-        self.agent.actions_ospf_bgp.update(self.action_prefix)
 
         self.agent.variables["prefix_instance_list"] = json.dumps(
             prefix_dict_new)
 
-    def prefix_cli_add(self, prefix, vrf):
-        if ':' in prefix:
+    def prefix_cli_add(self, key):
+        entry = self.watch_table.by_key[key]
+        prefix, vrf = entry.prefix, entry.vrf
+        if entry.family == 6:
             self.action_prefix.add("show ipv6 route summary all-vrfs")
             self.action_prefix.add("show ipv6 rib summary all-vrfs")
             self.action_prefix.add(
@@ -3417,9 +4659,8 @@ class PrefixAgent(Agent):
                 str(nh_added).replace("'", ""))
             self.agent.action_syslog(Log.WARNING, syslog)
 
-            for key, val in nh_added.items():
-                prefix, vrf = key.split('|')
-                self.prefix_cli_add(prefix, vrf)
+            for key in nh_added:
+                self.prefix_cli_add(key)
 
         if nh_deleted:
             syslog = "Nexthops are deleted: {0}".format(
@@ -3429,9 +4670,9 @@ class PrefixAgent(Agent):
             alert_level = AlertLevel.MINOR
 
             for key, val in nh_deleted.items():
-                prefix, vrf = key.split('|')
-                self.prefix_cli_add(prefix, vrf)
-                if ':' in prefix:
+                self.prefix_cli_add(key)
+                vrf = self.watch_table.by_key[key].vrf
+                if self.watch_table.by_key[key].family == 6:
                     for ele in val:
                         nh_ip = ele[0]
                         intf = ele[1]
@@ -3488,8 +4729,7 @@ class PrefixAgent(Agent):
             self.agent.set_alert_description_for_key(PREFIX, syslog)
             alert_level = AlertLevel.MAJOR
             for ele in prefix_missing_from_start:
-                prefix, vrf = ele.split('|')
-                self.prefix_cli_add(prefix, vrf)
+                self.prefix_cli_add(ele)
         if alert_level != AlertLevel.NONE:
             dprint("Enter alert_level != NONE")
             self.prefix_alert_on_this_cycle = True
@@ -3530,8 +4770,7 @@ class PrefixAgent(Agent):
             self.agent.set_alert_description_for_key(PREFIX, syslog)
             alert_level = AlertLevel.MAJOR
             for ele in prefixes_deleted:
-                prefix, vrf = ele.split('|')
-                self.prefix_cli_add(prefix, vrf)
+                self.prefix_cli_add(ele)
         if alert_level != AlertLevel.NONE:
             dprint("Enter alert_level != NONE")
             self.prefix_alert_on_this_cycle = True
@@ -3572,8 +4811,7 @@ class PrefixAgent(Agent):
                 self.agent.set_alert_description_for_key(PREFIX, syslog)
                 alert_level = AlertLevel.MINOR
                 for ele in val:
-                    prefix, vrf = ele.split('|')
-                    self.prefix_cli_add(prefix, vrf)
+                    self.prefix_cli_add(ele)
                 dprint("Enter alert_level != NONE")
                 self.prefix_alert_on_this_cycle = True
                 self.prefix_set_alert_level(alert_level)
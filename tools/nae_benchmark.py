@@ -0,0 +1,854 @@
+# -*- coding: utf-8 -*-
+#
+# (c) Copyright 2024 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Poll-cycle benchmark for the larger recommended scripts.
+
+Each workload loads a script in the NAE emulator (nae_emulator.py) against
+synthetic REST fixtures sized by a scale factor (number of BGP peers, OSPF
+neighbors, EVIs, VTEPs, TCAM features, interfaces, ...) and runs its poll
+or callback entry points for a number of cycles. For every cycle it
+measures:
+
+    wall      elapsed time
+    cpu       CLOCK_PROCESS_CPUTIME_ID, as in the scripts' "Time Report"
+    calls     REST requests made by the agent
+    parsed    bytes of REST responses decoded by the agent
+    vars      bytes written to self.variables (key + value, every write)
+
+The first cycle seeds the agent's persisted state and is reported
+separately from the steady-state mean. Results can be saved as JSON and
+compared against a previous run to catch regressions:
+
+    python nae_benchmark.py --scale 10 --scale 1000 --save before.json
+    python nae_benchmark.py --scale 10 --scale 1000 --compare before.json
+
+--state compares instead how routing_health_monitor persists its BGP
+neighbor list: the former full JSON rewrite every poll against its
+NeighborStateStore, with STATE_CHURN of the neighbors changing per poll.
+
+--ovsdb runs the routing_health_monitor incomplete routes and neighbors
+shell action against a Route table of scale rows, OVSDB_INCOMPLETE of them
+incomplete: the former pipeline jq-filtering two full `ovsdb-client dump`
+against the current one. ovsdb-client is replaced by a shell function
+replaying the dump or the transaction reply (selected rows and columns
+only) that ovsdb-server would send, so jq is needed but no switch.
+'''
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from ipaddress import IPv4Address
+from os.path import abspath, dirname, join
+
+import nae_emulator
+
+SCRIPTS_DIRECTORY = join(dirname(abspath(__file__)), '..',
+                         'recommended_scripts')
+DEFAULT_SCALES = (10, 100, 1000, 10000)
+DEFAULT_CYCLES = 5
+COMPARED_METRICS = ('cpu', 'calls', 'parsed', 'vars')
+# Same as PREFIX_LIST_MAX_LIMIT and the attributes of a RouteSnapshot.FULL
+# listing in routing_health_monitor
+PREFIX_LIST_MAX_LIMIT = 21
+PREFIX_ROUTE_ATTRIBUTES = 'prefix,from,metric,distance,nexthops,' \
+    'address_family,selected'
+EVPN_VTEPS_PER_EVI = 4
+STATE_CHURN = 0.01
+# Enough polls to include a full snapshot of NeighborStateStore
+STATE_SNAPSHOT_POLLS = 30
+BGP_STATES = ('Established', 'Idle', 'Connect', 'Active')
+OVSDB_INCOMPLETE = 0.01
+# Route columns as sorted by ovsdb-client dump, the former action selects
+# them by position
+OVSDB_ROUTE_COLUMNS = ('_uuid', '_version', 'address_family', 'distance',
+                       'dp_state', 'extra', 'from', 'metric', 'nexthops',
+                       'policy', 'prefix', 'selected', 'sub_address_family',
+                       'vrf')
+OVSDB_INCOMPLETE_STATES = ('disable', 'unresolved', ['set', []])
+# INCOMPLETE_ROUTES_HOSTS_SCRIPT of routing_health_monitor before the
+# transaction based version
+LEGACY_INCOMPLETE_ROUTES_HOSTS_SCRIPT = r'''
+echo "Incomplete Routes in Route Table"
+ovsdb-client dump Route -f json | jq '.[0] .data[] | select(.[4] == "disable" or .[4] == "unresolved" or .[4] == ["set", []]) | "\(.[10]) \(.[6]) \(.[4])"'
+echo "Incomplete Neighbors in Neighbor Table"
+ovsdb-client dump Route -f json | jq '.[0] .data[] | select(.[3] == "disable" or .[3] == ["set", []]) | "\(.[1]) \(.[2]) \(.[4]) \(.[6])"'
+'''
+RSS_HELPER = '''
+import resource, subprocess, sys
+subprocess.run(['bash', '-c', sys.argv[1]])
+print(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+'''
+OVSDB_CLIENT_SHIM = r'''
+ovsdb-client() {
+    case "$1" in
+    list-dbs) echo OpenSwitch ;;
+    dump) cat "$OVSDB_FILES/dump.json" ;;
+    transact)
+        case "$2" in
+        *'"Route"'*) cat "$OVSDB_FILES/routes.json" ;;
+        *) cat "$OVSDB_FILES/neighbors.json" ;;
+        esac ;;
+    esac
+}
+'''
+
+
+def script_path(name):
+    return join(SCRIPTS_DIRECTORY, name, name + '.py')
+
+
+def ipv4(base, index):
+    return str(IPv4Address(base) + index)
+
+
+def interface_name(index):
+    return '1/{}/{}'.format(index // 48 + 1, index % 48 + 1)
+
+
+#
+#   routing_health_monitor
+#
+
+def ospf_neighbor(index, now):
+    router_id = ipv4('192.0.0.1', index)
+    return {
+        'bdr': '0.0.0.0',
+        'dr': ipv4('101.0.0.1', index),
+        'nbr_if_addr': ipv4('101.0.0.2', index),
+        'nbr_options': ['external_attributes_lsa', 'external_routing',
+                        'type_of_service'],
+        'nbr_priority': 0,
+        'nbr_router_id': router_id,
+        'nfsm_state': 'full',
+        'statistics': {'ls_retransmit_queue_len': 0,
+                       'state_changes_count': 5},
+        'status': {'dead_timer_due': 30,
+                   'dr_rtr_state': 'desig_rtr_other',
+                   'time_of_last_change': now - 3600},
+    }
+
+
+def bgp_neighbor(index):
+    return {
+        'activate': {'ipv4-unicast': True, 'ipv6-unicast': False,
+                     'l2vpn-evpn': False},
+        'add_paths': {'ipv4-unicast': 'disable', 'ipv6-unicast': 'disable'},
+        'bfd_enable': False,
+        'capabilites_recevied': ['4-octet-asn', 'cisco-route-refresh',
+                                 'graceful-restart', 'route-refresh'],
+        'capabilites_sent': ['4-octet-asn', 'cisco-route-refresh',
+                             'graceful-restart', 'route-refresh'],
+        'ebgp_hop_count': 1,
+        'is_peer_group': False,
+        'local_as_mode': 'none',
+        'local_interface': {},
+        'negotiated_holdtime': 180,
+        'negotiated_keepalive': 60,
+        'passive': False,
+        'peer_rtrid': ipv4('2.0.0.1', index),
+        'remote_as': 65000 + index % 1000,
+        'route_reflector_client': {'ipv4-unicast': False,
+                                   'ipv6-unicast': False},
+        'sel_local_port': 40000 + index % 20000,
+        'sel_remote_port': 179,
+        'send_community': {'ipv4-unicast': 'none', 'ipv6-unicast': 'none'},
+        'shutdown': False,
+        'statistics': {
+            'bgp_peer_dropped_count': 0,
+            'bgp_peer_established_count': 1,
+            'bgp_peer_keepalive_in_count': 2864,
+            'bgp_peer_keepalive_out_count': 2862,
+            'bgp_peer_notify_in_count': 0,
+            'bgp_peer_notify_out_count': 0,
+            'bgp_peer_open_in_count': 1,
+            'bgp_peer_open_out_count': 1,
+            'bgp_peer_update_in_count': 4,
+            'bgp_peer_update_out_count': 3,
+            'bgp_peer_uptime': 171780,
+        },
+        'status': {'bgp_peer_state': 'Established'},
+        'timers': {'connect-retry': 120, 'holdtime': 180, 'keepalive': 60},
+        'update_source': ipv4('10.255.0.1', index % 16),
+        'weight': 0,
+    }
+
+
+def route(prefix, index):
+    return {
+        'address_family': 'ipv4',
+        'attributes': {},
+        'distance': 20,
+        'from': 'bgp',
+        'metric': 0,
+        'nexthops': {
+            str(index): {
+                'id': index,
+                'ip_address': ipv4('10.0.0.2', index % 64),
+                'port': {},
+                'selected': 'True',
+                'status': {},
+                'type': 'legacy-nexthop',
+                'weight': 0,
+            }
+        },
+        'prefix': prefix,
+        'protocol_private': 'None',
+        'route_age': 1686638132,
+        'selected': 'True',
+        'source_vrfs': {},
+        'sub_address_family': 'None',
+        'sub_protocol_type': '',
+        'tag': [0],
+        'type': 'forward',
+    }
+
+
+def routing_health_prefixes(scale):
+    count = min(scale, PREFIX_LIST_MAX_LIMIT)
+    return ['{}/24'.format(ipv4('10.0.0.0', i * 256)) for i in range(count)]
+
+
+def routing_health_params(scale):
+    return {'prefix_list': ','.join(
+        prefix + '|default' for prefix in routing_health_prefixes(scale))}
+
+
+def routing_health_fixtures(scale):
+    now = int(time.time())
+    areas = {}
+    projected_areas = {}
+    for i in range(scale):
+        neighbor = ospf_neighbor(i, now)
+        areas.setdefault(interface_name(i), {})[
+            ipv4('192.0.0.1', i)] = neighbor
+        projected_areas.setdefault(interface_name(i), {})[
+            ipv4('192.0.0.1', i)] = {
+                key: neighbor[key]
+                for key in ('nbr_if_addr', 'nfsm_state', 'status')}
+    neighbors = {ipv4('172.16.0.1', i): bgp_neighbor(i) for i in range(scale)}
+    projected_neighbors = {
+        address: {key: neighbor[key] for key in (
+            'is_peer_group', 'local_interface', 'statistics', 'status',
+            'update_source') if key in neighbor}
+        for address, neighbor in neighbors.items()}
+    fixtures = {
+        '/rest/v10.08/system?attributes=copp_statistics': {
+            'copp_statistics': {'unresolved_ip_unicast_packets_dropped': 0}},
+        '/rest/v10.08/system?attributes=capacities': {
+            'capacities': {'copp_max_rate_pps': 100000}},
+        '/rest/v10.08/system/vrfs/*?attributes=ospf_routers,ospfv3_routers,'
+        'bgp_routers': {
+            'default': {'ospf_routers': {'1': '/rest/v10.08/system/vrfs/'
+                                              'default/ospf_routers/1'},
+                        'ospfv3_routers': {},
+                        'bgp_routers': {'65001': '/rest/v10.08/system/vrfs/'
+                                                 'default/bgp_routers/65001'}}},
+        '/rest/v10.08/system/vrfs/*/ospf_routers/*/areas/*/ospf_interfaces/'
+        '*/ospf_neighbors?depth=2': {'default': {'1': {'0.0.0.0': areas}}},
+        '/rest/v10.08/system/vrfs/*/ospfv3_routers/*/areas/*/ospf_interfaces/'
+        '*/ospf_neighbors?depth=2': {},
+        '/rest/v10.08/system/vrfs/*/ospf_routers/*/areas/*/ospf_interfaces/'
+        '*/ospf_neighbors?depth=2&attributes=nbr_if_addr,nfsm_state,status': {
+            'default': {'1': {'0.0.0.0': projected_areas}}},
+        '/rest/v10.08/system/vrfs/*/ospfv3_routers/*/areas/*/ospf_interfaces/'
+        '*/ospf_neighbors?depth=2&attributes=nbr_if_addr,nfsm_state,status':
+            {},
+        '/rest/v10.13/system/vrfs/*/bgp_routers?depth=4': {
+            'default': {'65001': {'asn': 65001, 'router_id': '1.1.1.1',
+                                  'bgp_neighbors': neighbors}}},
+        '/rest/v10.13/system/vrfs/*/bgp_routers/*/bgp_neighbors?depth=2'
+        '&attributes=is_peer_group,local_interface,statistics,status,'
+        'update_source': {'default': {'65001': projected_neighbors}},
+        '/rest/v10.13/system/vrfs/*/routes?filter=selected:true&count=true': {
+            'count': scale * 10},
+        '/rest/v10.13/system/subsystems/*/*/daemons/hpe-routing'
+        '?attributes=name,resource_utilization': {
+            'management_module,1/1': {'hpe-routing': {
+                'name': 'hpe-routing',
+                'resource_utilization': {'cpu': 12, 'memory': 4}}}},
+    }
+    # The default VRF holds the monitored prefixes among scale routes
+    table = {}
+    for i, prefix in enumerate(routing_health_prefixes(scale)):
+        base = '/rest/v10.13/system/vrfs/default/routes/' + prefix
+        fixtures[base + '?count=true'] = {'count': 1}
+        fixtures[base + '?depth=2'] = route(prefix, i)
+        table[prefix] = route(prefix, i)
+    for i in range(len(table), scale):
+        prefix = '{}/32'.format(ipv4('172.16.0.1', i))
+        table[prefix] = route(prefix, i)
+    vrf_routes = '/rest/v10.13/system/vrfs/default/routes'
+    fixtures[vrf_routes + '?count=true'] = {'count': len(table)}
+    fixtures[vrf_routes + '?depth=3&attributes=' + PREFIX_ROUTE_ATTRIBUTES] = {
+        prefix.replace('/', '%2F'): {
+            key: value[key] for key in PREFIX_ROUTE_ATTRIBUTES.split(',')}
+        for prefix, value in table.items()}
+    return fixtures
+
+
+#
+#   evpn_vxlan_health
+#
+
+def evpn_vteps(scale):
+    return max(EVPN_VTEPS_PER_EVI, scale // 10)
+
+
+def evpn_vxlan_params(scale):
+    return {'monitor_evpn': 'true'}
+
+
+def evpn_vxlan_fixtures(scale):
+    vteps = [ipv4('3.0.0.1', i) for i in range(evpn_vteps(scale))]
+    evis = {}
+    vnis = {}
+    vnis_per_vtep = {vtep: {} for vtep in vteps}
+    for i in range(scale):
+        evi = i + 1
+        vni = 10000 + i
+        peers = [vteps[(i + j) % len(vteps)]
+                 for j in range(EVPN_VTEPS_PER_EVI)]
+        remote_macs = {peer: 20 for peer in peers}
+        evis[str(evi)] = {
+            'ethernet_tag': None,
+            'evi': evi,
+            'export_route_targets': ['1:{}'.format(vni)],
+            'import_route_targets': ['1:{}'.format(vni)],
+            'operational_failure_reason': 'None',
+            'operational_status': 'up',
+            'rd': '1.1.1.1:{}'.format(evi),
+            'remote_mac_count_per_vtep_peer': remote_macs,
+            'statistics': {'local_mac_count': 10,
+                           'peer_vtep_count': len(peers),
+                           'remote_mac_count': sum(remote_macs.values())},
+        }
+        vlan = str(i % 4094 + 1)
+        key = 'vxlan_vni,{}'.format(vni)
+        vnis[key] = {
+            'id': vni,
+            'routing': False,
+            'state': 'operational',
+            'type': 'vxlan_vni',
+            'vlan': {vlan: '/rest/v10.10/system/vlans/' + vlan},
+            'vrf': None,
+        }
+        for peer in peers:
+            vnis_per_vtep[peer][key] = \
+                '/rest/v10.10/system/virtual_network_ids/' + key
+    tunnels = {}
+    for vtep in vteps:
+        tunnels['default,evpn,' + vtep] = {
+            'destination': vtep,
+            'macs_invalid': 'None',
+            'network_id': vnis_per_vtep[vtep],
+            'origin': 'evpn',
+            'state': 'operational',
+            'statistics': {},
+            'vrf': {'default': '/rest/v10.10/system/vrfs/default'},
+        }
+    return {
+        '/rest/v10.10/system/evpn_instances/*': evis,
+        '/rest/v10.10/system/virtual_network_ids?attributes=id,type,vrf,'
+        'vlan,routing,state&depth=3': vnis,
+        '/rest/v10.10/system/interfaces/vxlan1/tunnel_endpoints/*,*,*': {
+            'vxlan1': tunnels},
+    }
+
+
+#
+#   tcam_resource_utilization_monitor
+#
+
+TCAM_RESOURCES = ('Ingress_TCAM_Entries', 'Egress_TCAM_Entries')
+
+
+def tcam_fixtures(scale):
+    reservation = {}
+    utilization = {}
+    for i in range(scale):
+        feature = 'feature_{}'.format(i)
+        resource = TCAM_RESOURCES[i % 2]
+        reservation[feature] = {resource: 256}
+        utilization[feature] = {resource: 64}
+    base = '/rest/v10.13/system/subsystems/line_card,1/1'
+    return {
+        base + '?attributes=resource_capacity': {
+            'resource_capacity': {'Ingress_TCAM_Entries': 256 * scale,
+                                  'Egress_TCAM_Entries': 256 * scale,
+                                  'Ingress_L4_Port_Ranges': 64,
+                                  'Policers': 4096}},
+        base + '?attributes=resource_unreserved,'
+        'resource_utilization_per_feature,'
+        'resource_reservation_per_feature': {
+            'resource_unreserved': {'Ingress_TCAM_Entries': 1024,
+                                    'Egress_TCAM_Entries': 1024,
+                                    'Ingress_L4_Port_Ranges': 60,
+                                    'Policers': 4000},
+            'resource_utilization_per_feature': utilization,
+            'resource_reservation_per_feature': reservation},
+    }
+
+
+#
+#   software_device_health_monitor
+#
+
+def software_device_fixtures(scale):
+    fixtures = {}
+    for prefix in ('', '/vsx-peer'):
+        fixtures[prefix + '/rest/v10.08/system/vlans/*/macs?count&'
+                 'filter=selected:true'] = {'count': scale * 10}
+        fixtures[prefix + '/rest/v10.08/system/vrfs/*/routes?count'] = {
+            'count': scale * 10}
+        fixtures[prefix + '/rest/v10.08/system/vrfs/*/neighbors?count'] = {
+            'count': scale}
+    return fixtures
+
+
+def software_device_events(emulated, scale):
+    '''Per interface broadcast storm and over bandwidth faults raised and
+    cleared, plus the daemon and VSX ratio rules'''
+    events = []
+    for i in range(scale):
+        labels = 'interface={},TimeInterval=60s'.format(interface_name(i))
+        for description, value in (('Broadcast storm fault', 200000),
+                                   ('Over bandwidth fault', 0.05)):
+            events.append((description, value, labels, False))
+            events.append((description, 0, labels, True))
+    for i in range(1, 5):
+        daemon = str(emulated.runtime.params['daemon_{}'.format(i)])
+        labels = 'Daemon={}'.format(daemon)
+        for description in ('High CPU utilization by ' + daemon,
+                            'High Memory utilization by ' + daemon):
+            events.append((description, 95, labels, False))
+            events.append((description, 5, labels, True))
+    for resource in ('routes', 'neighbors', 'mac_addresses'):
+        description = 'Ratio of {} on the switch to VSX-peer rule'.format(
+            resource)
+        events.append((description, 1.0, '', False))
+        events.append((description, 1.0, '', True))
+    return events
+
+
+#
+#   application_health_monitor
+#
+
+def ipsla_session(name, sla_type):
+    return {'name': name, 'type': sla_type, 'frequency': 60,
+            'status': {'state': 'running'}, 'vrf': '/rest/v10.08/system/vrfs/'
+            'default', 'source_port_number': 5000,
+            'effective_source_ip': '10.0.0.1', 'source_interface': None,
+            'domain_name_server': None, 'payload_size': 32, 'tos': 0,
+            'advantage_factor': 0, 'codec_type': 'g711a',
+            'http_sla': {'type': 'get', 'url': 'http://10.0.0.100/',
+                         'cache_disable': False, 'proxy_url': None,
+                         'version_number': '1.1'}}
+
+
+def application_health_params(scale):
+    return {'TCP_Application_IP_Address': '10.0.0.100',
+            'HTTP_IPSLA_Name': 'web', 'VoIP_IPSLA_Name': 'voip'}
+
+
+def application_health_fixtures(scale):
+    fixtures = {'/rest/v10.08/system/vrfs/default': {'name': 'default'}}
+    for name, sla_type in (('web', 'http'), ('voip', 'udp_jitter_voip')):
+        session = ipsla_session(name, sla_type)
+        uri = '/rest/v10.08/system/ipsla_sources/' + name
+        fixtures[uri] = session
+        fixtures[uri + '?attributes=frequency'] = {'frequency': 60}
+    return fixtures
+
+
+def application_health_events(emulated, scale):
+    '''IP SLA rule events raised and cleared, scale events per cycle'''
+    rules = [rule.description for rule in emulated.runtime.rules
+             if 'IPSLA' in rule.description or 'VOIP' in rule.description]
+    events = []
+    for i in range(scale):
+        description = rules[i % len(rules)]
+        if 'http' in description:
+            labels = 'ipsla_source=web'
+        else:
+            labels = 'ipsla_source=voip'
+        events.append((description, 1, labels, i % 2 == 1))
+    return events
+
+
+#
+#   Workloads
+#
+
+def fire_events(emulated, events):
+    rules = {}
+    for rule in emulated.runtime.rules:
+        rules.setdefault(rule.resolved_description(), rule)
+    for description, value, labels, clear in events:
+        emulated.fire(rules[description], value=value, labels=labels,
+                      clear=clear)
+
+
+class Workload:
+    '''
+    A script, the fixtures and parameters it runs with at a given scale and
+    what makes up one of its cycles: every periodic rule, followed by the
+    events returned by events(emulated, scale) when given.
+    '''
+
+    def __init__(self, name, unit, fixtures, params=None, events=None):
+        self.name = name
+        self.unit = unit
+        self.fixtures = fixtures
+        self.params = params
+        self.events = events
+
+    def load(self, server, scale):
+        params = self.params(scale) if self.params else None
+        return nae_emulator.load_script(script_path(self.name), server,
+                                        params=params, sleep_scale=0.0)
+
+    def cycle(self, emulated, scale):
+        emulated.poll()
+        if self.events:
+            fire_events(emulated, self.events(emulated, scale))
+
+
+WORKLOADS = (
+    Workload('routing_health_monitor', 'BGP peers and OSPF neighbors',
+             routing_health_fixtures, routing_health_params),
+    Workload('evpn_vxlan_health', 'EVIs (VTEPs = scale / 10)',
+             evpn_vxlan_fixtures, evpn_vxlan_params),
+    Workload('software_device_health_monitor', 'interfaces',
+             software_device_fixtures, events=software_device_events),
+    Workload('application_health_monitor', 'IP SLA rule events',
+             application_health_fixtures, application_health_params,
+             events=application_health_events),
+    Workload('tcam_resource_utilization_monitor', 'TCAM features',
+             tcam_fixtures),
+)
+
+
+def snapshot(runtime):
+    return {
+        'wall': time.monotonic(),
+        'cpu': time.clock_gettime(time.CLOCK_PROCESS_CPUTIME_ID),
+        'calls': runtime.rest_calls,
+        'parsed': runtime.rest_bytes,
+        'vars': runtime.variables.bytes_written,
+    }
+
+
+def delta(before, after):
+    return {key: after[key] - before[key] for key in before}
+
+
+def run_workload(workload, scale, cycles):
+    '''Returns the first cycle and the mean of the following cycles'''
+    fixtures = nae_emulator.Fixtures(workload.fixtures(scale))
+    with nae_emulator.ReplayServer(fixtures) as server:
+        emulated = workload.load(server, scale)
+        samples = []
+        for _ in range(cycles + 1):
+            before = snapshot(emulated.runtime)
+            workload.cycle(emulated, scale)
+            samples.append(delta(before, snapshot(emulated.runtime)))
+    first = samples[0]
+    steady = {key: sum(sample[key] for sample in samples[1:]) /
+              max(len(samples) - 1, 1) for key in first}
+    return first, steady
+
+
+def bgp_nbr_record(index, rng):
+    '''A neighbor as built by BGPAgent.analyze_bgp_data'''
+    state = 'Established' if rng.random() < 0.9 else rng.choice(BGP_STATES)
+    return {
+        'bgp_peer_state': state,
+        'bgp_peer_uptime': 0 if state == 'Established' else
+        rng.randrange(1000),
+        'bgp_peer_last_err_rx': 'No Error',
+        'bgp_peer_last_err_tx': rng.choice(('No Error', 'Cease')),
+        'bgp_peer_last_sub_err_rx': 'No Error',
+        'bgp_peer_last_sub_err_tx': 'No Error',
+        'bgp_peer_established_count': rng.randrange(1, 4),
+        'bgp_local_interface': 'None',
+        'bgp_update_source': ipv4('10.255.0.1', index % 16),
+        'bgp_peer_stuck_state': 'None',
+    }
+
+
+def run_state_encoding(module, scale, cycles):
+    '''
+    Returns the mean per poll cost of persisting scale BGP neighbors as
+    full JSON and with NeighborStateStore, plus the cost of decoding the
+    stored state after a restart.
+    '''
+    rng = random.Random(scale)
+    polls = []
+    neighbors = {'default/' + ipv4('172.16.0.1', i): bgp_nbr_record(i, rng)
+                 for i in range(scale)}
+    for _ in range(cycles + 1):
+        neighbors = dict(neighbors)
+        for _ in range(max(int(scale * STATE_CHURN), 1)):
+            index = rng.randrange(scale)
+            neighbors['default/' + ipv4('172.16.0.1', index)] = \
+                bgp_nbr_record(index, rng)
+        polls.append(neighbors)
+
+    results = {}
+    for encoding in ('full json', 'state store'):
+        holder = types.SimpleNamespace(variables=nae_emulator.Variables())
+        holder.variables['bgp_nbr_list'] = json.dumps({})
+        store = module.NeighborStateStore(
+            holder, 'bgp_nbr_list', tuple(bgp_nbr_record(0, rng)))
+        samples = []
+        for neighbor_dict in polls:
+            written = holder.variables.bytes_written
+            start = time.perf_counter()
+            if encoding == 'full json':
+                json.loads(holder.variables['bgp_nbr_list'])
+                holder.variables['bgp_nbr_list'] = json.dumps(neighbor_dict)
+            else:
+                store.load()
+                store.save(neighbor_dict)
+            samples.append((time.perf_counter() - start,
+                            holder.variables.bytes_written - written))
+        start = time.perf_counter()
+        if encoding == 'full json':
+            json.loads(holder.variables['bgp_nbr_list'])
+        else:
+            module.NeighborStateStore(
+                holder, 'bgp_nbr_list', store.fields).load()
+        restart = time.perf_counter() - start
+        steady = samples[1:]
+        results[encoding] = {
+            'poll': sum(sample[0] for sample in steady) / len(steady),
+            'written': sum(sample[1] for sample in steady) / len(steady),
+            'restart': restart,
+            'stored': sum(len(holder.variables[key]) for key in
+                          ('bgp_nbr_list', 'bgp_nbr_list_delta')
+                          if key in holder.variables)}
+    return results
+
+
+def state_encoding(scales, cycles):
+    fixtures = nae_emulator.Fixtures(routing_health_fixtures(1))
+    with nae_emulator.ReplayServer(fixtures) as server:
+        module = nae_emulator.load_script(
+            script_path('routing_health_monitor'), server,
+            sleep_scale=0.0).module
+    print('{:<12} {:>6} {:>10} {:>12} {:>12} {:>12}'.format(
+        'encoding', 'scale', 'poll ms', 'written B', 'stored B',
+        'restart ms'))
+    for scale in scales:
+        for encoding, result in run_state_encoding(
+                module, scale, cycles).items():
+            print('{:<12} {:>6} {:>10.2f} {:>12.0f} {:>12} {:>12.2f}'.format(
+                encoding, scale, result['poll'] * 1000, result['written'],
+                result['stored'], result['restart'] * 1000))
+
+
+def ovsdb_route_row(index, state):
+    '''A Route row as printed by ovsdb-client dump -f json'''
+    values = {
+        '_uuid': ['uuid', '00000000-0000-0000-0000-{:012x}'.format(index)],
+        '_version': ['uuid', '10000000-0000-0000-0000-{:012x}'.format(index)],
+        'address_family': 'ipv4',
+        'distance': 20,
+        'dp_state': state,
+        'extra': ['map', []],
+        'from': 'bgp',
+        'metric': 0,
+        'nexthops': ['set', [['uuid', '20000000-0000-0000-0000-{:012x}'
+                              .format(index)]]],
+        'policy': ['set', []],
+        'prefix': '{}/32'.format(ipv4('11.0.0.0', index)),
+        'selected': True,
+        'sub_address_family': 'unicast',
+        'vrf': ['uuid', '30000000-0000-0000-0000-000000000000'],
+    }
+    return [values[column] for column in OVSDB_ROUTE_COLUMNS]
+
+
+def write_ovsdb_files(directory, scale):
+    '''
+    Writes the Route table dump and the replies to the incomplete routes
+    and neighbors transactions. Returns the size of each file.
+    '''
+    rng = random.Random(scale)
+    rows = []
+    selected = [[] for _ in OVSDB_INCOMPLETE_STATES]
+    for index in range(scale):
+        state = 'programmed'
+        if rng.random() < OVSDB_INCOMPLETE:
+            which = rng.randrange(len(OVSDB_INCOMPLETE_STATES))
+            state = OVSDB_INCOMPLETE_STATES[which]
+            selected[which].append(index)
+        rows.append(ovsdb_route_row(index, state))
+    routes = [{'rows': [{'prefix': rows[index][10], 'from': rows[index][6],
+                         'dp_state': rows[index][4]} for index in indexes]}
+              for indexes in selected]
+    neighbors = [{'rows': [{'address_family': 'ipv4', 'dp_state': 'disable',
+                            'from': 'arp', 'ip_address': ipv4('12.0.0.1', i)}
+                           for i in range(max(scale // 1000, 1))]},
+                 {'rows': []}]
+    contents = {
+        'dump.json': [{'caption': 'Route table', 'data': rows,
+                       'headings': list(OVSDB_ROUTE_COLUMNS)}],
+        'routes.json': routes,
+        'neighbors.json': neighbors}
+    sizes = {}
+    for name, content in contents.items():
+        with open(join(directory, name), 'w') as outfile:
+            json.dump(content, outfile)
+        sizes[name] = os.path.getsize(join(directory, name))
+    return sizes
+
+
+def run_shell_action(script, directory):
+    '''
+    Runs script with ovsdb-client replaced by OVSDB_CLIENT_SHIM. Returns
+    the wall time, the lines printed and the peak RSS in kB of the shell
+    and the commands it ran. The shell is started from a fresh interpreter
+    (RSS_HELPER) as the peak RSS of a process includes the one of the
+    process it was spawned from.
+    '''
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-c', RSS_HELPER, OVSDB_CLIENT_SHIM + script],
+        env=dict(os.environ, OVSDB_FILES=directory), check=True,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+    output = result.stdout.splitlines()
+    return wall, len(output) - 1, int(output[-1])
+
+
+def ovsdb_action(scales):
+    fixtures = nae_emulator.Fixtures(routing_health_fixtures(1))
+    with nae_emulator.ReplayServer(fixtures) as server:
+        module = nae_emulator.load_script(
+            script_path('routing_health_monitor'), server,
+            sleep_scale=0.0).module
+    scripts = (('dump + jq', LEGACY_INCOMPLETE_ROUTES_HOSTS_SCRIPT),
+               ('transact', module.CoppAgent.INCOMPLETE_ROUTES_HOSTS_SCRIPT))
+    print('{:<10} {:>8} {:>10} {:>12} {:>10} {:>8}'.format(
+        'action', 'scale', 'wall ms', 'read B', 'peak kB', 'lines'))
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as directory:
+            sizes = write_ovsdb_files(directory, scale)
+            read = {'dump + jq': 2 * sizes['dump.json'],
+                    'transact': sizes['routes.json'] +
+                    sizes['neighbors.json']}
+            for name, script in scripts:
+                wall, lines, peak = run_shell_action(script, directory)
+                print('{:<10} {:>8} {:>10.2f} {:>12} {:>10} {:>8}'.format(
+                    name, scale, wall * 1000, read[name], peak, lines))
+
+
+def format_row(name, scale, label, sample):
+    return '{:<34} {:>6} {:<6} {:>10.2f} {:>10.2f} {:>7.0f} {:>12.0f} ' \
+           '{:>12.0f}'.format(name, scale, label, sample['wall'] * 1000,
+                              sample['cpu'] * 1000, sample['calls'],
+                              sample['parsed'], sample['vars'])
+
+
+def compare(results, baseline, tolerance):
+    '''Returns the metrics that regressed by more than tolerance'''
+    regressions = []
+    for key, sample in results.items():
+        if key not in baseline:
+            continue
+        for metric in COMPARED_METRICS:
+            old = baseline[key]['steady'][metric]
+            new = sample['steady'][metric]
+            if new > old * (1 + tolerance) and new - old > 0:
+                regressions.append('{} {}: {:.2f} -> {:.2f}'.format(
+                    key, metric, old, new))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark NAE script poll cycles on synthetic data')
+    parser.add_argument('--script', action='append',
+                        choices=[w.name for w in WORKLOADS],
+                        help='script to run, default is all of them')
+    parser.add_argument('--scale', action='append', type=int,
+                        help='entities per fixture, default is {}'.format(
+                            ', '.join(str(s) for s in DEFAULT_SCALES)))
+    parser.add_argument('--cycles', type=int, default=DEFAULT_CYCLES,
+                        help='steady-state cycles measured after the first')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--compare',
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative increase reported as a regression')
+    parser.add_argument('--state', action='store_true',
+                        help='compare the routing_health_monitor neighbor '
+                             'state encodings instead')
+    parser.add_argument('--ovsdb', action='store_true',
+                        help='compare the routing_health_monitor incomplete '
+                             'routes and neighbors actions instead')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.CRITICAL)
+    scales = args.scale or DEFAULT_SCALES
+    if args.state:
+        state_encoding(scales, max(args.cycles, STATE_SNAPSHOT_POLLS))
+        return 0
+    if args.ovsdb:
+        ovsdb_action(scales)
+        return 0
+    workloads = [w for w in WORKLOADS
+                 if not args.script or w.name in args.script]
+
+    print('{:<34} {:>6} {:<6} {:>10} {:>10} {:>7} {:>12} {:>12}'.format(
+        'script', 'scale', 'cycle', 'wall ms', 'cpu ms', 'calls',
+        'parsed B', 'vars B'))
+    results = {}
+    for workload in workloads:
+        for scale in scales:
+            first, steady = run_workload(workload, scale, args.cycles)
+            print(format_row(workload.name, scale, 'first', first))
+            print(format_row(workload.name, scale, 'mean', steady))
+            results['{}@{}'.format(workload.name, scale)] = {
+                'unit': workload.unit, 'first': first, 'steady': steady}
+
+    if args.save:
+        with open(args.save, 'w') as outfile:
+            json.dump(results, outfile, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as infile:
+            regressions = compare(results, json.load(infile), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
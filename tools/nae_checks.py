@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+#
+# (c) Copyright 2024 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Behaviour checks of the recommended scripts in the NAE emulator.
+
+Each check loads a script in the emulator (nae_emulator.py) against the
+benchmark fixtures (nae_benchmark.py), adapted to one scenario, drives a
+few polls and verifies what the agent reported. The checks stop at the
+first failure and exit non zero:
+
+    python nae_checks.py
+    python nae_checks.py --check ospf_timed_out_interface
+'''
+
+import argparse
+import logging
+import sys
+import time
+
+import nae_benchmark
+import nae_emulator
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def expect(condition, message, *args):
+    if not condition:
+        raise CheckFailed(message.format(*args))
+
+
+def action_texts(runtime):
+    return [' '.join(str(arg) for arg in args)
+            for _, args, _ in runtime.actions]
+
+
+#
+#   routing_health_monitor
+#
+
+OSPF_INTERFACE_URL = '/rest/v10.08/system/vrfs/*/ospf_routers/*/areas/*/' \
+    'ospf_interfaces/{}/ospf_neighbors?depth=2'
+
+
+OSPF_SLOW_LATENCY = 3.0
+
+
+def ospf_slow_interface_server():
+    '''Returns the parameters and a ReplayServer querying the OSPF
+    neighbors per interface, those of 1/1/2 answering after
+    OSPF_SLOW_LATENCY seconds'''
+    fixtures = nae_benchmark.routing_health_fixtures(2)
+    areas = fixtures['/rest/v10.08/system/vrfs/*/ospf_routers/*/areas/*/'
+                     'ospf_interfaces/*/ospf_neighbors?depth=2']
+    areas = areas['default']['1']['0.0.0.0']
+    for interface, neighbors in areas.items():
+        encoded = interface.replace('/', '%2F')
+        fixtures[OSPF_INTERFACE_URL.format(encoded)] = {
+            'default': {'1': {'0.0.0.0': {encoded: neighbors}}}}
+    slow = OSPF_INTERFACE_URL.format('1%2F1%2F2').split('?')[0]
+
+    def latency(path):
+        return OSPF_SLOW_LATENCY if path.startswith(slow) else 0.0
+
+    params = dict(nae_benchmark.routing_health_params(2),
+                  ospf_wildcard_query='false',
+                  ospf_interface='1/1/1, 1/1/2',
+                  ospf_fetch_deadline='5')
+    return params, nae_emulator.ReplayServer(
+        nae_emulator.Fixtures(fixtures), latency=latency)
+
+
+def check_ospf_timed_out_interface():
+    '''The neighbors of an interface whose query misses ospf_fetch_deadline
+    are kept, not reported as expired'''
+    params, server = ospf_slow_interface_server()
+    with server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=params, sleep_scale=0.0)
+        emulated.poll()
+        neighbors = emulated.agent.variables['neighbor_count']
+        expect(neighbors == '2', 'expected 2 OSPF neighbors, got {}',
+               neighbors)
+
+        emulated.agent.params['ospf_fetch_deadline'].value = 1
+        del emulated.runtime.actions[:]
+        emulated.poll()
+        timed_out = emulated.agent.variables['ospf_timed_out_interfaces']
+        expect(timed_out == '[["1/1/2", ""]]',
+               'expected 1/1/2 to time out, got {}', timed_out)
+        expired = [text for text in action_texts(emulated.runtime)
+                   if 'expired' in text]
+        expect(not expired, 'timed out neighbors reported as expired: {}',
+               expired)
+
+
+def check_ospf_abandoned_query_stats():
+    '''The response of an OSPF query abandoned at ospf_fetch_deadline is not
+    counted in the poll_stats of the sub-agent running when it ends'''
+    params, server = ospf_slow_interface_server()
+    params['ospf_fetch_deadline'] = '1'
+    with server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=params, sleep_scale=0.0)
+        emulated.poll()
+        stats = emulated.agent.poll_stats
+        stats.start('CHECK')
+        time.sleep(OSPF_SLOW_LATENCY)
+        stats.stop()
+        calls = stats.samples['CHECK'][-1][stats.METRICS.index('rest_calls')]
+        expect(calls == 0, 'abandoned OSPF query counted in a later '
+               'sub-agent, {} calls', calls)
+
+
+COPP_STATS_URL = '/rest/v10.08/system?attributes=copp_statistics'
+
+
+COPP_STATS = ('arp_packets_dropped', 'arp_bytes_dropped',
+              'unresolved_ip_unicast_packets_dropped')
+
+
+def copp_alerts(params, dropping):
+    '''Returns the COPP drop rate syslogs sent when the stats in dropping
+    go far above the system capacity, the other ones staying at 0'''
+    fixtures = nae_benchmark.routing_health_fixtures(1)
+    params = dict(nae_benchmark.routing_health_params(1), **params)
+    with nae_emulator.ReplayServer(
+            nae_emulator.Fixtures(fixtures)) as server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=params, sleep_scale=0.0)
+        for poll in range(3):
+            server.publish({COPP_STATS_URL: {'copp_statistics': {
+                name: poll * 10 ** 9 if name in dropping else 0
+                for name in COPP_STATS}}})
+            emulated.poll()
+        return [text for text in action_texts(emulated.runtime)
+                if 'COPP drop rate' in text]
+
+
+def check_copp_default_alerting():
+    '''Only the unresolved ip unicast drops alert by default, the other
+    packets dropped stats are tracked without alerting and the bytes dropped
+    stats never alert'''
+    alerts = copp_alerts({}, COPP_STATS[:2])
+    expect(not alerts, 'ARP drops alerted by default: {}', alerts)
+    alerts = copp_alerts({}, COPP_STATS[2:])
+    expect(alerts and all('unresolved ip unicast' in alert
+                          for alert in alerts),
+           'expected unresolved ip unicast drops alerts, got {}', alerts)
+    alerts = copp_alerts({'copp_alert_statistics': '*_dropped'},
+                         COPP_STATS[:2])
+    expect(alerts and all(' arp ' in alert and 'bytes' not in alert
+                          for alert in alerts),
+           'expected ARP packets drops alerts only, got {}', alerts)
+
+
+VRFS_PATH = '/system/vrfs/*'
+
+
+def capability_queries(error):
+    '''Returns the VRF queries of two capability probes, the first query
+    of the routers columns failing with error'''
+    fixtures = nae_benchmark.routing_health_fixtures(1)
+    params = dict(nae_benchmark.routing_health_params(1), capability_ttl='0')
+    with nae_emulator.ReplayServer(
+            nae_emulator.Fixtures(fixtures)) as server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=params, sleep_scale=0.0)
+        runtime = emulated.runtime
+        get_rest_request_json = runtime.get_rest_request_json
+        queries = []
+
+        def failing_once(url, *args, **kwargs):
+            path = url.split('/rest/v10.08', 1)[-1]
+            if path.startswith(VRFS_PATH) and \
+                    '/' not in path[len(VRFS_PATH):]:
+                queries.append(path)
+                if len(queries) == 1:
+                    raise nae_emulator.NAEException(error.format(url))
+            return get_rest_request_json(url, *args, **kwargs)
+
+        runtime.get_rest_request_json = failing_once
+        emulated.poll(2)
+        return queries
+
+
+def check_capability_transient_error():
+    '''A transient error of the routers columns query is retried, the
+    whole VRF is only fetched once the query was rejected'''
+    projected = VRFS_PATH + \
+        '?attributes=ospf_routers,ospfv3_routers,bgp_routers'
+    queries = capability_queries('GET {} failed: timed out')
+    expect(queries == [projected, projected],
+           'expected the columns query to be retried, got {}', queries)
+    for error in ('GET {} failed with status code 400',
+                  'Status code: 400 for GET {}'):
+        queries = capability_queries(error)
+        expect(queries == [projected, VRFS_PATH, VRFS_PATH],
+               'expected the whole VRF after a rejection ({}), got {}',
+               error, queries)
+
+
+ROUTES_URL = '/rest/v10.13/system/vrfs/default/routes'
+
+
+def check_prefix_covering_route_same_poll():
+    '''The commands of a covering route change are run in the poll it is
+    reported'''
+    fixtures = nae_benchmark.routing_health_fixtures(1)
+    params = dict(nae_benchmark.routing_health_params(1), prefix_lpm='true')
+    with nae_emulator.ReplayServer(
+            nae_emulator.Fixtures(fixtures)) as server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=params, sleep_scale=0.0)
+        emulated.poll()
+        route = nae_benchmark.route('10.0.0.0/16', 0)
+        server.publish({ROUTES_URL: {'10.0.0.0%2F16': route}})
+        del emulated.runtime.actions[:]
+        emulated.poll()
+        texts = action_texts(emulated.runtime)
+        changed = [text for text in texts if 'Covering route changed' in text]
+        expect(changed and
+               'from 10.0.0.0/24 to 10.0.0.0/16' in changed[0],
+               'expected the covering route change syslog, got {}', changed)
+        expect(any('show ip route 10.0.0.0/16 vrf default' in text
+                   for text in texts),
+               'covering route commands not run in the poll, got {}', texts)
+
+
+def check_route_snapshot_versions():
+    '''The version of a VRF listing only changes with its SUMMARY view, a
+    KEYS listing leaves the SUMMARY one current'''
+    fixtures = nae_benchmark.routing_health_fixtures(1)
+    with nae_emulator.ReplayServer(
+            nae_emulator.Fixtures(fixtures)) as server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=nae_benchmark.routing_health_params(1), sleep_scale=0.0)
+        routes = emulated.agent.routes
+        views = emulated.module.RouteSnapshot
+
+        def listing(view, **kwargs):
+            routes.begin_cycle()
+            result = routes.vrf_routes('default', view, **kwargs)
+            routes.end_cycle()
+            return result
+
+        version, _ = listing(views.SUMMARY)
+        listed = listing(views.KEYS, fresh=True)
+        expect(listed[0] == version, 'KEYS listing changed the version')
+        listed = listing(views.SUMMARY, known_version=version)
+        expect(listed == (version, None),
+               'SUMMARY listing not current after a KEYS one, got {}',
+               listed[0])
+        route = nae_benchmark.route('10.0.0.0/24', 1)
+        server.publish({ROUTES_URL: {'10.0.0.0%2F24': route}})
+        listed = listing(views.FULL, fresh=True)
+        expect(listed[0] == version, 'next hop change bumped the version')
+        route['from'] = 'ospf'
+        server.publish({ROUTES_URL: {'10.0.0.0%2F24': route}})
+        listed = listing(views.SUMMARY, fresh=True)
+        expect(listed[0] != version, 'protocol change kept the version')
+
+
+def check_route_count_error_skipped():
+    '''An interval whose route count query fails is skipped, not counted
+    as a drop to 0 routes'''
+    fixtures = nae_benchmark.routing_health_fixtures(1)
+    with nae_emulator.ReplayServer(
+            nae_emulator.Fixtures(fixtures)) as server:
+        emulated = nae_emulator.load_script(
+            nae_benchmark.script_path('routing_health_monitor'), server,
+            params=nae_benchmark.routing_health_params(1), sleep_scale=0.0)
+        runtime = emulated.runtime
+        get_rest_request_json = runtime.get_rest_request_json
+        failing = []
+
+        def failing_count(url, *args, **kwargs):
+            if failing and 'routes?filter=selected' in url:
+                raise nae_emulator.NAEException(
+                    'GET {} failed with status code 503'.format(url))
+            return get_rest_request_json(url, *args, **kwargs)
+
+        runtime.get_rest_request_json = failing_count
+        emulated.poll()
+        failing.append(True)
+        emulated.poll()
+        del failing[:]
+        emulated.poll()
+        samples = emulated.agent.variables['route_count_samples']
+        counts = samples.split(':', 1)[1].split()
+        expect(counts == ['10', '10'],
+               'expected the failed interval to be skipped, got {}', counts)
+        alerts = [text for text in action_texts(runtime)
+                  if text.startswith('The rate of ')]
+        expect(not alerts, 'route count error alerted: {}', alerts)
+
+
+CHECKS = {
+    'ospf_timed_out_interface': check_ospf_timed_out_interface,
+    'ospf_abandoned_query_stats': check_ospf_abandoned_query_stats,
+    'copp_default_alerting': check_copp_default_alerting,
+    'capability_transient_error': check_capability_transient_error,
+    'prefix_covering_route_same_poll': check_prefix_covering_route_same_poll,
+    'route_snapshot_versions': check_route_snapshot_versions,
+    'route_count_error_skipped': check_route_count_error_skipped,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n')[0])
+    parser.add_argument('--check', action='append', choices=sorted(CHECKS),
+                        help='check to run, repeatable (default: all)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the scripts logs')
+    args = parser.parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    for name in args.check or CHECKS:
+        try:
+            CHECKS[name]()
+        except CheckFailed as error:
+            print('{:<40} FAIL  {}'.format(name, error))
+            return 1
+        print('{:<40} ok'.format(name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,731 @@
+# -*- coding: utf-8 -*-
+#
+# (c) Copyright 2024 Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+'''
+Offline emulator of the NAE scripting runtime.
+
+Loads any script from recommended_scripts/ on a plain Linux host, provides
+the names the switch injects into the script namespace (NAE, Monitor, Rule,
+ActionCLI, AlertLevel, HTTP_ADDRESS, ...) and answers the script's REST
+GETs from a local HTTP server that replays recorded JSON. This makes it
+possible to drive an agent callback for thousands of poll cycles and
+profile it without a switch.
+
+Fixtures are a JSON object mapping REST URIs, as the script requests them,
+to the response body:
+
+    {
+        "/rest/v10.08/system?attributes=copp_statistics": {...},
+        "/rest/v10.13/system/vrfs/*/bgp_routers?depth=4": {...}
+    }
+
+The REST version segment is ignored when matching, so a recording taken
+with one firmware answers every /rest/v10.xx/ request for the same path.
+
+Example:
+
+    python nae_emulator.py \\
+        ../recommended_scripts/routing_health_monitor/routing_health_monitor.py \\
+        --fixtures recorded.json --callback routing_heath_poller \\
+        --cycles 1000 --profile
+'''
+
+import argparse
+import cProfile
+import json
+import logging
+import multiprocessing
+import pstats
+import re
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import basename, splitext
+from urllib.error import HTTPError, URLError
+from urllib.parse import unquote, urlsplit
+from urllib.request import Request, urlopen
+
+REST_VERSION_RE = re.compile(r'/rest/v10\.\d+/')
+REST_VERSION_ANY = '/rest/v10/'
+CONTROL_PATH = '/_emulator/fixtures'
+PERIODIC_RE = re.compile(r'^\s*every\s+(\S+)\s+(second|minute|hour)s?\s*$')
+PERIOD_SECONDS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+SYSLOG_EMERG = 0
+SYSLOG_ALERT = 1
+SYSLOG_CRIT = 2
+SYSLOG_ERR = 3
+SYSLOG_WARNING = 4
+SYSLOG_NOTICE = 5
+SYSLOG_INFO = 6
+SYSLOG_DEBUG = 7
+
+
+class AlertLevel:
+    NONE = 'None'
+    MINOR = 'Minor'
+    MAJOR = 'Major'
+    CRITICAL = 'Critical'
+
+
+class Log:
+    DEBUG = 'DEBUG'
+    INFO = 'INFO'
+    WARNING = 'WARNING'
+    ERR = 'ERR'
+    CRIT = 'CRIT'
+
+
+class NAEException(Exception):
+    pass
+
+
+#
+#   Fixtures and replay server
+#
+
+def normalize_uri(uri):
+    '''Strips scheme/host, percent-decodes and folds the REST version so
+    that recorded and requested URIs compare equal'''
+    parts = urlsplit(uri)
+    path = REST_VERSION_RE.sub(REST_VERSION_ANY, unquote(parts.path),
+                               count=1)
+    query = unquote(parts.query)
+    if query:
+        return path + '?' + query
+    return path
+
+
+class Fixtures:
+    '''
+    Store of REST responses served by the ReplayServer.
+
+    Exact entries are matched on the normalized URI first, then on the
+    path alone (ignoring the query string). Routes are (regex, handler)
+    pairs tried last; the handler receives the match object and the
+    normalized URI and returns the body, or None for a 404.
+    '''
+
+    def __init__(self, recorded=None):
+        self._exact = {}
+        self._path_only = {}
+        self._routes = []
+        if recorded:
+            self.update(recorded)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as infile:
+            return cls(json.load(infile))
+
+    def add(self, uri, body):
+        key = normalize_uri(uri)
+        encoded = json.dumps(body).encode()
+        self._exact[key] = encoded
+        self._path_only[key.split('?', 1)[0]] = encoded
+
+    def update(self, recorded):
+        for uri, body in recorded.items():
+            self.add(uri, body)
+
+    def route(self, pattern, handler):
+        self._routes.append((re.compile(pattern), handler))
+
+    def lookup(self, uri):
+        '''Returns the encoded body for uri or None if nothing matches'''
+        key = normalize_uri(uri)
+        if key in self._exact:
+            return self._exact[key]
+        for regex, handler in self._routes:
+            match = regex.search(key)
+            if match:
+                body = handler(match, key)
+                if body is None:
+                    return None
+                return json.dumps(body).encode()
+        return self._path_only.get(key.split('?', 1)[0])
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        delay = self.server.latency(self.path)
+        if delay:
+            time.sleep(delay)
+        body = self.server.fixtures.lookup(self.path)
+        if body is None:
+            self._reply(404, json.dumps(
+                {'message': 'No fixture for {}'.format(self.path)}).encode())
+        else:
+            self._reply(200, body)
+
+    def do_POST(self):
+        if self.path != CONTROL_PATH:
+            self._reply(404, b'{}')
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.fixtures.update(json.loads(self.rfile.read(length)))
+        self._reply(200, b'{}')
+
+    def _reply(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _constant_latency(seconds):
+    return lambda path: seconds
+
+
+def _serve(fixtures, latency, port_pipe):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _ReplayHandler)
+    server.daemon_threads = True
+    server.fixtures = fixtures
+    server.latency = latency
+    port_pipe.send(server.server_address[1])
+    port_pipe.close()
+    server.serve_forever()
+
+
+class ReplayServer:
+    '''
+    Local HTTP server replaying Fixtures to the emulated agent.
+
+    The server runs in a forked child process so that its CPU time does not
+    show up in the agent's CLOCK_PROCESS_CPUTIME_ID readings. latency is
+    either a number of seconds added to every response or a callable taking
+    the request path and returning seconds.
+    '''
+
+    def __init__(self, fixtures, latency=0.0):
+        self.fixtures = fixtures
+        if callable(latency):
+            self.latency = latency
+        else:
+            self.latency = _constant_latency(latency)
+        self.process = None
+        self.port = None
+
+    @property
+    def address(self):
+        return 'http://127.0.0.1:{}'.format(self.port)
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        parent_end, child_end = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=_serve, args=(self.fixtures, self.latency, child_end),
+            daemon=True)
+        self.process.start()
+        self.port = parent_end.recv()
+        parent_end.close()
+        return self
+
+    def publish(self, recorded):
+        '''Adds or replaces exact fixtures in the running server'''
+        self.fixtures.update(recorded)
+        request = Request(self.address + CONTROL_PATH,
+                          data=json.dumps(recorded).encode(), method='POST')
+        urlopen(request).read()
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+#
+#   Emulated NAE API
+#
+
+class Parameter:
+    def __init__(self, name, definition, value=None):
+        self.name = name
+        self.definition = definition
+        if value is None:
+            value = definition.get('Default')
+        self.value = self.convert(value)
+
+    def convert(self, value):
+        if value is None:
+            return None
+        if str(self.definition.get('Type', '')).lower() == 'integer':
+            return int(value)
+        return value
+
+    def __str__(self):
+        return str(self.value)
+
+    def __format__(self, spec):
+        return format(str(self.value), spec)
+
+
+class Variables(dict):
+    '''self.variables of an agent. Values must be strings, as on the
+    switch. Every write is counted since each one is persisted by the
+    framework.'''
+
+    def __init__(self):
+        dict.__init__(self)
+        self.writes = 0
+        self.bytes_written = 0
+
+    def __setitem__(self, key, value):
+        if not isinstance(value, str):
+            raise TypeError('NAE variable {} must be a string, not {}'.format(
+                key, type(value).__name__))
+        self.writes += 1
+        self.bytes_written += len(key) + len(value)
+        dict.__setitem__(self, key, value)
+
+
+class Runtime:
+    '''
+    State the NAE framework keeps for one agent outside of the script:
+    parameters, variables, alert level, registered monitors/rules/graphs,
+    executed actions and REST accounting.
+    '''
+
+    def __init__(self, http_address, agent_name, script_name,
+                 sleep_scale=1.0):
+        self.http_address = http_address
+        self.agent_name = agent_name
+        self.script_name = script_name
+        self.sleep_scale = sleep_scale
+        self.params = {}
+        self.variables = Variables()
+        self.logger = logging.getLogger('nae.{}'.format(agent_name))
+        self.alert_level = None
+        self.alert_descriptions = {}
+        self.monitors = []
+        self.rules = []
+        self.graphs = []
+        self.actions = []
+        self.rest_calls = 0
+        self.rest_bytes = 0
+        # Scripts may issue REST queries from worker threads
+        self._counter_lock = threading.Lock()
+
+    def get_rest_request_json(self, url, retry=3, wait_between_retries=5):
+        attempts = max(int(retry), 1)
+        for attempt in range(attempts):
+            with self._counter_lock:
+                self.rest_calls += 1
+            try:
+                with urlopen(url) as response:
+                    body = response.read()
+            except HTTPError as e:
+                raise NAEException(
+                    'GET {} failed with status code {}'.format(url, e.code))
+            except URLError as e:
+                if attempt + 1 == attempts:
+                    raise NAEException('GET {} failed: {}'.format(url, e))
+                time.sleep(wait_between_retries * self.sleep_scale)
+                continue
+            with self._counter_lock:
+                self.rest_bytes += len(body)
+            return json.loads(body)
+
+    def record_action(self, kind, args, kwargs):
+        self.actions.append((kind, args, kwargs))
+
+
+def build_api(runtime):
+    '''Returns the names the switch injects into a script namespace, bound
+    to runtime'''
+
+    class NAE:
+        '''Base class of every Agent. Sub-agents that subclass Agent without
+        calling its __init__ still see params, variables and logger.'''
+
+        _runtime = runtime
+
+        def __new__(cls, *args, **kwargs):
+            self = object.__new__(cls)
+            self.params = runtime.params
+            self.variables = runtime.variables
+            self.logger = runtime.logger
+            self.name = runtime.agent_name
+            self.uri = '/rest/v1/system/nae_scripts/{}/nae_agents/{}'.format(
+                runtime.script_name, runtime.agent_name)
+            return self
+
+        def get_rest_request_json(self, url, retry=3, wait_between_retries=5):
+            return runtime.get_rest_request_json(
+                url, retry=retry, wait_between_retries=wait_between_retries)
+
+        def set_alert_level(self, level):
+            runtime.alert_level = level
+
+        def get_alert_level(self):
+            return runtime.alert_level
+
+        def remove_alert_level(self):
+            runtime.alert_level = None
+
+        def init_alert_description(self, descriptions):
+            runtime.alert_descriptions = dict(descriptions)
+
+        def set_alert_description_for_key(self, key, description):
+            runtime.alert_descriptions[key] = description
+
+        def clear_alert_description_for_key(self, key):
+            runtime.alert_descriptions[key] = 'Normal'
+
+    class MonitorFunction:
+        def __init__(self, uri, *args):
+            self.uri = uri
+            self.args = args
+
+    class Sum(MonitorFunction):
+        pass
+
+    class Rate(MonitorFunction):
+        pass
+
+    class Average(MonitorFunction):
+        pass
+
+    class Count(MonitorFunction):
+        pass
+
+    class Min(MonitorFunction):
+        pass
+
+    class Max(MonitorFunction):
+        pass
+
+    class Monitor:
+        def __init__(self, uri, name=None, params=None):
+            self.uri = uri
+            self.name = name
+            self.params = params or []
+            self.value = None
+            runtime.monitors.append(self)
+
+        def __str__(self):
+            return str(self.name)
+
+    class Title:
+        def __init__(self, title, params=None):
+            self.title = title
+            self.params = params or []
+
+    class Graph:
+        def __init__(self, monitors, title=None, dashboard_display=False):
+            self.monitors = monitors
+            self.title = title
+            self.dashboard_display = dashboard_display
+            runtime.graphs.append(self)
+
+    class Rule:
+        def __init__(self, description, params=None):
+            self.description = description
+            self.params = params or []
+            self.conditions = []
+            self.actions = []
+            self.clear_conditions = []
+            self.clear_actions = []
+            runtime.rules.append(self)
+
+        def condition(self, expression, params=None):
+            self.conditions.append((expression, params or []))
+
+        def action(self, action, *args, **kwargs):
+            self.actions.append(action)
+
+        def clear_condition(self, expression, params=None):
+            self.clear_conditions.append((expression, params or []))
+
+        def clear_action(self, action, *args, **kwargs):
+            self.clear_actions.append(action)
+
+        def resolved_description(self):
+            '''Returns the description with its parameters filled in'''
+            return self.description.format(*[str(p) for p in self.params])
+
+        def period(self):
+            '''Returns the period in seconds of an "every N ..." rule, or
+            None for any other condition'''
+            for expression, params in self.conditions:
+                match = PERIODIC_RE.match(
+                    expression.format(*[str(p) for p in params]))
+                if match:
+                    return float(match.group(1)) * \
+                        PERIOD_SECONDS[match.group(2)]
+            return None
+
+    class ADCList:
+        class Type:
+            IPV4 = 'ipv4'
+            IPV6 = 'ipv6'
+            MAC = 'mac'
+
+        def __init__(self, name, type=None):
+            self.name = name
+            self.type = type
+            self.entries = {}
+
+        def add_entry(self, sequence, entry):
+            self.entries[sequence] = entry
+
+    class ADCEntry:
+        '''Records the match criteria set through any of the ADCEntry
+        setters (dst_ip, src_l4_port, protocol, ...)'''
+
+        class Type:
+            MATCH = 'match'
+
+        class Protocol:
+            TCP = 'tcp'
+            UDP = 'udp'
+            ICMP = 'icmp'
+
+        def __init__(self, type):
+            self.type = type
+            self.criteria = {}
+
+        def __getattr__(self, name):
+            if name.startswith('_'):
+                raise AttributeError(name)
+
+            def setter(*args, **kwargs):
+                self.criteria[name] = (args, kwargs)
+            return setter
+
+    def recorder(kind):
+        class RecordedAction:
+            def __init__(self, *args, **kwargs):
+                self.args = args
+                self.kwargs = kwargs
+                runtime.record_action(kind, args, kwargs)
+        RecordedAction.__name__ = kind
+        return RecordedAction
+
+    api = {
+        'NAE': NAE,
+        'NAEException': NAEException,
+        'HTTP_ADDRESS': runtime.http_address,
+        'AlertLevel': AlertLevel,
+        'Log': Log,
+        'Monitor': Monitor,
+        'Rule': Rule,
+        'Graph': Graph,
+        'Title': Title,
+        'Sum': Sum,
+        'Rate': Rate,
+        'Average': Average,
+        'Count': Count,
+        'Min': Min,
+        'Max': Max,
+        'ADCList': ADCList,
+        'ADCEntry': ADCEntry,
+    }
+    for kind in ('ActionSyslog', 'ActionCLI', 'ActionCli', 'ActionShell',
+                 'ActionCustomReport', 'ActionEmail', 'ActionSNMP', 'Action',
+                 'Actions', 'Clear'):
+        api[kind] = recorder(kind)
+    for name, value in globals().items():
+        if name.startswith('SYSLOG_'):
+            api[name] = value
+    return api
+
+
+TEMPLATEAPI_MODULES = ('templateapi', 'templateapi.api', 'templateapi.nae',
+                       'templateapi.alert_level', 'templateapi.adc',
+                       'templateapi.action', 'templateapi.monitor',
+                       'templateapi.constants')
+
+
+def install_templateapi(api):
+    '''Makes "from templateapi.xxx import ..." in scripts resolve to api'''
+    for module_name in TEMPLATEAPI_MODULES:
+        module = types.ModuleType(module_name)
+        module.__dict__.update(api)
+        module.__all__ = list(api)
+        sys.modules[module_name] = module
+
+
+class EmulatedAgent:
+    '''
+    A script loaded into the emulator and instantiated as an agent.
+
+    agent is the script's Agent instance; its callbacks can be called
+    directly (e.g. agent.routing_heath_poller(event)) or through poll(),
+    which runs every periodic rule action once per cycle.
+    '''
+
+    def __init__(self, module, agent, runtime):
+        self.module = module
+        self.agent = agent
+        self.runtime = runtime
+
+    def event(self, rule=None, value=None, labels=''):
+        description = rule.resolved_description() if rule is not None \
+            else ''
+        return {
+            'rule_description': description,
+            'condition_description': description,
+            'value': value,
+            'labels': labels,
+            'time': int(time.time()),
+        }
+
+    def periodic_rules(self):
+        return [rule for rule in self.runtime.rules
+                if rule.period() is not None]
+
+    def fire(self, rule, value=None, labels='', clear=False):
+        '''Runs the (clear) actions of rule as if its condition fired'''
+        actions = rule.clear_actions if clear else rule.actions
+        for action in actions:
+            if callable(action):
+                action(self.event(rule, value, labels))
+            else:
+                self.runtime.record_action(action, (), {})
+
+    def poll(self, cycles=1, callback=None):
+        '''Runs callback (name of an Agent method) or every periodic rule
+        for the given number of cycles'''
+        rules = self.periodic_rules()
+        for _ in range(cycles):
+            if callback is not None:
+                getattr(self.agent, callback)(self.event())
+            else:
+                for rule in rules:
+                    self.fire(rule)
+
+
+def load_script(path, server, params=None, agent_name=None, sleep_scale=1.0):
+    '''
+    Executes the script at path against server (a started ReplayServer)
+    and returns an EmulatedAgent. params overrides ParameterDefinitions
+    defaults by name.
+    '''
+    script_name = splitext(basename(path))[0]
+    runtime = Runtime(server.address, agent_name or script_name + '_agent',
+                      script_name, sleep_scale=sleep_scale)
+    api = build_api(runtime)
+    install_templateapi(api)
+
+    module = types.ModuleType(script_name)
+    module.__file__ = path
+    module.__dict__.update(api)
+    with open(path) as infile:
+        code = compile(infile.read(), path, 'exec')
+    exec(code, module.__dict__)
+
+    params = params or {}
+    definitions = getattr(module, 'ParameterDefinitions', {})
+    unknown = set(params) - set(definitions)
+    if unknown:
+        raise ValueError('Unknown parameters for {}: {}'.format(
+            script_name, ', '.join(sorted(unknown))))
+    for name, definition in definitions.items():
+        runtime.params[name] = Parameter(name, definition, params.get(name))
+
+    agent = module.Agent()
+    return EmulatedAgent(module, agent, runtime)
+
+
+def parse_params(pairs):
+    params = {}
+    for pair in pairs or []:
+        if '=' not in pair:
+            raise ValueError('Parameter {} is not in name=value form'.format(
+                pair))
+        name, value = pair.split('=', 1)
+        params[name] = value
+    return params
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run an NAE script offline against recorded REST data')
+    parser.add_argument('script', help='path to the NAE script')
+    parser.add_argument('--fixtures', help='JSON file of recorded responses')
+    parser.add_argument('--param', action='append', metavar='NAME=VALUE',
+                        help='override a ParameterDefinitions default')
+    parser.add_argument('--callback',
+                        help='Agent method to call every cycle. Default is '
+                             'every periodic rule action')
+    parser.add_argument('--cycles', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every REST response')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the top cProfile entries of the run')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the agent logger output')
+    args = parser.parse_args(argv)
+
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.disable(logging.CRITICAL)
+    fixtures = Fixtures.load(args.fixtures) if args.fixtures else Fixtures()
+
+    with ReplayServer(fixtures, latency=args.latency) as server:
+        emulated = load_script(args.script, server,
+                               params=parse_params(args.param),
+                               sleep_scale=0.0)
+        runtime = emulated.runtime
+        calls_at_init = runtime.rest_calls
+        profiler = cProfile.Profile() if args.profile else None
+        wall0 = time.monotonic()
+        cpu0 = time.clock_gettime(time.CLOCK_PROCESS_CPUTIME_ID)
+        if profiler:
+            profiler.enable()
+        emulated.poll(args.cycles, callback=args.callback)
+        if profiler:
+            profiler.disable()
+        cpu = time.clock_gettime(time.CLOCK_PROCESS_CPUTIME_ID) - cpu0
+        wall = time.monotonic() - wall0
+
+    print('cycles:      {}'.format(args.cycles))
+    print('wall time:   {:.6f} s ({:.6f} s/cycle)'.format(
+        wall, wall / max(args.cycles, 1)))
+    print('cpu time:    {:.6f} s ({:.6f} s/cycle)'.format(
+        cpu, cpu / max(args.cycles, 1)))
+    print('rest calls:  {} ({} during init)'.format(
+        runtime.rest_calls, calls_at_init))
+    print('rest bytes:  {}'.format(runtime.rest_bytes))
+    print('variables:   {} writes, {} bytes'.format(
+        runtime.variables.writes, runtime.variables.bytes_written))
+    print('actions:     {}'.format(len(runtime.actions)))
+    print('alert level: {}'.format(runtime.alert_level))
+    if profiler:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())